@@ -1,3 +1,4 @@
-# ./getOutput.sh urls-api UrlFuncId
-aws cloudformation describe-stacks --stack-name $1 \
-  --query "Stacks[0].Outputs[?OutputKey=='$2'].OutputValue" --output text
+# ./getStackOutputVal.sh urls-api UrlFuncId
+#
+# Uses stack.py output (cached, one DescribeStacks per stack rather than per key)
+exec "$(dirname "$0")/py3/stack.py" output "$1" "$2"
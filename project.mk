@@ -25,6 +25,12 @@ SHELL=/usr/bin/env bash -o pipefail
 makefiles = $(shell export GLOBIGNORE=".$(FUNCS_DIR)/ignore/.*" ; echo $(FUNCS_DIR)/*/makefile)
 subdirs := $(foreach proj,$(makefiles),$(dir $(proj)))
 
+# Runs function targets in parallel (e.g. BUILD_FLAGS="-j 8 -k" to keep going)
+# Unchanged functions are restored from the build cache; set
+# MAKETOOLS_ARTIFACT_STORE=s3://bucket/prefix to share it (e.g. across CI runs).
+# Restored zips are byte-identical, so package does not upload them again.
+BUILD_PY = $(SELF_DIR)/py3/build.py --funcs-dir $(FUNCS_DIR) --layer-dir $(LAYER_DIR) $(BUILD_FLAGS)
+
 list:
 	@echo -------Funcs-----------
 	@for dir in $(subdirs); do echo $$dir ; done
@@ -33,15 +39,10 @@ list:
 
 
 build-src:
-	@for dir in $(subdirs); do \
-		$(MAKE) -C $$dir build; \
-	 done
+	@$(BUILD_PY) src --no-layer
 
 build-lambda:
-	@echo "Building lambdas... [$(subdirs)]"
-	@for dir in $(subdirs); do \
-		$(MAKE) -C $$dir lambda; \
-	 done
+	@$(BUILD_PY) lambda --no-layer
 
 ifneq "$(wildcard $$LAYER_DIR)" ""
 
@@ -55,30 +56,18 @@ clean-layer:
 endif
 
 clean-projects:
-	@for dir in $(subdirs); do \
-		$(MAKE) -C $$dir clean; \
-	 done
+	@$(BUILD_PY) clean
 
 test:
-	@set -e; for dir in $(subdirs); do \
-		cd $$dir; \
-		npm run test; \
-	 done
+	@$(BUILD_PY) test
 
 lint:
-	@set -e; for dir in $(subdirs); do \
-		cd $$dir; \
-		npm run lint; \
-	 done
+	@$(BUILD_PY) lint
 
 clean: clean-projects clean-layer
 
 
-# Add build-layer as dependency if ./layer exists
-BUILD_DEPS = build-lambda
-ifneq "$(wildcard ./layer)" ""
-BUILD_DEPS += build-layer
-endif
-
-build: $(BUILD_DEPS)
+# Layer (if present) first, then all functions in parallel
+build:
+	@$(BUILD_PY) lambda
 
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- mode: python3 -*-
+
+import click
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from local.utils import *
+from local.console_util import *
+
+
+@click.group()
+def bench():
+  '''
+    Benchmarks for the local helpers
+  '''
+  pass
+
+
+def flattenRecursive(ob, prefix=''):
+  '''
+    Previous flatten (recursive, copies each child dict into its parent)
+  '''
+  flat={}
+  for key, val in ob.items():
+    cprefix = prefix + key
+    if isinstance(val, dict):
+      sub=flattenRecursive(val, cprefix + '/')
+      for skey, sval in sub.items():
+        flat[skey] = sval
+    else:
+      flat[prefix + key] = val
+  return flat
+
+
+def nestMerge(pairs):
+  '''
+    Previous way of building a tree from flat pairs
+  '''
+  dest = {}
+  for path, val in pairs:
+    merge(nest(path, val), dest)
+  return dest
+
+
+def makeTree(leaves, fanout, depth):
+  '''
+    Builds a tree with about leaves leaves, fanout children per node and
+    leaves at depth
+  '''
+  count = [0]
+
+  def build(level):
+    node = {}
+    for i in range(fanout):
+      if count[0] >= leaves:
+        break
+      if level == depth:
+        node['k{}'.format(i)] = 'v{}'.format(count[0])
+        count[0] += 1
+      else:
+        node['n{}'.format(i)] = build(level + 1)
+    return node
+
+  return build(1)
+
+
+def makeChain(depth):
+  '''
+    Builds a single path depth levels deep (without recursion)
+  '''
+  tree = node = {}
+  for i in range(depth - 1):
+    node = node.setdefault('n{}'.format(i), {})
+  node['leaf'] = 'v'
+  return tree
+
+
+def measure(label, fn):
+  '''
+    Runs fn, printing wall time and (from a second, traced run) peak memory
+  '''
+  start = time.perf_counter()
+  try:
+    out = fn()
+  except RecursionError:
+    print('{:<28} {}'.format(label, red('RecursionError')))
+    return None
+  elapsed = (time.perf_counter() - start) * 1000
+  tracemalloc.start()
+  fn()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  print('{:<28} {:8.1f} ms  peak {:8.1f} MB'.format(label, elapsed, peak / 1e6))
+  return out
+
+
+def consume(it):
+  n = 0
+  for _ in it:
+    n += 1
+  return n
+
+
+@click.command()
+@click.option('-n', '--leaves', default=100000, help='number of leaves')
+@click.option('-f', '--fanout', default=10, help='children per node')
+@click.option('-d', '--depth', default=5, help='depth of leaves')
+def flatten_(leaves, fanout, depth):
+  '''
+    Compares recursive flatten/nest+merge with iterFlat/unflatten
+  '''
+  tree = makeTree(leaves, fanout, depth)
+  print(bold('{} leaves, fanout {}, depth {}'.format(leaves, fanout, depth)))
+
+  old = measure('flatten (recursive)', lambda: flattenRecursive(tree, '/'))
+  new = measure('flatten (iterative)', lambda: flatten(tree, '/'))
+  measure('iterFlat (streamed)', lambda: consume(iterFlat(tree, '/')))
+  if old is not None and old != new:
+    print(bred('Mismatch between implementations'))
+    sys.exit(1)
+
+  pairs = list(new.items())
+  measure('nest + merge', lambda: nestMerge(pairs))
+  rebuilt = measure('unflatten', lambda: unflatten(pairs))
+  if rebuilt != tree:
+    print(bred('unflatten did not rebuild the tree'))
+    sys.exit(1)
+
+  print(bold('\nDeep chain (depth {})'.format(sys.getrecursionlimit() * 2)))
+  chain = makeChain(sys.getrecursionlimit() * 2)
+  measure('flatten (recursive)', lambda: flattenRecursive(chain, '/'))
+  measure('flatten (iterative)', lambda: flatten(chain, '/'))
+
+
+# Commands that must start without touching AWS (and so must not import boto3)
+STARTUP_COMMANDS = [
+    ['stack.py', '--help'],
+    ['stack.py', 'info', '--help'],
+    ['values.py', '--help'],
+    ['values.py', 'show', '--help'],
+]
+
+
+def importTimes(args):
+  '''
+    Runs python -X importtime with args; returns (wall ms, {module: self us})
+  '''
+  here = os.path.dirname(os.path.abspath(__file__))
+  start = time.perf_counter()
+  proc = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                        cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                        universal_newlines=True)
+  wall = (time.perf_counter() - start) * 1000
+  modules = {}
+  for line in proc.stderr.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    selfUs, _, name = line[len('import time:'):].split('|')
+    modules[name.strip()] = int(selfUs)
+  return wall, modules
+
+
+@click.command()
+@click.option('-n', '--runs', default=5, help='runs per command (best is reported)')
+@click.option('--max-ms', default=0, help='fail if any command imports take longer (0 = no limit)')
+@click.option('-t', '--top', default=5, help='slowest modules to list per command')
+def startup(runs, max_ms, top):
+  '''
+    Measures CLI startup (python -X importtime) and fails on regressions
+
+    Fails if boto3 is imported just to show help or if imports exceed --max-ms.
+  '''
+  failed = False
+  for args in STARTUP_COMMANDS:
+    best = min((importTimes(args) for _ in range(runs)), key=lambda r: r[0])
+    wall, modules = best
+    total = sum(modules.values()) / 1000
+    print(bold(' '.join(args)))
+    print('  wall {:7.1f} ms  imports {:7.1f} ms  modules {}'.format(wall, total, len(modules)))
+    for name, us in sorted(modules.items(), key=lambda m: -m[1])[:top]:
+      print(dim('    {:7.1f} ms  {}'.format(us / 1000, name)))
+    if 'boto3' in modules:
+      print(bred('  boto3 imported at startup'))
+      failed = True
+    if max_ms and total > max_ms:
+      print(bred('  imports over {} ms'.format(max_ms)))
+      failed = True
+  if failed:
+    sys.exit(1)
+
+
+bench.add_command(flatten_, name='flatten')
+bench.add_command(startup)
+
+if __name__ == "__main__":
+  bench()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- mode: python3 -*-
+
+import click
+import glob
+import os
+import sys
+import time
+from fnmatch import fnmatchcase
+from functools import partial
+
+from local.artifacts import ArtifactStore, sourceHash
+from local.batch import runAll
+from local.dag import Node, runGraph
+from local.console_util import *
+
+
+@click.group()
+@click.option('-j', '--jobs', type=int, help='max concurrent builds (default: cpu count)')
+@click.option('-k', '--keep-going', is_flag=True, help='Continue after a failure (skip only what depends on it)')
+@click.option('--funcs-dir', default='./funcs', help='directory holding one project per function')
+@click.option('--layer-dir', default='./layer', help='layer directory (built first when present)')
+@click.option('-m', '--match', 'matches', multiple=True, help='only functions whose directory name matches (glob, repeatable)')
+@click.pass_context
+def build(ctx, jobs, keep_going, funcs_dir, layer_dir, matches):
+  '''
+    Runs function project targets in parallel (replaces sam.mk/project.mk loops)
+
+    Functions are the directories with a makefile under --funcs-dir (except
+    "ignore"). Output lines are prefixed with the function name. lambda and
+    src skip functions whose sources are unchanged since a cached build
+    (see local/artifacts.py). Example:
+
+      ./build.py -j 8 lambda
+  '''
+  ctx.obj = {
+      'jobs': jobs,
+      'keepGoing': keep_going,
+      'funcs': findFuncDirs(funcs_dir, matches),
+      'layer': layer_dir if os.path.isfile(os.path.join(layer_dir, 'nodejs', 'makefile')) else None,
+  }
+
+
+def findFuncDirs(funcsDir, matches=()):
+  '''
+    Returns sorted function directories (those with a makefile)
+  '''
+  dirs = []
+  for makefile in sorted(glob.glob(os.path.join(funcsDir, '*', 'makefile'))):
+    path = os.path.dirname(makefile)
+    name = os.path.basename(path)
+    if name == 'ignore':
+      continue
+    if matches and not any(fnmatchcase(name, m) for m in matches):
+      continue
+    dirs.append(path)
+  return dirs
+
+
+def makeCmd(target):
+  return [os.environ.get('MAKE', 'make'), '--no-print-directory', target]
+
+
+def funcNodes(funcs, cmd, deps=()):
+  return [Node(os.path.basename(d), cmd, d, list(deps)) for d in funcs]
+
+
+def layerNodes(layer, target):
+  if not layer:
+    return []
+  return [Node('layer', makeCmd(target), os.path.join(layer, 'nodejs'), [])]
+
+
+def runNodes(obj, nodes, cached=()):
+  '''
+    Runs nodes and prints a summary (cached names are listed as restored)
+
+    Returns an Outcome per node.
+  '''
+  if not nodes and not cached:
+    print(dim('Nothing to do'))
+    return []
+  print(bold('Running {} tasks ({} jobs)'.format(len(nodes), obj['jobs'] or os.cpu_count())))
+  start = time.perf_counter()
+  outcomes = runGraph(nodes, obj['jobs'], obj['keepGoing'])
+  elapsed = time.perf_counter() - start
+  print()
+  for name in cached:
+    print(blue('{:<30} cached'.format(name)))
+  for o in outcomes:
+    if o.status == 'ok':
+      print(green('{:<30} ok      {:7.2f}s'.format(o.name, o.elapsed)))
+    elif o.status == 'failed':
+      print(red('{:<30} failed  {:7.2f}s  (exit {})'.format(o.name, o.elapsed, o.code)))
+    else:
+      print(dim('{:<30} skipped'.format(o.name)))
+  failed = sum(1 for o in outcomes if o.status != 'ok')
+  summary = '{} ok, {} cached, {} failed or skipped in {:.2f}s'.format(
+      len(outcomes) - failed, len(cached), failed, elapsed)
+  print(bred(summary) if failed else bold(summary))
+  return outcomes
+
+
+def checkOutcomes(outcomes):
+  if any(o.status != 'ok' for o in outcomes):
+    sys.exit(1)
+
+
+def buildOptions(f):
+  f = click.option('--layer/--no-layer', default=True, help='Build the layer first (when present)')(f)
+  f = click.option('--cache/--no-cache', default=True, help='Restore outputs of functions whose inputs are unchanged')(f)
+  f = click.option('--store', envvar='MAKETOOLS_ARTIFACT_STORE',
+                   help='Shared artifact store: s3://bucket/prefix or a directory (env MAKETOOLS_ARTIFACT_STORE)')(f)
+  return f
+
+
+def buildFuncs(obj, target, layer, cache, store):
+  '''
+    Runs make target for each function after the layer build
+
+    With cache, functions whose inputs hash to a stored build get its outputs
+    (dist/, zip) restored instead of building; new builds are stored.
+  '''
+  funcs = obj['funcs']
+  jobs = obj['jobs'] or os.cpu_count()
+  keys = {}
+  hits = []
+  if cache:
+    artifacts = ArtifactStore(store)
+    keys = {d: sourceHash(d, target) for d in funcs}
+    for r in runAll([(d, partial(artifacts.restore, keys[d], d)) for d in funcs], jobs, retries=0):
+      if r.ok and r.value:
+        hits.append(r.key)
+      elif not r.ok:
+        print(red('{} restore failed (building instead): {}'.format(r.key, r.error)))
+
+  layers = layerNodes(obj['layer'], 'build') if layer else []
+  todo = [d for d in funcs if d not in hits]
+  outcomes = runNodes(obj, layers + funcNodes(todo, makeCmd(target), [n.name for n in layers]),
+                      [os.path.basename(d) for d in hits])
+  if cache:
+    built = set(o.name for o in outcomes if o.status == 'ok')
+    saves = [(d, partial(artifacts.save, keys[d], d)) for d in todo if os.path.basename(d) in built]
+    for r in runAll(saves, jobs):
+      if not r.ok:
+        print(red('{} not cached: {}'.format(r.key, r.error)))
+  checkOutcomes(outcomes)
+
+
+@click.command()
+@buildOptions
+@click.pass_obj
+def lambda_(obj, layer, cache, store):
+  '''
+    Runs "make lambda" for each function (after the layer build)
+  '''
+  buildFuncs(obj, 'lambda', layer, cache, store)
+
+
+@click.command()
+@buildOptions
+@click.pass_obj
+def src(obj, layer, cache, store):
+  '''
+    Runs "make build" for each function (after the layer build)
+  '''
+  buildFuncs(obj, 'build', layer, cache, store)
+
+
+@click.command()
+@click.pass_obj
+def test(obj):
+  '''
+    Runs "npm run test" for each function
+  '''
+  checkOutcomes(runNodes(obj, funcNodes(obj['funcs'], ['npm', 'run', 'test'])))
+
+
+@click.command()
+@click.pass_obj
+def lint(obj):
+  '''
+    Runs "npm run lint" for each function
+  '''
+  checkOutcomes(runNodes(obj, funcNodes(obj['funcs'], ['npm', 'run', 'lint'])))
+
+
+@click.command()
+@click.option('--layer/--no-layer', default=False, help='Also clean the layer')
+@click.pass_obj
+def clean(obj, layer):
+  '''
+    Runs "make clean" for each function
+  '''
+  layers = layerNodes(obj['layer'], 'clean') if layer else []
+  checkOutcomes(runNodes(obj, layers + funcNodes(obj['funcs'], makeCmd('clean'))))
+
+
+@click.command('list')
+@click.pass_obj
+def list_(obj):
+  '''
+    Lists function directories (and the layer)
+  '''
+  if obj['layer']:
+    print('{} {}'.format(bold('layer'), dim(obj['layer'])))
+  for d in obj['funcs']:
+    print('{} {}'.format(blue(os.path.basename(d)), dim(d)))
+
+
+build.add_command(lambda_, 'lambda')
+build.add_command(src)
+build.add_command(test)
+build.add_command(lint)
+build.add_command(clean)
+build.add_command(list_)
+
+if __name__ == "__main__":
+  build()  # pylint: disable=no-value-for-parameter
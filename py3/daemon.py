@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- mode: python3 -*-
+
+import click
+import os
+import subprocess
+import sys
+import time
+
+from local.server import *
+from local.cache import cacheDir
+from local.console_util import *
+
+
+@click.group()
+def daemon():
+  '''
+    Warm daemon for stack.py/values.py (optional)
+
+    While running, read-only commands (see DAEMON_COMMANDS) are forwarded to it
+    over a Unix socket instead of starting Python and boto3 each time. Set
+    MAKETOOLS_NO_DAEMON=1 to bypass it.
+  '''
+  pass
+
+
+@click.command()
+@click.option('-f', '--foreground', is_flag=True, help='Run in this process')
+@click.option('-i', '--idle', default=30, help='exit after this many idle minutes')
+def start(foreground, idle):
+  '''
+    Starts the daemon (background by default)
+  '''
+  if call({'op': 'status'}, timeout=2):
+    print('Already running')
+    return
+
+  if not foreground:
+    log = os.path.join(cacheDir(), 'daemon.log')
+    with open(log, 'ab') as f:
+      subprocess.Popen(
+          [sys.executable, os.path.abspath(__file__), 'start', '--foreground', '--idle', str(idle)],
+          stdin=subprocess.DEVNULL, stdout=f, stderr=f, start_new_session=True)
+    for _ in range(50):
+      if call({'op': 'status'}, timeout=2):
+        print('Started (log: {})'.format(log))
+        return
+      time.sleep(0.1)
+    print(red('Daemon did not start (see {})'.format(log)))
+    sys.exit(1)
+
+  # Import the tools (and boto3) once; every request reuses them
+  import stack
+  import values
+  from local import aws
+  aws.session()
+  print('Listening on {}'.format(socketPath()))
+  Daemon({'stack': stack.stack, 'values': values.values}, idle * 60).serve()
+
+
+@click.command()
+def stop():
+  '''
+    Stops the daemon
+  '''
+  if call({'op': 'stop'}, timeout=5):
+    print('Stopped')
+  else:
+    print('Not running')
+
+
+@click.command()
+def status():
+  '''
+    Shows whether the daemon is running
+  '''
+  info = call({'op': 'status'}, timeout=2)
+  if not info:
+    print(dim('Not running'))
+    return
+  print(green('Running'), dim('pid {pid}, up {uptime:.0f}s, served {served}'.format(**info)))
+
+
+daemon.add_command(start)
+daemon.add_command(stop)
+daemon.add_command(status)
+
+if __name__ == "__main__":
+  daemon()  # pylint: disable=no-value-for-parameter
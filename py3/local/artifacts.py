@@ -0,0 +1,270 @@
+# -*- mode: python3 -*-
+#
+# Content-addressed cache of function build outputs
+#
+# The key is a hash of everything that goes into a build (function name,
+# sources, package.json, lockfile, tsconfig.json, makefile and includes). Outputs (dist/, lambda zip) are
+# stored as one tar per key in a local directory and optionally mirrored to
+# a shared store (s3://bucket/prefix or a directory). Restoring puts back the
+# exact same bytes, so the zip's hash is unchanged and "sam package" finds
+# the object it uploaded before instead of uploading again.
+#
+
+import glob
+import hashlib
+import os
+import re
+import shutil
+import tarfile
+from .cache import cacheDir
+from .utils import atomicWrite
+
+# Build inputs (relative to the function directory; directories recurse)
+HASH_INPUTS = ['src', 'package.json', 'package-lock.json', 'npm-shrinkwrap.json', 'yarn.lock', 'tsconfig.json']
+# Build outputs (globs relative to the function directory)
+ARTIFACTS = ['dist', '*.zip']
+# Bump when the key or archive layout changes
+CACHE_VERSION = '2'
+# Makefile include directives (include, -include, sinclude)
+INCLUDE_REGEX = re.compile(r'^\s*(?:-|s)?include\s+(.+)$')
+# Simple variable assignments and references ($(X) or ${X})
+ASSIGN_REGEX = re.compile(r'^\s*([A-Za-z_][A-Za-z0-9_]*)\s*(?::=|::=|\?=|=)\s*(.*)$')
+VAR_REGEX = re.compile(r'\$[({]([A-Za-z_][A-Za-z0-9_]*)[)}]')
+# This toolkit's own makefiles (project.mk, npm.mk, ...), which function
+# makefiles usually include through a variable
+TOOL_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def iterFiles(root, names):
+  '''
+    Yields relative paths of files under root for names (sorted, recursive)
+  '''
+  for name in sorted(names):
+    path = os.path.join(root, name)
+    if os.path.isfile(path):
+      yield name
+    elif os.path.isdir(path):
+      for dirPath, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+          yield os.path.relpath(os.path.join(dirPath, f), root)
+
+
+def makefiles(funcDir, name='makefile'):
+  '''
+    Returns the function's makefile and the files it includes (recursively),
+    as absolute paths
+
+    Variables in include paths are expanded from the environment and simple
+    assignments seen so far; includes that still use variables are left out
+    (the toolkit's makefiles are hashed separately).
+  '''
+  found = []
+  todo = [os.path.join(funcDir, name)]
+  variables = dict(os.environ)
+
+  def expand(m):
+    return variables.get(m.group(1), m.group(0))
+
+  while todo:
+    path = os.path.abspath(todo.pop(0))
+    if path in found or not os.path.isfile(path):
+      continue
+    found.append(path)
+    with open(path, errors='replace') as f:
+      for line in f:
+        line = line.split('#')[0]
+        m = ASSIGN_REGEX.match(line)
+        if m:
+          value = VAR_REGEX.sub(expand, m.group(2).strip())
+          if '$' not in value:
+            variables[m.group(1)] = value
+          continue
+        m = INCLUDE_REGEX.match(line)
+        if not m:
+          continue
+        for inc in VAR_REGEX.sub(expand, m.group(1)).split():
+          if '$' not in inc:
+            todo.append(os.path.join(os.path.dirname(path), inc))
+  return found
+
+
+def sourceHash(funcDir, target, inputs=HASH_INPUTS):
+  '''
+    Returns the cache key for building target in funcDir
+
+    Covers the function's name, its inputs, and its makefile with whatever
+    that includes (the recipe that turns inputs into outputs).
+  '''
+  name = os.path.basename(os.path.abspath(funcDir))
+  h = hashlib.sha256('{}\0{}\0{}\0'.format(CACHE_VERSION, target, name).encode('utf-8'))
+  files = [(rel.replace(os.sep, '/'), os.path.join(funcDir, rel)) for rel in iterFiles(funcDir, inputs)]
+  files += [('makefile:' + os.path.relpath(path, funcDir).replace(os.sep, '/'), path)
+            for path in makefiles(funcDir)]
+  files += [('maketools:' + os.path.basename(path), path)
+            for path in sorted(glob.glob(os.path.join(TOOL_DIR, '*.mk')))]
+  for label, path in files:
+    h.update(label.encode('utf-8') + b'\0')
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        h.update(chunk)
+    h.update(b'\0')
+  return h.hexdigest()
+
+
+def artifactPaths(funcDir, patterns=ARTIFACTS):
+  paths = set()
+  for pattern in patterns:
+    paths.update(os.path.relpath(p, funcDir) for p in glob.glob(os.path.join(funcDir, pattern)))
+  return sorted(paths)
+
+
+def resetInfo(info):
+  # Same bytes for same content (zip mtimes inside are kept as built)
+  info.uid = info.gid = 0
+  info.uname = info.gname = ''
+  return info
+
+
+class ArtifactStore:
+  '''
+    Archives keyed by hash: local directory first, then the optional mirror
+  '''
+
+  def __init__(self, mirror=None, local=None):
+    self.local = local or cacheDir('artifacts')
+    self.mirror = mirror
+
+  def localPath(self, key):
+    return os.path.join(self.local, key + '.tar')
+
+  def fetch(self, key):
+    '''
+      Returns local archive path for key (downloading from the mirror on a
+      local miss), or None
+    '''
+    path = self.localPath(key)
+    if os.path.exists(path):
+      return path
+    if not self.mirror:
+      return None
+    if self.mirror.startswith('s3://'):
+      from . import aws
+      bucket, prefix = splitS3(self.mirror)
+      try:
+        with atomicWrite(path, binary=True) as f:
+          aws.client('s3').download_fileobj(bucket, prefix + key + '.tar', f)
+      except aws.ClientError as e:
+        if aws.errorCode(e) in ('404', 'NoSuchKey'):
+          return None
+        raise
+      return path
+    remote = os.path.join(self.mirror, key + '.tar')
+    if not os.path.exists(remote):
+      return None
+    with open(remote, 'rb') as src, atomicWrite(path, binary=True) as f:
+      shutil.copyfileobj(src, f)
+    return path
+
+  def restore(self, key, funcDir):
+    '''
+      Replaces funcDir's outputs with the archive for key (False on a miss)
+
+      A local hit missing from the mirror is uploaded, so builds cached
+      before the mirror was configured are shared too.
+    '''
+    local = os.path.exists(self.localPath(key))
+    path = self.fetch(key)
+    if not path:
+      return False
+    with tarfile.open(path) as tar:
+      members = tar.getmembers()
+      for member in members:
+        if not isSafeMember(funcDir, member):
+          raise Exception('Unsafe member in {}: {}'.format(path, member.name))
+      for name in set(m.name.split('/')[0] for m in members):
+        target = os.path.join(funcDir, name)
+        if os.path.isdir(target) and not os.path.islink(target):
+          shutil.rmtree(target)
+        elif os.path.lexists(target):
+          os.unlink(target)
+      if hasattr(tarfile, 'data_filter'):
+        tar.extractall(funcDir, filter='data')
+      else:
+        tar.extractall(funcDir)
+    if local and self.mirror and not self.mirrored(key):
+      self.upload(key, path)
+    return True
+
+  def mirrored(self, key):
+    '''
+      True if the mirror has the archive for key
+    '''
+    if self.mirror.startswith('s3://'):
+      from . import aws
+      bucket, prefix = splitS3(self.mirror)
+      try:
+        aws.client('s3').head_object(Bucket=bucket, Key=prefix + key + '.tar')
+      except aws.ClientError as e:
+        if aws.errorCode(e) in ('404', 'NoSuchKey'):
+          return False
+        raise
+      return True
+    return os.path.exists(os.path.join(self.mirror, key + '.tar'))
+
+  def save(self, key, funcDir, patterns=ARTIFACTS):
+    '''
+      Archives funcDir's outputs under key (locally and to the mirror)
+
+      Returns False if there was nothing to save.
+    '''
+    paths = artifactPaths(funcDir, patterns)
+    if not paths:
+      return False
+    path = self.localPath(key)
+    with atomicWrite(path, binary=True) as f:
+      with tarfile.open(fileobj=f, mode='w') as tar:
+        for rel in paths:
+          tar.add(os.path.join(funcDir, rel), arcname=rel, filter=resetInfo)
+    if self.mirror:
+      self.upload(key, path)
+    return True
+
+  def upload(self, key, path):
+    if self.mirror.startswith('s3://'):
+      from . import aws
+      bucket, prefix = splitS3(self.mirror)
+      aws.client('s3').upload_file(path, bucket, prefix + key + '.tar')
+      return
+    os.makedirs(self.mirror, exist_ok=True)
+    with open(path, 'rb') as src, atomicWrite(os.path.join(self.mirror, key + '.tar'), binary=True) as f:
+      shutil.copyfileobj(src, f)
+
+
+def isInside(root, path):
+  root = os.path.realpath(root)
+  return os.path.realpath(path).startswith(root + os.sep)
+
+
+def isSafeMember(funcDir, member):
+  '''
+    True if extracting member writes only inside funcDir: a regular file or
+    directory with a relative path, or a link whose target stays inside
+  '''
+  target = os.path.join(funcDir, member.name)
+  if os.path.isabs(member.name) or not isInside(funcDir, target):
+    return False
+  if member.issym():
+    return isInside(funcDir, os.path.join(os.path.dirname(target), member.linkname))
+  if member.islnk():
+    return isInside(funcDir, os.path.join(funcDir, member.linkname))
+  return member.isfile() or member.isdir()
+
+
+def splitS3(url):
+  '''
+    "s3://bucket/some/prefix" => ("bucket", "some/prefix/")
+  '''
+  bucket, _, prefix = url[len('s3://'):].partition('/')
+  prefix = prefix.strip('/')
+  return bucket, prefix + '/' if prefix else ''
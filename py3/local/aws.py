@@ -0,0 +1,96 @@
+# -*- mode: python3 -*-
+#
+# Shared boto3 session with clients created on first use
+#
+# boto3/botocore take a few hundred ms to import and each client costs more to
+# build, so nothing here is imported or constructed until a command needs it.
+#
+
+import contextvars
+import threading
+from contextlib import contextmanager
+from .cache import getAccount
+
+_lock = threading.RLock()
+_session = None
+_clients = {}
+# Region override for the current context (see useRegion)
+_region = contextvars.ContextVar('region', default=None)
+
+
+def session():
+  '''
+    Returns the process-wide boto3 session
+  '''
+  global _session
+  if _session is None:
+    with _lock:
+      if _session is None:
+        import boto3
+        from . import trace
+        _session = boto3.session.Session()
+        trace.attach(_session)
+  return _session
+
+
+@contextmanager
+def useRegion(region):
+  '''
+    Makes clients created/returned in this context (and in work handed to
+    batch.runAll from it) use region instead of the session default
+  '''
+  token = _region.set(region)
+  try:
+    yield
+  finally:
+    _region.reset(token)
+
+
+def client(service, region=None):
+  '''
+    Returns the shared client for service and region
+
+    Region defaults to the one set by useRegion, then the session's. Clients
+    are thread-safe and keep their own connection pool, so one per
+    service/region is reused for the life of the process.
+  '''
+  key = (service, region or _region.get())
+  c = _clients.get(key)
+  if c is None:
+    with _lock:
+      c = _clients.get(key)
+      if c is None:
+        c = _clients[key] = session().client(service, region_name=key[1])
+  return c
+
+
+def scope(region=None):
+  '''
+    Returns "account:region" (key for cached remote state)
+
+    The account is looked up with STS once per access key and then cached.
+    Raises NoCredentialsError when no credentials are configured.
+  '''
+  creds = session().get_credentials()
+  if creds is None:
+    from botocore.exceptions import NoCredentialsError
+    raise NoCredentialsError()
+  lookup = lambda: client('sts').get_caller_identity()['Account']
+  region = region or _region.get() or session().region_name
+  return '{}:{}'.format(getAccount(creds.access_key, lookup), region)
+
+
+def errorCode(e):
+  '''
+    Returns AWS error code for a botocore ClientError (None for other errors)
+  '''
+  response = getattr(e, 'response', None)
+  return response.get('Error', {}).get('Code') if isinstance(response, dict) else None
+
+
+def __getattr__(name):
+  # Lazy access to botocore exceptions, e.g. "except aws.ClientError"
+  if name in ('ClientError', 'WaiterError'):
+    import botocore.exceptions
+    return getattr(botocore.exceptions, name)
+  raise AttributeError(name)
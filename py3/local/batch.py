@@ -0,0 +1,114 @@
+# -*- mode: python3 -*-
+#
+# Helpers for running many AWS calls at once without tripping API rate limits
+#
+
+import contextvars
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from . import aws
+
+# Outcome of one task (value is whatever the task returned)
+Result = namedtuple('Result', ['key', 'ok', 'error', 'value'])
+
+THROTTLE_CODES = {
+    'ThrottlingException',
+    'Throttling',
+    'TooManyRequestsException',
+    'TooManyUpdates',
+    'RequestLimitExceeded',
+    # Route53: another change to the zone is still being applied
+    'PriorRequestNotComplete',
+}
+
+
+class TokenBucket:
+  '''
+    Token bucket rate limiter
+
+    Allows rate calls per second on average with bursts up to burst calls.
+    Safe to share between threads.
+  '''
+
+  def __init__(self, rate, burst=None):
+    self.rate = float(rate)
+    self.capacity = float(burst or rate)
+    self.tokens = self.capacity
+    self.stamp = time.monotonic()
+    self.lock = threading.Lock()
+
+  def take(self, n=1):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= n:
+          self.tokens -= n
+          return
+        wait = (n - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+def isThrottle(e):
+  return aws.errorCode(e) in THROTTLE_CODES
+
+
+def withRetry(fn, bucket=None, retries=6, base=0.25, cap=20.0):
+  '''
+    Calls fn, retrying with exponential backoff and full jitter while throttled
+
+    Other errors (and the last throttle) are raised.
+  '''
+  attempt = 0
+  while True:
+    if bucket:
+      bucket.take()
+    try:
+      return fn()
+    except aws.ClientError as e:
+      if not isThrottle(e) or attempt >= retries:
+        raise
+    attempt += 1
+    time.sleep(random.uniform(0, min(cap, base * 2**attempt)))
+
+
+def inContext(fn):
+  '''
+    Binds fn to a copy of the caller's context (aws.useRegion etc.) so it can
+    run on a pool thread. Call once per submitted task.
+  '''
+  ctx = contextvars.copy_context()
+  return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+
+def runAll(tasks, workers=8, bucket=None, retries=6):
+  '''
+    Runs (key, fn) tasks on a bounded pool
+
+    Returns a Result per task, in task order. Failures are captured rather
+    than raised so one bad key does not abort the rest.
+  '''
+
+  def run(task):
+    key, fn = task
+    try:
+      return Result(key, True, None, withRetry(fn, bucket, retries))
+    except Exception as e:
+      return Result(key, False, e, None)
+
+  tasks = list(tasks)
+  if not tasks:
+    return []
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    futures = [pool.submit(inContext(run), task) for task in tasks]
+    return [f.result() for f in futures]
+
+
+def chunks(items, size):
+  items = list(items)
+  for i in range(0, len(items), size):
+    yield items[i:i + size]
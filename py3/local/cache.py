@@ -0,0 +1,453 @@
+# -*- mode: python3 -*-
+#
+# On-disk cache of remote AWS state (SQLite under ~/.cache/maketools)
+#
+
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+CACHE_DIR = os.environ.get('MAKETOOLS_CACHE_DIR') or os.path.join(
+    os.path.expanduser('~'), '.cache', 'maketools')
+
+# Prefix snapshots older than this are re-checked against SSM (seconds)
+PARAM_TTL = int(os.environ.get('MAKETOOLS_PARAM_TTL', 300))
+# Stack outputs are re-read from CloudFormation after this (seconds)
+STACK_TTL = int(os.environ.get('MAKETOOLS_STACK_TTL', 60))
+# Route53 hosted zone lookups are trusted this long (seconds)
+ZONE_TTL = int(os.environ.get('MAKETOOLS_ZONE_TTL', 3600))
+# Stack events kept per stack (older ones are dropped)
+MAX_EVENTS = 1000
+# Prefixes unused this long are dropped (seconds)
+MAX_AGE = 7 * 24 * 3600
+# Total cached parameter rows before least recently used prefixes are dropped
+MAX_ROWS = 200000
+
+
+def cacheDir(*parts):
+  '''
+    Returns (creating if needed) a private directory under the cache root
+  '''
+  path = os.path.join(CACHE_DIR, *parts)
+  os.makedirs(path, mode=0o700, exist_ok=True)
+  return path
+
+
+_hashKeys = {}
+_hashLock = threading.Lock()
+
+def hashKey():
+  '''
+    Returns the random per-user key valueHash uses (0600 file under the cache
+    root, created on first use)
+
+    A new key makes every stored hash meaningless, so cached parameter state
+    is dropped when one is created.
+  '''
+  with _hashLock:
+    key = _hashKeys.get(CACHE_DIR)
+    if key is None:
+      path = os.path.join(cacheDir(), 'hash.key')
+      try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+      except FileExistsError:
+        with open(path, 'rb') as f:
+          key = f.read()
+      else:
+        key = os.urandom(32)
+        with os.fdopen(fd, 'wb') as f:
+          f.write(key)
+        with closing(connect()) as db, db:
+          db.execute('DELETE FROM params')
+          db.execute('DELETE FROM prefixes')
+      _hashKeys[CACHE_DIR] = key
+  return key
+
+
+def valueHash(type, value):
+  '''
+    Keyed hash (HMAC-SHA256) of a parameter; the value itself is never
+    stored, and without the key the hash cannot be brute forced
+  '''
+  return hmac.new(hashKey(), '{}\0{}'.format(type, value).encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+SCHEMA = '''
+  CREATE TABLE IF NOT EXISTS identity (
+    accessKey TEXT PRIMARY KEY,
+    account TEXT NOT NULL
+  );
+  CREATE TABLE IF NOT EXISTS prefixes (
+    scope TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    refreshed REAL NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (scope, prefix)
+  );
+  CREATE TABLE IF NOT EXISTS params (
+    scope TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    modified TEXT,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (scope, prefix, name)
+  );
+  CREATE TABLE IF NOT EXISTS stacks (
+    scope TEXT NOT NULL,
+    name TEXT NOT NULL,
+    updated TEXT,
+    outputs TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (scope, name)
+  );
+  CREATE TABLE IF NOT EXISTS zones (
+    scope TEXT NOT NULL,
+    name TEXT NOT NULL,
+    zoneId TEXT NOT NULL,
+    private INTEGER NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (scope, name, zoneId)
+  );
+  CREATE TABLE IF NOT EXISTS zoneScans (
+    scope TEXT PRIMARY KEY,
+    fetched REAL NOT NULL
+  );
+  CREATE TABLE IF NOT EXISTS events (
+    scope TEXT NOT NULL,
+    stack TEXT NOT NULL,
+    eventId TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    stackName TEXT NOT NULL,
+    logicalId TEXT,
+    physicalId TEXT,
+    resourceType TEXT,
+    status TEXT,
+    reason TEXT,
+    PRIMARY KEY (scope, stack, eventId)
+  );
+  CREATE TABLE IF NOT EXISTS deploys (
+    scope TEXT NOT NULL,
+    stack TEXT NOT NULL,
+    stamp TEXT NOT NULL,
+    updated TEXT,
+    PRIMARY KEY (scope, stack)
+  );
+  CREATE TABLE IF NOT EXISTS eventCursors (
+    scope TEXT NOT NULL,
+    stack TEXT NOT NULL,
+    eventId TEXT NOT NULL,
+    PRIMARY KEY (scope, stack)
+  );
+'''
+
+
+def connect(path=None):
+  '''
+    Opens the cache database (one connection per call, so safe across threads)
+  '''
+  if path is None:
+    root = cacheDir()
+    os.chmod(root, 0o700)
+    path = os.path.join(root, 'cache.db')
+    if not os.path.exists(path):
+      os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+    os.chmod(path, 0o600)
+  db = sqlite3.connect(path, timeout=30)
+  db.executescript(SCHEMA)
+  return db
+
+
+def getAccount(accessKey, lookup):
+  '''
+    Returns account id for an access key, calling lookup() only on a miss
+  '''
+  with closing(connect()) as db, db:
+    row = db.execute('SELECT account FROM identity WHERE accessKey=?', (accessKey,)).fetchone()
+    if row:
+      return row[0]
+    account = lookup()
+    db.execute('INSERT OR REPLACE INTO identity VALUES (?, ?)', (accessKey, account))
+    return account
+
+
+class StackCache:
+  '''
+    Cached stack outputs for one account/region, keyed by stack name
+
+    Entries expire after ttl only: updated (LastUpdatedTime) is stored for
+    reference but checking it would cost the DescribeStacks the cache saves.
+    Deploys through stack.py deploy invalidate the stack's entry.
+  '''
+
+  def __init__(self, scope, ttl=STACK_TTL):
+    self.scope = scope
+    self.ttl = ttl
+
+  def get(self, name):
+    '''
+      Returns (outputs, updated) if fetched within ttl, else None
+    '''
+    with closing(connect()) as db:
+      row = db.execute('SELECT outputs, updated, fetched FROM stacks WHERE scope=? AND name=?',
+                       (self.scope, name)).fetchone()
+    if not row or time.time() - row[2] >= self.ttl:
+      return None
+    return json.loads(row[0]), row[1]
+
+  def put(self, name, outputs, updated):
+    self.putMany([(name, outputs, updated)])
+
+  def putMany(self, stacks):
+    '''
+      Stores (name, outputs, updated) tuples in one transaction
+    '''
+    now = time.time()
+    with closing(connect()) as db, db:
+      db.executemany('INSERT OR REPLACE INTO stacks VALUES (?, ?, ?, ?, ?)',
+                     [(self.scope, name, updated, json.dumps(outputs), now)
+                      for name, outputs, updated in stacks])
+
+  def invalidate(self, name):
+    with closing(connect()) as db, db:
+      db.execute('DELETE FROM stacks WHERE scope=? AND name=?', (self.scope, name))
+
+
+class ZoneCache:
+  '''
+    Route53 hosted zones (name => zone ids) for one account
+
+    Holds zones found by name (a row with an empty zoneId records that no
+    zone has that name) and, after a full listing, every zone.
+  '''
+
+  def __init__(self, scope, ttl=ZONE_TTL):
+    self.scope = scope
+    self.ttl = ttl
+
+  def lookup(self, name):
+    '''
+      Returns [(zoneId, private)] for zones named name, [] if known to have
+      none, or None if not known within ttl
+    '''
+    since = time.time() - self.ttl
+    with closing(connect()) as db:
+      rows = db.execute('SELECT zoneId, private FROM zones WHERE scope=? AND name=? AND fetched>?',
+                        (self.scope, name, since)).fetchall()
+      if not rows:
+        scanned = db.execute('SELECT 1 FROM zoneScans WHERE scope=? AND fetched>?',
+                             (self.scope, since)).fetchone()
+        return [] if scanned else None
+    return [(zoneId, bool(private)) for zoneId, private in rows if zoneId]
+
+  def put(self, name, zones):
+    '''
+      Stores [(zoneId, private)] found for name (may be empty)
+    '''
+    now = time.time()
+    with closing(connect()) as db, db:
+      db.execute('DELETE FROM zones WHERE scope=? AND name=?', (self.scope, name))
+      db.executemany('INSERT INTO zones VALUES (?, ?, ?, ?, ?)',
+                     [(self.scope, name, zoneId, int(private), now) for zoneId, private in zones or [('', False)]])
+
+  def putAll(self, zones):
+    '''
+      Replaces the index with [(name, zoneId, private)] from a full listing
+    '''
+    now = time.time()
+    with closing(connect()) as db, db:
+      db.execute('DELETE FROM zones WHERE scope=?', (self.scope,))
+      db.executemany('INSERT OR REPLACE INTO zones VALUES (?, ?, ?, ?, ?)',
+                     [(self.scope, name, zoneId, int(private), now) for name, zoneId, private in zones])
+      db.execute('INSERT OR REPLACE INTO zoneScans VALUES (?, ?)', (self.scope, now))
+
+  def invalidate(self):
+    with closing(connect()) as db, db:
+      db.execute('DELETE FROM zones WHERE scope=?', (self.scope,))
+      db.execute('DELETE FROM zoneScans WHERE scope=?', (self.scope,))
+
+
+class DeployCache:
+  '''
+    Hash of what was last deployed to each stack (template, parameters,
+    capabilities) and the stack's LastUpdatedTime after that deploy
+  '''
+
+  def __init__(self, scope):
+    self.scope = scope
+
+  def isCurrent(self, stack, stamp, updated):
+    with closing(connect()) as db:
+      row = db.execute('SELECT stamp, updated FROM deploys WHERE scope=? AND stack=?',
+                       (self.scope, stack)).fetchone()
+    return row is not None and row[0] == stamp and row[1] == updated
+
+  def put(self, stack, stamp, updated):
+    with closing(connect()) as db, db:
+      db.execute('INSERT OR REPLACE INTO deploys VALUES (?, ?, ?, ?)', (self.scope, stack, stamp, updated))
+
+
+EVENT_FIELDS = ['eventId', 'timestamp', 'stackName', 'logicalId', 'physicalId',
+                'resourceType', 'status', 'reason']
+
+
+class EventCache:
+  '''
+    Stack events seen so far (per account/region and stack) and the id of
+    the newest one (the cursor reads stop at)
+  '''
+
+  def __init__(self, scope, maxEvents=MAX_EVENTS):
+    self.scope = scope
+    self.maxEvents = maxEvents
+
+  def cursor(self, stack):
+    with closing(connect()) as db:
+      row = db.execute('SELECT eventId FROM eventCursors WHERE scope=? AND stack=?',
+                       (self.scope, stack)).fetchone()
+    return row[0] if row else None
+
+  def setCursor(self, stack, eventId):
+    with closing(connect()) as db, db:
+      db.execute('INSERT OR REPLACE INTO eventCursors VALUES (?, ?, ?)', (self.scope, stack, eventId))
+
+  def add(self, stack, events):
+    '''
+      Stores events (dicts with EVENT_FIELDS, newest first)
+
+      The cursor is left alone: callers move it with setCursor once the
+      events have been shown.
+    '''
+    if not events:
+      return
+    with closing(connect()) as db, db:
+      db.executemany('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     [(self.scope, stack) + tuple(e[f] for f in EVENT_FIELDS) for e in reversed(events)])
+      db.execute('''
+        DELETE FROM events WHERE scope=? AND stack=? AND eventId NOT IN (
+          SELECT eventId FROM events WHERE scope=? AND stack=?
+          ORDER BY timestamp DESC LIMIT ?)''', (self.scope, stack, self.scope, stack, self.maxEvents))
+
+  def rows(self, stack, failedOnly=False, limit=None):
+    '''
+      Returns stored events for stack (oldest first, at most limit newest)
+    '''
+    sql = 'SELECT {} FROM events WHERE scope=? AND stack=?'.format(', '.join(EVENT_FIELDS))
+    if failedOnly:
+      sql += " AND status LIKE '%FAILED%'"
+    sql += ' ORDER BY timestamp DESC, rowid DESC LIMIT ?'
+    with closing(connect()) as db:
+      cur = db.execute(sql, (self.scope, stack, -1 if limit is None else limit))
+      rows = [dict(zip(EVENT_FIELDS, r)) for r in cur]
+    return rows[::-1]
+
+
+class ParamCache:
+  '''
+    Cached SSM state (name => type, version, modified, hash) for one
+    account/region/prefix
+  '''
+
+  def __init__(self, scope, prefix, ttl=PARAM_TTL):
+    self.scope = scope
+    self.prefix = prefix
+    self.ttl = ttl
+
+  def age(self):
+    '''
+      Seconds since the prefix was last checked against SSM (None if never)
+    '''
+    with closing(connect()) as db:
+      row = db.execute('SELECT refreshed FROM prefixes WHERE scope=? AND prefix=?',
+                       (self.scope, self.prefix)).fetchone()
+    return time.time() - row[0] if row else None
+
+  def isFresh(self):
+    age = self.age()
+    return age is not None and age < self.ttl
+
+  def rows(self):
+    '''
+      Returns {name: (type, version, modified, hash)}
+    '''
+    with closing(connect()) as db, db:
+      db.execute('UPDATE prefixes SET used=? WHERE scope=? AND prefix=?',
+                 (time.time(), self.scope, self.prefix))
+      cur = db.execute(
+          'SELECT name, type, version, modified, hash FROM params WHERE scope=? AND prefix=?',
+          (self.scope, self.prefix))
+      return {r[0]: tuple(r[1:]) for r in cur}
+
+  def update(self, rows, deleted=(), replace=False, refreshed=True):
+    '''
+      Stores {name: (type, version, modified, hash)} and drops deleted names
+
+      With replace everything else under the prefix is dropped first. With
+      refreshed the prefix is marked as just checked against SSM.
+    '''
+    now = time.time()
+    with closing(connect()) as db, db:
+      if replace:
+        db.execute('DELETE FROM params WHERE scope=? AND prefix=?', (self.scope, self.prefix))
+      db.executemany('DELETE FROM params WHERE scope=? AND prefix=? AND name=?',
+                     [(self.scope, self.prefix, name) for name in deleted])
+      db.executemany('INSERT OR REPLACE INTO params VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     [(self.scope, self.prefix, name) + tuple(row) for name, row in rows.items()])
+      if refreshed:
+        db.execute('INSERT OR REPLACE INTO prefixes VALUES (?, ?, ?, ?)',
+                   (self.scope, self.prefix, now, now))
+      evict(db, now)
+
+  def clear(self):
+    with closing(connect()) as db, db:
+      db.execute('DELETE FROM params WHERE scope=? AND prefix=?', (self.scope, self.prefix))
+      db.execute('DELETE FROM prefixes WHERE scope=? AND prefix=?', (self.scope, self.prefix))
+
+
+def isUnder(name, prefix):
+  prefix = prefix.rstrip('/')
+  return not prefix or name == prefix or name.startswith(prefix + '/')
+
+
+def invalidatePrefixes(scope, names, keep=None):
+  '''
+    Drops cached prefixes (other than keep) holding any of names, so parent
+    and child prefixes of a write are re-read instead of trusted
+  '''
+  names = list(names)
+  if not names:
+    return
+  with closing(connect()) as db, db:
+    prefixes = [r[0] for r in db.execute('SELECT prefix FROM prefixes WHERE scope=?', (scope,))]
+    for prefix in prefixes:
+      if prefix != keep and any(isUnder(name, prefix) for name in names):
+        db.execute('DELETE FROM params WHERE scope=? AND prefix=?', (scope, prefix))
+        db.execute('DELETE FROM prefixes WHERE scope=? AND prefix=?', (scope, prefix))
+
+
+def evict(db, now, maxAge=MAX_AGE, maxRows=MAX_ROWS):
+  '''
+    Drops prefixes unused for maxAge, then least recently used prefixes until
+    at most maxRows parameters remain
+  '''
+  stale = db.execute('SELECT scope, prefix FROM prefixes WHERE used < ?', (now - maxAge,)).fetchall()
+  total = db.execute('SELECT COUNT(*) FROM params').fetchone()[0]
+  if total > maxRows:
+    cur = db.execute('''
+      SELECT p.scope, p.prefix, COUNT(*) FROM prefixes p
+      JOIN params r ON r.scope = p.scope AND r.prefix = p.prefix
+      GROUP BY p.scope, p.prefix ORDER BY p.used''')
+    for scope, prefix, count in cur.fetchall():
+      if total <= maxRows:
+        break
+      stale.append((scope, prefix))
+      total -= count
+  for scope, prefix in stale:
+    db.execute('DELETE FROM params WHERE scope=? AND prefix=?', (scope, prefix))
+    db.execute('DELETE FROM prefixes WHERE scope=? AND prefix=?', (scope, prefix))
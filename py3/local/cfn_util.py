@@ -1,7 +1,6 @@
 
 # -*- mode: python3 -*-
 #
-import boto3
 import click
 import string
 import yaml
@@ -9,29 +8,223 @@ from enum import Enum
 import pathlib
 import os
 import io
+import json
+import hashlib
+import random
+import threading
+import time
+from datetime import timezone
+from fnmatch import fnmatchcase
+from functools import partial
+from .utils import parseYaml, atomicWrite, decodeStream, replaceStream
+from .cache import StackCache, STACK_TTL, ZoneCache, ZONE_TTL, EventCache, MAX_EVENTS, cacheDir
+from .batch import runAll
+from .params import putParams, delParams
+from .trace import phase
+from . import aws
+
+def outputDict(stack):
+  return {out['OutputKey']: out['OutputValue'] for out in stack.get('Outputs') or []}
+
+def stackUpdated(stack):
+  updated = stack.get('LastUpdatedTime') or stack.get('CreationTime')
+  return updated and str(updated)
+
+def getStackOutputDict(stackName, ttl=STACK_TTL, verbose=True):
+  '''
+    Returns stack outputs as a dict
 
-cognitoClient = boto3.client('cognito-idp')
-cloudformation = boto3.resource('cloudformation')
-ssmClient = boto3.client('ssm')
-route53client = boto3.client('route53')
-
-def getStackOutputDict(stackName):
-  print('Getting stack output for {}...'.format(stackName))
-  stack = cloudformation.Stack(stackName)
-  d = {}
-  for out in stack.outputs or []:
-    key = out['OutputKey']
-    d[key] = out['OutputValue']
+    Outputs are cached (per account/region) for ttl seconds so repeated calls
+    from make share one DescribeStacks per stack.
+  '''
+  cache = StackCache(aws.scope(), ttl)
+  hit = cache.get(stackName)
+  if hit:
+    return hit[0]
+  if verbose:
+    print('Getting stack output for {}...'.format(stackName))
+  res = aws.client('cloudformation').describe_stacks(StackName=stackName)
+  stack = res['Stacks'][0]
+  d = outputDict(stack)
+  cache.put(stackName, d, stackUpdated(stack))
   return d
 
+ACTIVE_STATUSES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE']
+
+def iterStacks(match=None, statuses=None):
+  '''
+    Yields describe_stacks entries (with outputs) page by page
+
+    match is a glob on the stack name. A plain name is passed to
+    DescribeStacks so only that stack is fetched; otherwise all pages are read
+    once and filtered here (DescribeStacks has no status or name filter).
+    Outputs of every stack seen are stored in the output cache.
+  '''
+  cf = aws.client('cloudformation')
+  cache = StackCache(aws.scope())
+  if match and not any(c in match for c in '*?['):
+    pages = [cf.describe_stacks(StackName=match)]
+  else:
+    pages = cf.get_paginator('describe_stacks').paginate()
+  for page in pages:
+    stacks = [s for s in page['Stacks']
+              if (not match or fnmatchcase(s['StackName'], match)) and
+              (not statuses or s['StackStatus'] in statuses)]
+    cache.putMany([(s['StackName'], outputDict(s), stackUpdated(s)) for s in stacks])
+    yield from stacks
+
 def getStackNames():
-  return [(s.stack_name, s.stack_status) for s in cloudformation.stacks.all()]
+  return [(s['StackName'], s['StackStatus']) for s in iterStacks()]
+
+NESTED_STACK_TYPE = 'AWS::CloudFormation::Stack'
+
+def eventRow(e):
+  return {
+      'eventId': e['EventId'],
+      'timestamp': e['Timestamp'].astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+      'stackName': e['StackName'],
+      'logicalId': e.get('LogicalResourceId'),
+      'physicalId': e.get('PhysicalResourceId'),
+      'resourceType': e.get('ResourceType'),
+      'status': e.get('ResourceStatus'),
+      'reason': e.get('ResourceStatusReason'),
+  }
+
+def fetchNewEvents(stack, cursor, limit=MAX_EVENTS):
+  '''
+    Returns events newer than cursor (newest first)
+
+    Pages are read only until the cursor is reached, or limit events when
+    there is no cursor yet.
+  '''
+  events = []
+  pages = aws.client('cloudformation').get_paginator('describe_stack_events').paginate(StackName=stack)
+  for page in pages:
+    for e in page['StackEvents']:
+      if e['EventId'] == cursor or len(events) >= limit:
+        return events
+      events.append(eventRow(e))
+  return events
+
+def isStackEvent(row):
+  # Event for the stack itself (not one of its resources)
+  return row['resourceType'] == NESTED_STACK_TYPE and row['logicalId'] == row['stackName']
+
+class EventFollower:
+  '''
+    Reads new events for a stack (and its nested stacks) incrementally
+
+    Events and a cursor per stack are kept in the cache so each poll reads
+    only the pages newer than the last event seen. Cursors move only on
+    commit(), called once polled events have been shown, so an interrupted
+    follower reads them again rather than losing them.
+  '''
+
+  def __init__(self, stackName, nested=True, workers=8):
+    self.root = stackName
+    self.nested = nested
+    self.workers = workers
+    self.cache = EventCache(aws.scope())
+    self.stacks = [stackName]
+    # Newest event id per stack polled since the last commit
+    self.pending = {}
+    self.discover(stackName, self.cache.rows(stackName))
+
+  def discover(self, stack, rows):
+    '''
+      Adds nested stacks (by id) created by stack's resources
+    '''
+    if not self.nested:
+      return []
+    found = [r['physicalId'] for r in rows
+             if r['resourceType'] == NESTED_STACK_TYPE and not isStackEvent(r) and r['physicalId']]
+    found = [s for s in dict.fromkeys(found) if s not in self.stacks]
+    for s in found:
+      self.stacks.append(s)
+      self.discover(s, self.cache.rows(s))
+    return found
+
+  def pollStack(self, stack):
+    cursor = self.pending.get(stack) or self.cache.cursor(stack)
+    events = fetchNewEvents(stack, cursor)
+    self.cache.add(stack, events)
+    return events
+
+  def poll(self):
+    '''
+      Returns new events of all stacks, oldest first (nested stacks are read
+      concurrently, including ones first seen in this poll)
+    '''
+    new = []
+    todo = list(self.stacks)
+    while todo:
+      results = runAll([(s, partial(self.pollStack, s)) for s in todo], self.workers)
+      todo = []
+      for r in results:
+        if not r.ok:
+          raise r.error
+        new.extend(r.value)
+        if r.value:
+          self.pending[r.key] = r.value[0]['eventId']
+        todo.extend(self.discover(r.key, r.value))
+    return sorted(new, key=lambda e: e['timestamp'])
+
+  def commit(self):
+    '''
+      Moves the stored cursors past everything polled so far
+    '''
+    for stack, eventId in self.pending.items():
+      self.cache.setCursor(stack, eventId)
+    self.pending = {}
+
+  def history(self, failedOnly=False, limit=None):
+    rows = []
+    for s in self.stacks:
+      rows.extend(self.cache.rows(s, failedOnly, limit))
+    rows.sort(key=lambda e: e['timestamp'])
+    return rows[-limit:] if limit else rows
+
+  def status(self):
+    '''
+      Returns the root stack's latest status (from stored events)
+    '''
+    rows = self.cache.rows(self.root, limit=50)
+    return next((r['status'] for r in reversed(rows) if isStackEvent(r)), None)
+
+def isFailedStatus(status):
+  return bool(status) and ('FAILED' in status or 'ROLLBACK' in status)
+
+def followEvents(follower, onEvent, untilDone=False, started=False, fast=2.0, slow=30.0):
+  '''
+    Polls follower, calling onEvent for each new event
+
+    Polls every fast seconds while the stack is IN_PROGRESS, backing off to
+    slow when idle. With untilDone returns the final status once the stack
+    leaves IN_PROGRESS (after it was seen in progress, or at once if started).
+  '''
+  delay = fast
+  while True:
+    for e in follower.poll():
+      # A short update can start and finish between two polls
+      if isStackEvent(e) and e['status'].endswith('IN_PROGRESS'):
+        started = True
+      onEvent(e)
+    follower.commit()
+    status = follower.status()
+    if status and status.endswith('IN_PROGRESS'):
+      started = True
+      delay = fast
+    else:
+      if untilDone and started:
+        return status
+      delay = min(slow, delay * 1.5)
+    time.sleep(delay)
 
 def toYaml(ob):
   return yaml.safe_dump(ob, default_flow_style=False)
 
 def fromYaml(text):
-  return yaml.load(text, Loader=yaml.FullLoader)
+  return parseYaml(text)
 
 def ensureSuffix(name, s = '.yaml'):
   p = pathlib.Path(name)
@@ -39,25 +232,141 @@ def ensureSuffix(name, s = '.yaml'):
     p = p.with_suffix(s)
   return p
 
-def getApiClientInfo(poolArnOrId, clientId):
-    userPoolId = poolArnOrId.split('/')[-1]
-    res = cognitoClient.describe_user_pool_client(
-        ClientId=clientId, UserPoolId=userPoolId)
-    info = res['UserPoolClient']
-    return {
-        'name': info['ClientName'],
-        'id': info['ClientId'],
-        'secret': info['ClientSecret']
-    }
+# Seconds Cognito client/domain descriptions are reused for
+COGNITO_TTL = int(os.environ.get('MAKETOOLS_COGNITO_TTL', 300))
+
+# In-process memo: (scope, pool id) => (fetched, {client id: info}) holding
+# complete listings only, (scope, pool id, client id) => (fetched, info) for
+# single clients and (scope, domain) => (fetched, info)
+_poolMemo = {}
+_clientMemo = {}
+_domainMemo = {}
+_memoLock = threading.Lock()
+
+def poolId(poolArnOrId):
+  return poolArnOrId.split('/')[-1]
+
+def clientInfo(client):
+  return {
+      'name': client['ClientName'],
+      'id': client['ClientId'],
+      'secret': client.get('ClientSecret')
+  }
 
-def getAuthDomainInfo(domain):
-    res = cognitoClient.describe_user_pool_domain(Domain=domain)
-    info = res['DomainDescription']
-    dist = info['CloudFrontDistribution']
-    status = info['Status']
-    return {'name': domain, 'dist': dist, 'status': status}
+def poolMemoPath(scope, userPoolId):
+  key = hashlib.sha256('{}\0{}'.format(scope, userPoolId).encode('utf-8')).hexdigest()
+  return os.path.join(cacheDir('cognito'), key + '.json')
 
+def readPoolMemo(scope, userPoolId, ttl, disk):
+  '''
+    Returns {client id: info} remembered for the pool within ttl (or None)
+  '''
+  with _memoLock:
+    hit = _poolMemo.get((scope, userPoolId))
+  if not hit and disk:
+    try:
+      with open(poolMemoPath(scope, userPoolId)) as f:
+        ob = json.load(f)
+      hit = (ob['fetched'], ob['clients'])
+    except (OSError, ValueError, KeyError):
+      hit = None
+    if hit:
+      with _memoLock:
+        _poolMemo.setdefault((scope, userPoolId), hit)
+  if hit and time.time() - hit[0] < ttl:
+    return hit[1]
+  return None
+
+def writePoolMemo(scope, userPoolId, clients, disk):
+  '''
+    Remembers clients (all of the pool's clients)
+  '''
+  now = time.time()
+  with _memoLock:
+    _poolMemo[(scope, userPoolId)] = (now, clients)
+  if disk:
+    # Holds client secrets, so private to the user
+    with atomicWrite(poolMemoPath(scope, userPoolId), mode=0o600) as f:
+      json.dump({'fetched': now, 'clients': clients}, f)
+
+def describeClient(userPoolId, clientId):
+  res = aws.client('cognito-idp').describe_user_pool_client(
+      ClientId=clientId, UserPoolId=userPoolId)
+  return clientInfo(res['UserPoolClient'])
+
+def iterPoolClients(poolArnOrId):
+  '''
+    Yields (client id, name) for every app client in the pool, page by page
+  '''
+  pages = aws.client('cognito-idp').get_paginator('list_user_pool_clients').paginate(
+      UserPoolId=poolId(poolArnOrId), PaginationConfig={'PageSize': 60})
+  for page in pages:
+    for client in page['UserPoolClients']:
+      yield client['ClientId'], client['ClientName']
 
+def getPoolClients(poolArnOrId, workers=8, ttl=COGNITO_TTL, disk=False):
+  '''
+    Returns {client id: info} for every app client in the pool
+
+    Lists clients once, then describes them concurrently (retried when
+    throttled). The result is remembered for ttl seconds in-process and, with
+    disk, in a private file under the cache dir.
+  '''
+  userPoolId = poolId(poolArnOrId)
+  scope = aws.scope()
+  clients = readPoolMemo(scope, userPoolId, ttl, disk)
+  if clients is not None:
+    return clients
+  tasks = [(cid, partial(describeClient, userPoolId, cid)) for cid, name in iterPoolClients(userPoolId)]
+  clients = {}
+  for r in runAll(tasks, workers):
+    if not r.ok:
+      raise r.error
+    clients[r.key] = r.value
+  writePoolMemo(scope, userPoolId, clients, disk)
+  return clients
+
+def getApiClientInfo(poolArnOrId, clientId, ttl=COGNITO_TTL):
+  '''
+    Returns {name, id, secret} for one app client (memoized)
+
+    Uses the pool's listing when one is remembered. Single clients are kept
+    apart from it, so they never pass for the pool's complete client list.
+  '''
+  userPoolId = poolId(poolArnOrId)
+  scope = aws.scope()
+  clients = readPoolMemo(scope, userPoolId, ttl, False) or {}
+  if clientId in clients:
+    return clients[clientId]
+  key = (scope, userPoolId, clientId)
+  with _memoLock:
+    hit = _clientMemo.get(key)
+  if hit and time.time() - hit[0] < ttl:
+    return hit[1]
+  info = describeClient(userPoolId, clientId)
+  with _memoLock:
+    _clientMemo[key] = (time.time(), info)
+  return info
+
+def getAuthDomainInfo(domain, ttl=COGNITO_TTL):
+  key = (aws.scope(), domain)
+  with _memoLock:
+    hit = _domainMemo.get(key)
+  if hit and time.time() - hit[0] < ttl:
+    return hit[1]
+  res = aws.client('cognito-idp').describe_user_pool_domain(Domain=domain)
+  info = res['DomainDescription']
+  dist = info['CloudFrontDistribution']
+  status = info['Status']
+  info = {'name': domain, 'dist': dist, 'status': status}
+  with _memoLock:
+    _domainMemo[key] = (time.time(), info)
+  return info
+
+
+
+# Read size for API Gateway export bodies
+CHUNK_SIZE = 1 << 20
 
 Extension = Enum('Extension', 'postman aws none')
 ExtensionVals = [a.name for a in Extension]
@@ -74,13 +383,71 @@ def fixupSwagger(fileName):
   #
   # sed -i '' 's/\/{basePath}/{basePath}/g' ./$OUT_FILE
   '''
-  with open(fileName) as f:
-    data = f.read()
-  with open(fileName, 'w') as f:
-    f.write(data.replace("/{basePath}", "{basePath}"))
+  with open(fileName, 'rb') as src:
+    writeSwagger(iter(lambda: src.read(CHUNK_SIZE), b''), fileName)
+
+
+@phase('export write')
+def writeSwagger(chunks, outPath):
+  '''
+    Streams swagger byte chunks to outPath (atomically) applying fixupSwagger
+  '''
+  with atomicWrite(outPath) as f:
+    for text in replaceStream(decodeStream(chunks), "/{basePath}", "{basePath}"):
+      f.write(text)
+
+
+def getStage(apiId, apiStage):
+  return aws.client('apigateway').get_stage(restApiId=apiId, stageName=apiStage)
+
+
+def getStageStamp(apiId, apiStage, stage=None, **extra):
+  '''
+    Identifies what a stage export was taken from (changes on redeploy)
+
+    stage is a get_stage response to reuse (read here if not given).
+  '''
+  stage = stage or getStage(apiId, apiStage)
+  stamp = {
+      'restApiId': apiId,
+      'stageName': apiStage,
+      'deploymentId': stage.get('deploymentId'),
+      'lastUpdatedDate': str(stage.get('lastUpdatedDate')),
+  }
+  stamp.update(extra)
+  return stamp
 
 
-def exportSwagger(stackName, apiId, apiStage, directory, extension=Extension.none):
+def manifestPath(outPath):
+  # foo/orders-api.yaml => foo/.orders-api.yaml.stage.json
+  head, tail = os.path.split(outPath)
+  return os.path.join(head, '.{}.stage.json'.format(tail))
+
+
+def isExportCurrent(outPath, stamp):
+  '''
+    True if outPath exists and was exported from the same stage deployment
+  '''
+  try:
+    with open(manifestPath(outPath)) as f:
+      return os.path.exists(outPath) and json.load(f) == stamp
+  except (OSError, ValueError):
+    return False
+
+
+def writeManifest(outPath, stamp):
+  with atomicWrite(manifestPath(outPath)) as f:
+    json.dump(stamp, f, indent=2, sort_keys=True)
+
+
+def exportSwagger(stackName, apiId, apiStage, directory, extension=Extension.none, force=False, stage=None):
+  '''
+    Saves swagger for the stage, skipping the download (and leaving the file
+    untouched) if the stage has not been redeployed since the last export
+
+    stage is a get_stage response shared by several exports. Returns True
+    if the file was written.
+  '''
 
   fileType='yaml'
 
@@ -104,54 +471,74 @@ def exportSwagger(stackName, apiId, apiStage, directory, extension=Extension.non
   else:
     suffix = ''
 
-  client = boto3.client('apigateway')
-  response = client.get_export(parameters=params, **args)
-
   #  stackName-api.yaml
   #  stackName-api-aws.yaml
   #  stackName-api-postman.yaml
   outName = '{}-api{}.{}'.format(stackName, suffix, fileType)
   outPath = os.path.join(directory, outName)
+
+  stamp = getStageStamp(apiId, apiStage, stage, exportType=args['exportType'], parameters=params)
+  if not force and isExportCurrent(outPath, stamp):
+    print('Up to date: {}'.format(outPath))
+    return False
+
+  client = aws.client('apigateway')
+  response = client.get_export(parameters=params, **args)
+
   print('Saving swagger: {}'.format(outPath))
-  with open(outPath, 'wt') as f:
-    body = response['body']
-    for chunk in body:
-      f.write(chunk.decode('utf-8'))
+  writeSwagger(response['body'].iter_chunks(CHUNK_SIZE), outPath)
+  writeManifest(outPath, stamp)
+  return True
 
-  fixupSwagger(outPath)
+def exportSdk(stackName, apiId, apiStage, directory, force=False, type='javascript', params=None, stage=None):
+  '''
+    Saves sdk zip for the stage (skipped like exportSwagger when unchanged)
 
-def exportSdk(stackName, apiId, apiStage, directory):
-  type='javascript'
+    params are sdk generator settings (required for types other than
+    javascript, e.g. groupId/artifactId for android). Returns True if the
+    file was written.
+  '''
   args = {}
   args['restApiId'] = apiId
   args['stageName'] = apiStage
   args['sdkType'] = type
-
-  client = boto3.client('apigateway')
-  response = client.get_sdk(**args)
+  args['parameters'] = params or {}
 
   outName = '{}-client-{}-{}.zip'.format(stackName, type, apiStage)
   outPath = os.path.join(directory, outName)
+
+  stamp = getStageStamp(apiId, apiStage, stage, sdkType=type, parameters=args['parameters'])
+  if not force and isExportCurrent(outPath, stamp):
+    print('Up to date: {}'.format(outPath))
+    return False
+
+  client = aws.client('apigateway')
+  response = client.get_sdk(**args)
+
   print('Saving sdk client zip: {}'.format(outPath))
-  with open(outPath, 'wb') as f:
-    body = response['body']
-    for chunk in body:
+  with phase('export write'), atomicWrite(outPath, binary=True) as f:
+    for chunk in response['body'].iter_chunks(CHUNK_SIZE):
       f.write(chunk)
+  writeManifest(outPath, stamp)
+  return True
 
 
+def ssmName(userInfo, base='/api/clientcreds'):
+  return '{}/{}'.format(base, userInfo['name'])
+
 def putSsm(userInfo, enablePrompts=True, base='/api/clientcreds'):
   '''
     Saves api client info (from getApiClientInfo) to SSM
 
     Used for test apps that act as client hitting services.
   '''
-  name = '{}/{}'.format(base, userInfo['name'])
+  name = ssmName(userInfo, base)
   clientId = userInfo['id']
   secret = userInfo['secret']
   value = "{}:{}".format(clientId, secret)
   print("Setting SSM secret for {}".format(name))
   if not enablePrompts or click.confirm('Continue?', default=False):
-    ssmClient.put_parameter(
+    aws.client('ssm').put_parameter(
         Name=name,
         Description="Client ID and secret for {}".format(name),
         Value=value,
@@ -160,90 +547,222 @@ def putSsm(userInfo, enablePrompts=True, base='/api/clientcreds'):
 
 
 def deleteSsm(userInfo, enablePrompts=True, base='/api/clientcreds'):
-  name = '{}/{}'.format(base, userInfo['name'])
+  name = ssmName(userInfo, base)
   print(("Removing SSM secret for {}".format(name)))
   if not enablePrompts or click.confirm('Continue?', default=False):
-    ssmClient.delete_parameter(Name=name)
+    aws.client('ssm').delete_parameter(Name=name)
 
 
+def syncSsm(infos, enablePrompts=True, base='/api/clientcreds', remove=False, workers=8):
+  '''
+    Saves (or with remove deletes) many clients' SSM entries concurrently
 
-def getApexDomain(domain):
+    Clients without a secret are skipped. Returns a Result per SSM name.
   '''
-    Returns something like "nod15c.com."
+  infos = [i for i in infos if i['secret']]
+  for info in infos:
+    print("{} SSM secret for {}".format('Removing' if remove else 'Setting', ssmName(info, base)))
+  if not infos or (enablePrompts and not click.confirm('Continue?', default=False)):
+    return []
+  if remove:
+    return delParams([ssmName(i, base) for i in infos], workers)
+  return putParams([(ssmName(i, base), '{}:{}'.format(i['id'], i['secret']), 'SecureString')
+                    for i in infos], workers)
+
+
+
+def zoneName(domain):
+  '''
+    "Foo.nod15c.com" => "foo.nod15c.com." (form Route53 uses for zone names)
   '''
-  # Handle "foo.nod15c.com" and "foo.nod15c.com."
-  parts = [p for p in domain.split('.') if p]
-  return '.'.join(parts[-2:]) + '.'
+  return '.'.join(p for p in domain.lower().split('.') if p) + '.'
 
+def zoneSuffixes(domain):
+  '''
+    "a.b.co.uk." => ["a.b.co.uk.", "b.co.uk.", "co.uk.", "uk."] (longest first)
+  '''
+  labels = zoneName(domain).split('.')[:-1]
+  return ['.'.join(labels[i:]) + '.' for i in range(len(labels))]
+
+def zoneInfo(name, zoneId, private=False):
+  # zoneId is like /hostedzone/Z2X325LEDJ47O
+  return {
+      'domain': name,
+      'zoneId': zoneId[zoneId.rfind('/') + 1:],
+      'zoneIdFullyQualified': zoneId,
+      'private': private
+  }
 
-def getHostedZoneInfo(name="nod15c.com."):
-  # Assumes relatively small number
-  res = route53client.list_hosted_zones()
-  if res['IsTruncated']:
-    raise Exception("FixMe")
-  zones = res['HostedZones']
-  try:
-    info = next(zone for zone in zones if zone['Name'] == name)
-    # print info
-    id = info['Id']
-    # /hostedzone/Z2X325LEDJ47O
-    idShort = id[id.rfind('/') + 1:]
-    return {'domain': name, 'zoneId': idShort, 'zoneIdFullyQualified': id}
-  except:
-    raise Exception("Not found: {}".format(name))
+def findZonesByName(name):
+  '''
+    Returns [(zoneId, private)] for zones named name (one ListHostedZonesByName
+    call: zones are sorted by name, so any match comes first)
+  '''
+  res = aws.client('route53').list_hosted_zones_by_name(DNSName=name, MaxItems='10')
+  return [(z['Id'], z['Config'].get('PrivateZone', False))
+          for z in res['HostedZones'] if z['Name'] == name]
 
+def indexHostedZones(cache):
+  '''
+    Lists every hosted zone (paginated) into cache
+  '''
+  pages = aws.client('route53').get_paginator('list_hosted_zones').paginate()
+  cache.putAll([(z['Name'], z['Id'], z['Config'].get('PrivateZone', False))
+                for page in pages for z in page['HostedZones']])
 
-def modifyUserPoolDomainRoute53AliasEntry(domainInfo, update=True, enablePrompts=True):
+def getHostedZoneInfo(domain="nod15c.com.", private=False, ttl=ZONE_TTL):
   '''
-    Adds or removes route53 alias given domain info from getAuthDomainInfo()
+    Returns the hosted zone that holds records for domain (longest matching
+    suffix, so "a.example.co.uk" finds "example.co.uk." and nested zones win)
+
+    Each suffix is looked up in the zone cache, else fetched by name and
+    cached (hits and misses) for ttl seconds. If by-name lookups are not
+    allowed all zones are listed into the cache instead.
+  '''
+  cache = ZoneCache(aws.scope(), ttl)
+  for name in zoneSuffixes(domain):
+    zones = cache.lookup(name)
+    if zones is None:
+      try:
+        zones = findZonesByName(name)
+        cache.put(name, zones)
+      except aws.ClientError as e:
+        if aws.errorCode(e) != 'AccessDenied':
+          raise
+        indexHostedZones(cache)
+        zones = cache.lookup(name)
+    match = next((zoneId for zoneId, isPrivate in zones if isPrivate == private), None)
+    if match:
+      return zoneInfo(name, match, private)
+  raise Exception("Not found: {}".format(domain))
+
+def getApexDomain(domain):
   '''
-  domain = domainInfo['name']
-  apex = getApexDomain(domain)
-  info = getHostedZoneInfo(apex)
+    Returns name of the hosted zone holding domain, e.g. "nod15c.com."
+  '''
+  return getHostedZoneInfo(domain)['domain']
 
-  # Well-known zone id for cloudfront
-  cfZoneId = 'Z2FDTNDATAQYW2'
 
-  zoneId = info['zoneId']
-  alias = domainInfo['dist']
+# Well-known zone id for cloudfront
+CLOUDFRONT_ZONE_ID = 'Z2FDTNDATAQYW2'
 
-  if update:
-    action = 'UPSERT'
-    comment = "Create alias for user pool domain"
-  else:
-    action = 'DELETE'
-    comment = "Remove alias for user pool domain"
-
-  batch = {
-      "Comment":
-          comment,
-      "Changes": [{
-          "Action": action,
-          "ResourceRecordSet": {
-              "Name": domain,
-              "Type": "A",
-              "AliasTarget": {
-                  "HostedZoneId": cfZoneId,
-                  "DNSName": alias,
-                  "EvaluateTargetHealth": False
-              }
+# ChangeResourceRecordSets limits on records and value characters (UPSERTs
+# count twice)
+MAX_BATCH_CHANGES = 1000
+MAX_BATCH_CHARS = 32000
+
+def aliasChange(domainInfo, update=True):
+  '''
+    UPSERT (or DELETE) of the A record alias for a domain from getAuthDomainInfo()
+  '''
+  return {
+      "Action": 'UPSERT' if update else 'DELETE',
+      "ResourceRecordSet": {
+          "Name": domainInfo['name'],
+          "Type": "A",
+          "AliasTarget": {
+              "HostedZoneId": CLOUDFRONT_ZONE_ID,
+              "DNSName": domainInfo['dist'],
+              "EvaluateTargetHealth": False
           }
-      }]
+      }
   }
 
-  res=None
-  if update:
-    print(("Create A record Alias: {} ({}) => {}".format(domain, zoneId, alias)))
-    if not enablePrompts or click.confirm('Continue?', default=False):
-      res = route53client.change_resource_record_sets(
-          HostedZoneId=zoneId, ChangeBatch=batch)
-  else:
-    print(("Delete A record Alias: {} ({})".format(domain, zoneId)))
-    if not enablePrompts or click.confirm('Continue?', default=False):
-      res = route53client.change_resource_record_sets(
-          HostedZoneId=zoneId, ChangeBatch=batch)
-  if res:
-    print(("Submitted (status={})".format(res['ChangeInfo']['Status'])))
+def changeSize(change):
+  '''
+    Returns (records, value chars) a change counts toward the batch limits
+    (an alias has no records but is counted as one)
+  '''
+  records = change['ResourceRecordSet'].get('ResourceRecords') or []
+  times = 2 if change['Action'] == 'UPSERT' else 1
+  return times * max(1, len(records)), times * sum(len(r['Value']) for r in records)
+
+def batchChanges(changes, maxChanges=MAX_BATCH_CHANGES, maxChars=MAX_BATCH_CHARS):
+  '''
+    Splits changes for one zone into as few batches as the limits allow
+  '''
+  batch, count, chars = [], 0, 0
+  for change in changes:
+    n, c = changeSize(change)
+    if batch and (count + n > maxChanges or chars + c > maxChars):
+      yield batch
+      batch, count, chars = [], 0, 0
+    batch.append(change)
+    count += n
+    chars += c
+  if batch:
+    yield batch
+
+def submitChanges(zoneChanges, comment, workers=8):
+  '''
+    Submits {zone id: [change]} as batched change sets, zones in parallel
+
+    Returns a Result per batch keyed (zone id, batch) with the ChangeInfo.
+  '''
+  r53 = aws.client('route53')
+  tasks = []
+  for zoneId, changes in zoneChanges.items():
+    for batch in batchChanges(changes):
+      fn = partial(r53.change_resource_record_sets, HostedZoneId=zoneId,
+                   ChangeBatch={'Comment': comment, 'Changes': batch})
+      tasks.append(((zoneId, tuple(c['ResourceRecordSet']['Name'] for c in batch)), fn))
+  return [r._replace(value=r.value['ChangeInfo']) if r.ok else r for r in runAll(tasks, workers)]
+
+def waitForChange(changeId, timeout=900, delay=2.0, maxDelay=15.0):
+  '''
+    Polls get_change with growing, jittered delays until INSYNC
+
+    Returns seconds waited (raises on timeout).
+  '''
+  r53 = aws.client('route53')
+  start = time.monotonic()
+  while True:
+    status = r53.get_change(Id=changeId)['ChangeInfo']['Status']
+    elapsed = time.monotonic() - start
+    if status == 'INSYNC':
+      return elapsed
+    if elapsed > timeout:
+      raise Exception('{} still {} after {:.0f}s'.format(changeId, status, elapsed))
+    time.sleep(random.uniform(delay / 2, delay))
+    delay = min(maxDelay, delay * 1.5)
+
+def syncAliases(domainInfos, update=True, enablePrompts=True, wait=True, workers=8):
+  '''
+    Adds or removes route53 aliases for many domains from getAuthDomainInfo()
+
+    Changes are grouped per hosted zone into as few batches as possible and
+    submitted in parallel. With wait, every change is polled (concurrently)
+    until INSYNC. Returns (submit results, wait results).
+  '''
+  zones = runAll([(d['name'], partial(getHostedZoneInfo, d['name'])) for d in domainInfos], workers)
+  zoneChanges = {}
+  for d, z in zip(domainInfos, zones):
+    if not z.ok:
+      raise z.error
+    zoneId = z.value['zoneId']
+    zoneChanges.setdefault(zoneId, []).append(aliasChange(d, update))
+    if update:
+      print("Create A record Alias: {} ({}) => {}".format(d['name'], zoneId, d['dist']))
+    else:
+      print("Delete A record Alias: {} ({})".format(d['name'], zoneId))
+  if not zoneChanges or (enablePrompts and not click.confirm('Continue?', default=False)):
+    return [], []
+
+  comment = "{} alias for user pool domain".format('Create' if update else 'Remove')
+  submitted = submitChanges(zoneChanges, comment, workers)
+  for r in submitted:
+    if r.ok:
+      print("Submitted {} ({} changes, status={})".format(r.value['Id'], len(r.key[1]), r.value['Status']))
+  if not wait:
+    return submitted, []
+  pending = [(r.value['Id'], partial(waitForChange, r.value['Id'])) for r in submitted if r.ok]
+  return submitted, runAll(pending, workers)
+
+def modifyUserPoolDomainRoute53AliasEntry(domainInfo, update=True, enablePrompts=True):
+  '''
+    Adds or removes route53 alias given domain info from getAuthDomainInfo()
+  '''
+  syncAliases([domainInfo], update, enablePrompts, wait=False)
 
 
 
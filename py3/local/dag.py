@@ -0,0 +1,139 @@
+# -*- mode: python3 -*-
+#
+# Runs shell commands (or Python callables) as a dependency graph on a
+# bounded pool, streaming each command's output line by line with its node
+# name as prefix
+#
+
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .batch import inContext
+from .console_util import *
+
+# One command; deps are names of nodes that must succeed first. cmd may be a
+# callable taking emit(line), which fails by raising.
+Node = namedtuple('Node', ['name', 'cmd', 'cwd', 'deps'])
+
+# Outcome of one node (status is ok, failed or skipped)
+Outcome = namedtuple('Outcome', ['name', 'status', 'code', 'elapsed'])
+
+
+class Runner:
+  '''
+    Schedules nodes as soon as their deps succeed, up to jobs at a time
+
+    Without keepGoing the first failure stops everything: nothing new starts
+    and running commands are terminated. With keepGoing only nodes that
+    depend (directly or not) on a failure are skipped.
+  '''
+
+  def __init__(self, nodes, jobs=None, keepGoing=False, out=None):
+    self.nodes = {n.name: n for n in nodes}
+    self.jobs = jobs or os.cpu_count() or 4
+    self.keepGoing = keepGoing
+    self.out = out or sys.stdout
+    self.width = max([len(n) for n in self.nodes] + [0])
+    self.lock = threading.Lock()
+    self.procs = {}
+    self.stopping = False
+    for n in nodes:
+      missing = [d for d in n.deps if d not in self.nodes]
+      if missing:
+        raise ValueError('{} depends on unknown {}'.format(n.name, ', '.join(missing)))
+
+  def emit(self, name, line):
+    with self.lock:
+      self.out.write('{} {}\n'.format(dim('[{:<{}}]'.format(name, self.width)), line))
+      self.out.flush()
+
+  def runCall(self, node):
+    start = time.perf_counter()
+    if self.stopping:
+      return Outcome(node.name, 'skipped', None, 0)
+    try:
+      node.cmd(lambda line: self.emit(node.name, line))
+    except Exception as e:
+      self.emit(node.name, red('{}: {}'.format(type(e).__name__, e)))
+      return Outcome(node.name, 'failed', None, time.perf_counter() - start)
+    return Outcome(node.name, 'ok', 0, time.perf_counter() - start)
+
+  def runNode(self, node):
+    if callable(node.cmd):
+      return self.runCall(node)
+    start = time.perf_counter()
+    with self.lock:
+      if self.stopping:
+        return Outcome(node.name, 'skipped', None, 0)
+      proc = subprocess.Popen(node.cmd, cwd=node.cwd, shell=isinstance(node.cmd, str),
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              stdin=subprocess.DEVNULL)
+      self.procs[node.name] = proc
+    try:
+      for raw in proc.stdout:
+        self.emit(node.name, raw.decode('utf-8', 'replace').rstrip('\r\n'))
+      code = proc.wait()
+    finally:
+      with self.lock:
+        self.procs.pop(node.name, None)
+    status = 'ok' if code == 0 else 'failed'
+    return Outcome(node.name, status, code, time.perf_counter() - start)
+
+  def stop(self):
+    with self.lock:
+      self.stopping = True
+      for proc in self.procs.values():
+        proc.terminate()
+
+  def run(self):
+    '''
+      Returns an Outcome per node, in the order nodes were given
+    '''
+    pending = dict(self.nodes)
+    outcomes = {}
+    running = {}
+
+    def skipBlocked():
+      # Skip nodes whose deps failed or were skipped (repeat for chains)
+      changed = True
+      while changed:
+        changed = False
+        for name, node in list(pending.items()):
+          if any(d in outcomes and outcomes[d].status != 'ok' for d in node.deps):
+            outcomes[name] = Outcome(name, 'skipped', None, 0)
+            del pending[name]
+            changed = True
+
+    with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+      while pending or running:
+        if not self.stopping:
+          ready = [n for n in pending.values()
+                   if all(d in outcomes and outcomes[d].status == 'ok' for d in n.deps)]
+          for node in ready[:max(0, self.jobs - len(running))]:
+            del pending[node.name]
+            running[pool.submit(inContext(self.runNode), node)] = node.name
+        if not running:
+          # Nothing can start: a cycle, or everything left is blocked/stopped
+          for name in pending:
+            outcomes[name] = Outcome(name, 'skipped', None, 0)
+          break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for f in done:
+          name = running.pop(f)
+          try:
+            outcomes[name] = f.result()
+          except Exception as e:
+            self.emit(name, red(str(e)))
+            outcomes[name] = Outcome(name, 'failed', None, 0)
+          if outcomes[name].status == 'failed' and not self.keepGoing:
+            self.stop()
+        skipBlocked()
+    return [outcomes[name] for name in self.nodes]
+
+
+def runGraph(nodes, jobs=None, keepGoing=False, out=None):
+  return Runner(nodes, jobs, keepGoing, out).run()
@@ -0,0 +1,253 @@
+# -*- mode: python3 -*-
+#
+# CloudFormation deploys through change sets (replaces sam deploy)
+#
+# Skips stacks whose template, parameters and capabilities match what was
+# last deployed (no change set at all), treats an empty change set as "no
+# changes" and follows execution with the incremental event reader.
+#
+
+import hashlib
+import json
+import os
+import re
+import time
+from datetime import datetime
+from .cache import DeployCache, StackCache
+from .cfn_util import EventFollower, followEvents, isFailedStatus, isStackEvent, stackUpdated
+from .utils import loadYaml
+from . import aws
+
+DEFAULT_CAPABILITIES = ['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND']
+# Larger templates must be passed by S3 URL
+MAX_TEMPLATE_BODY = 51200
+# Reasons CloudFormation gives for a change set without changes
+NO_CHANGES_REGEX = re.compile(r"didn't contain changes|No updates are to be performed")
+# Stack statuses a change set cannot be created in
+BUSY_SUFFIX = '_IN_PROGRESS'
+# Spec parameter values like "${network.VpcId}" take another stack's output
+OUTPUT_REF_REGEX = re.compile(r'\$\{([\w-]+)\.([\w-]+)\}')
+
+
+def describeStack(stackName):
+  '''
+    Returns describe_stacks entry, or None if the stack does not exist
+  '''
+  try:
+    return aws.client('cloudformation').describe_stacks(StackName=stackName)['Stacks'][0]
+  except aws.ClientError as e:
+    if aws.errorCode(e) == 'ValidationError' and 'does not exist' in str(e):
+      return None
+    raise
+
+
+def deployStamp(body, params, capabilities):
+  ob = {'template': body, 'parameters': params, 'capabilities': sorted(capabilities)}
+  return hashlib.sha256(json.dumps(ob, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def templateArgs(body, bucket):
+  '''
+    TemplateBody, or TemplateURL after uploading to bucket (content addressed)
+  '''
+  if len(body.encode('utf-8')) <= MAX_TEMPLATE_BODY:
+    return {'TemplateBody': body}
+  if not bucket:
+    raise Exception('Template is over {} bytes: an S3 bucket is needed'.format(MAX_TEMPLATE_BODY))
+  key = 'maketools/templates/{}.yaml'.format(hashlib.sha256(body.encode('utf-8')).hexdigest())
+  aws.client('s3').put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+  return {'TemplateURL': 'https://{}.s3.amazonaws.com/{}'.format(bucket, key)}
+
+
+def parameterArgs(stack, template, params):
+  '''
+    Parameters for a change set: given values, previous values for the
+    stack's other parameters that the template still declares
+  '''
+  args = [{'ParameterKey': k, 'ParameterValue': str(v)} for k, v in sorted(params.items())]
+  previous = [p['ParameterKey'] for p in (stack or {}).get('Parameters') or [] if p['ParameterKey'] not in params]
+  if previous:
+    summary = aws.client('cloudformation').get_template_summary(**template)
+    declared = set(p['ParameterKey'] for p in summary.get('Parameters') or [])
+    args += [{'ParameterKey': k, 'UsePreviousValue': True} for k in previous if k in declared]
+  return args
+
+
+def waitForChangeSet(changeSetId, delay=0.5, maxDelay=10.0):
+  '''
+    Polls describe_change_set (delay growing to maxDelay) until it settles
+
+    Returns (status, reason, changes).
+  '''
+  cf = aws.client('cloudformation')
+  while True:
+    res = cf.describe_change_set(ChangeSetName=changeSetId)
+    if res['Status'] in ('CREATE_COMPLETE', 'FAILED', 'DELETE_COMPLETE'):
+      break
+    time.sleep(delay)
+    delay = min(maxDelay, delay * 1.5)
+  changes = list(res.get('Changes') or [])
+  token = res.get('NextToken')
+  while token:
+    page = cf.describe_change_set(ChangeSetName=changeSetId, NextToken=token)
+    changes += page.get('Changes') or []
+    token = page.get('NextToken')
+  return res['Status'], res.get('StatusReason') or '', changes
+
+
+def parseTimestamp(ts):
+  return datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class ResourceTimer:
+  '''
+    Collects per-resource start/end times from stack events
+  '''
+
+  def __init__(self):
+    self.started = {}
+    self.ended = {}
+
+  def add(self, e):
+    key = (e['stackName'], e['logicalId'])
+    status = e['status'] or ''
+    if status.endswith('IN_PROGRESS'):
+      self.started.setdefault(key, (parseTimestamp(e['timestamp']), e['resourceType']))
+    elif key in self.started:
+      self.ended[key] = (parseTimestamp(e['timestamp']), status)
+
+  def rows(self):
+    '''
+      Returns (seconds, stack, logical id, type, final status), slowest first
+    '''
+    rows = []
+    for key, (start, type) in self.started.items():
+      end, status = self.ended.get(key, (None, 'IN_PROGRESS'))
+      secs = (end - start).total_seconds() if end else 0
+      rows.append((secs, key[0], key[1], type, status))
+    return sorted(rows, reverse=True)
+
+
+def deployStack(stackName, templateFile, params=None, capabilities=DEFAULT_CAPABILITIES,
+                bucket=None, execute=True, force=False, emit=print, top=20):
+  '''
+    Deploys templateFile to stackName with a change set
+
+    Returns 'unchanged' (skipped), 'no changes', 'pending' (not executed) or
+    the final stack status. Raises if the change set or the update fails.
+  '''
+  cf = aws.client('cloudformation')
+  params = {k: str(v) for k, v in (params or {}).items()}
+  with open(templateFile) as f:
+    body = f.read()
+  stack = describeStack(stackName)
+  if stack and stack['StackStatus'].endswith(BUSY_SUFFIX) and stack['StackStatus'] != 'REVIEW_IN_PROGRESS':
+    raise Exception('{} is busy ({})'.format(stackName, stack['StackStatus']))
+  exists = stack is not None and stack['StackStatus'] != 'REVIEW_IN_PROGRESS'
+
+  cache = DeployCache(aws.scope())
+  stamp = deployStamp(body, params, capabilities)
+  if exists and not force and cache.isCurrent(stackName, stamp, stackUpdated(stack)):
+    emit('Unchanged since last deploy ({})'.format(stack['StackStatus']))
+    return 'unchanged'
+
+  template = templateArgs(body, bucket)
+  name = 'maketools-{}'.format(time.strftime('%Y%m%d%H%M%S'))
+  res = cf.create_change_set(
+      StackName=stackName,
+      ChangeSetName=name,
+      ChangeSetType='UPDATE' if exists else 'CREATE',
+      Parameters=parameterArgs(stack if exists else None, template, params),
+      Capabilities=list(capabilities),
+      **template)
+  changeSetId = res['Id']
+  status, reason, changes = waitForChangeSet(changeSetId)
+  if status == 'FAILED':
+    if NO_CHANGES_REGEX.search(reason):
+      cf.delete_change_set(ChangeSetName=changeSetId)
+      cache.put(stackName, stamp, stackUpdated(stack))
+      emit('No changes')
+      return 'no changes'
+    raise Exception('Change set failed: {}'.format(reason))
+
+  for c in changes:
+    rc = c.get('ResourceChange') or {}
+    replace = ' (replace)' if rc.get('Replacement') == 'True' else ''
+    emit('{:<8} {:<40} {}{}'.format(rc.get('Action', ''), rc.get('LogicalResourceId', ''),
+                                     rc.get('ResourceType', ''), replace))
+  if not execute:
+    emit('Change set ready (not executed): {}'.format(changeSetId))
+    return 'pending'
+
+  follower = EventFollower(stackName)
+  follower.poll()
+  follower.commit()
+  timer = ResourceTimer()
+  start = time.perf_counter()
+  cf.execute_change_set(ChangeSetName=changeSetId)
+
+  def onEvent(e):
+    timer.add(e)
+    if not isStackEvent(e) and 'FAILED' in (e['status'] or ''):
+      emit('{} {} {}'.format(e['logicalId'], e['status'], e['reason'] or ''))
+
+  final = followEvents(follower, onEvent, untilDone=True, slow=10.0)
+  emit('{} in {:.0f}s'.format(final, time.perf_counter() - start))
+  for secs, stack_, logicalId, type, status in timer.rows()[:top]:
+    where = '' if stack_ == stackName else '[{}] '.format(stack_)
+    emit('{:7.1f}s  {}{:<40} {:<36} {}'.format(secs, where, logicalId, type or '', status))
+  StackCache(aws.scope()).invalidate(stackName)
+  if isFailedStatus(final):
+    raise Exception('{} {}'.format(stackName, final))
+  cache.put(stackName, stamp, stackUpdated(describeStack(stackName)))
+  return final
+
+
+def loadSpec(fileName):
+  '''
+    Reads a multi-stack deploy spec:
+
+      stacks:
+        network-dev:
+          template: network.yml
+          parameters:
+            Env: dev
+        orders-dev:
+          template: .packaged.yaml
+          parameters:
+            VpcId: ${network-dev.VpcId}
+
+    Returns {stack: {'template', 'parameters', 'deps'}} where deps are the
+    stacks whose outputs the parameters use. Template paths are relative to
+    the spec file.
+  '''
+  ob = loadYaml(fileName)
+  base = os.path.dirname(os.path.abspath(fileName))
+  stacks = {}
+  for name, spec in (ob.get('stacks') or {}).items():
+    params = {k: str(v) for k, v in (spec.get('parameters') or {}).items()}
+    deps = sorted(set(m.group(1) for v in params.values() for m in OUTPUT_REF_REGEX.finditer(v)))
+    unknown = [d for d in deps if d not in ob['stacks']]
+    if unknown:
+      raise Exception('{} uses outputs of unknown stack(s) {}'.format(name, ', '.join(unknown)))
+    stacks[name] = {
+        'template': os.path.join(base, spec['template']),
+        'parameters': params,
+        'deps': deps,
+    }
+  return stacks
+
+
+def resolveParams(params):
+  '''
+    Replaces ${stack.Output} references with (freshly read) output values
+  '''
+  from .cfn_util import getStackOutputDict
+
+  def lookup(m):
+    outputs = getStackOutputDict(m.group(1), ttl=0, verbose=False)
+    if m.group(2) not in outputs:
+      raise Exception('{} has no output {}'.format(m.group(1), m.group(2)))
+    return outputs[m.group(2)]
+
+  return {k: OUTPUT_REF_REGEX.sub(lookup, v) for k, v in params.items()}
@@ -0,0 +1,195 @@
+# -*- mode: python3 -*-
+#
+# Runs one click subcommand for many (stack, region) targets at once
+#
+
+import click
+import contextvars
+import io
+import sys
+import time
+from contextlib import contextmanager
+from . import aws
+from .batch import runAll
+from .console_util import *
+
+# Output buffer of the target running in the current context (None = real stdout)
+_buffer = contextvars.ContextVar('buffer', default=None)
+
+
+class ContextStdout:
+  '''
+    sys.stdout stand-in that sends writes to the current target's buffer
+  '''
+
+  def __init__(self, real):
+    self.real = real
+
+  def write(self, text):
+    buf = _buffer.get()
+    return (buf if buf is not None else self.real).write(text)
+
+  def flush(self):
+    if _buffer.get() is None:
+      self.real.flush()
+
+  def __getattr__(self, name):
+    return getattr(self.real, name)
+
+
+class ContextStdin:
+  '''
+    sys.stdin stand-in that reads as closed for targets run concurrently, so
+    a prompt fails (click.Abort) instead of blocking a worker
+  '''
+
+  def __init__(self, real):
+    self.real = real
+
+  def readline(self, *args):
+    return '' if _buffer.get() is not None else self.real.readline(*args)
+
+  def read(self, *args):
+    return '' if _buffer.get() is not None else self.real.read(*args)
+
+  # input() reads the terminal directly when stdin has a tty fileno, so
+  # workers must not see either
+  def isatty(self):
+    return _buffer.get() is None and self.real.isatty()
+
+  def fileno(self):
+    if _buffer.get() is not None:
+      raise io.UnsupportedOperation('fileno')
+    return self.real.fileno()
+
+  def __getattr__(self, name):
+    return getattr(self.real, name)
+
+
+@contextmanager
+def captureStdout(interactive=True):
+  real, realIn = sys.stdout, sys.stdin
+  sys.stdout = ContextStdout(real)
+  if not interactive:
+    sys.stdin = ContextStdin(realIn)
+  try:
+    yield
+  finally:
+    sys.stdout, sys.stdin = real, realIn
+
+
+def splitList(ctx, param, value):
+  '''
+    click callback: "a,b, c" => ['a', 'b', 'c']
+  '''
+  return [v.strip() for v in value.split(',') if v.strip()] if value else []
+
+
+def pendingArgs(ctx):
+  # click 8.2 renamed protected_args
+  protected = ctx._protected_args if hasattr(ctx, '_protected_args') else ctx.protected_args
+  return list(protected) + list(ctx.args)
+
+
+class FanOutGroup(click.Group):
+  '''
+    Group that, given --stacks and/or --regions, runs the chosen subcommand
+    once per (stack, region) on a bounded pool
+
+    The stack name is passed as the subcommand's first positional argument
+    (only commands whose first argument is a stack name can fan out over
+    stacks) and each run uses clients for its region. Output is collected per
+    target and printed in target order once all finish; failures are
+    reported without stopping the others. Targets run concurrently are not
+    interactive: --prompt is forced off and reading stdin gets end of file.
+  '''
+
+  def invoke(self, ctx):
+    stacks = ctx.params.get('stacks') or []
+    regions = ctx.params.get('regions') or []
+    if not stacks and not regions:
+      return super().invoke(ctx)
+
+    args = pendingArgs(ctx)
+    if not args:
+      ctx.fail('Missing command.')
+    with ctx:
+      name, cmd, cmdArgs = self.resolve_command(ctx, args)
+      ctx.invoked_subcommand = name
+      if stacks and not takesStack(cmd):
+        ctx.fail('{} does not take a stack name, so it cannot run with --stacks'.format(name))
+      click.Command.invoke(self, ctx)
+      targets = [(s, r) for s in (stacks or [None]) for r in (regions or [None])]
+      jobs = ctx.params.get('jobs') or 8
+      interactive = jobs == 1 or len(targets) == 1
+      tasks = [((s, r), self.runner(ctx, name, cmd, cmdArgs, s, r, interactive)) for s, r in targets]
+      with captureStdout(interactive):
+        results = runAll(tasks, jobs)
+    report(results)
+
+  def runner(self, ctx, name, cmd, cmdArgs, stack, region, interactive=True):
+    def run():
+      buf = io.StringIO()
+      _buffer.set(buf)
+      start = time.perf_counter()
+      try:
+        with aws.useRegion(region):
+          args = ([stack] if stack else []) + list(cmdArgs)
+          with cmd.make_context(name, args, parent=ctx) as sub:
+            if not interactive and 'prompt' in sub.params:
+              sub.params['prompt'] = False
+            cmd.invoke(sub)
+      except (click.exceptions.Exit, SystemExit) as e:
+        code = getattr(e, 'exit_code', getattr(e, 'code', 0))
+        if code:
+          raise TargetError(buf.getvalue(), 'exit code {}'.format(code))
+      except click.ClickException as e:
+        raise TargetError(buf.getvalue(), e.format_message())
+      except click.Abort:
+        raise TargetError(buf.getvalue(), 'aborted (prompts need -j 1 or a single target)')
+      except Exception as e:
+        raise TargetError(buf.getvalue(), '{}: {}'.format(type(e).__name__, e))
+      return buf.getvalue(), time.perf_counter() - start
+    return run
+
+
+def takesStack(cmd):
+  '''
+    True if cmd's first positional argument is a stack name (stack_name or
+    stack_names)
+  '''
+  args = [p for p in cmd.params if isinstance(p, click.Argument)]
+  return bool(args) and args[0].name in ('stack_name', 'stack_names')
+
+
+class TargetError(Exception):
+
+  def __init__(self, output, message):
+    super().__init__(message)
+    self.output = output
+
+
+def label(target):
+  stack, region = target
+  return ' '.join(p for p in [stack, region and '({})'.format(region)] if p)
+
+
+def report(results):
+  '''
+    Prints each target's output in order, then a summary (exits 1 on failure)
+  '''
+  failed = [r for r in results if not r.ok]
+  for r in results:
+    if r.ok:
+      output, elapsed = r.value
+      print(bold('== {} '.format(label(r.key))) + dim('{:.2f}s'.format(elapsed)))
+    else:
+      output = getattr(r.error, 'output', '')
+      print(bred('== {} failed: {}'.format(label(r.key), r.error)))
+    if output:
+      print(output.rstrip('\n'))
+    print()
+  summary = '{} succeeded, {} failed'.format(len(results) - len(failed), len(failed))
+  print(bred(summary) if failed else bold(summary))
+  if failed:
+    sys.exit(1)
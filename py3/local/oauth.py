@@ -0,0 +1,144 @@
+# -*- mode: python3 -*-
+#
+# OAuth2 client credentials tokens (Cognito token endpoint)
+#
+# Tokens are cached on disk until shortly before they expire and HTTP
+# connections are reused between requests, so test harnesses calling this
+# repeatedly do not hit the token endpoint (and its rate limit) every time.
+#
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from io import BytesIO
+from urllib.parse import urlencode
+from .cache import cacheDir
+from .utils import atomicWrite
+
+# Cached tokens are treated as expired this many seconds early
+TOKEN_MARGIN = 60
+
+# Per-thread HTTP sessions / curl handles (neither is safe to share)
+_local = threading.local()
+
+
+class TokenCache:
+  '''
+    Tokens keyed by (token endpoint, client id, scope), one private file each
+  '''
+
+  def __init__(self, margin=TOKEN_MARGIN):
+    self.margin = margin
+
+  def path(self, endpoint, clientId, scope):
+    key = hashlib.sha256('\0'.join([endpoint, clientId, scope]).encode('utf-8')).hexdigest()
+    return os.path.join(cacheDir('tokens'), key + '.json')
+
+  def get(self, endpoint, clientId, scope):
+    '''
+      Returns cached token if it is still valid for at least margin seconds
+    '''
+    try:
+      with open(self.path(endpoint, clientId, scope)) as f:
+        token = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if token.get('expires_at', 0) - self.margin <= time.time():
+      return None
+    return token
+
+  def put(self, endpoint, clientId, scope, token):
+    token = dict(token)
+    if 'expires_at' not in token:
+      token['expires_at'] = time.time() + int(token.get('expires_in', 0))
+    with atomicWrite(self.path(endpoint, clientId, scope), mode=0o600) as f:
+      json.dump(token, f)
+    return token
+
+
+def scopeKey(scope):
+  if isinstance(scope, str):
+    scope = scope.split()
+  return ' '.join(sorted(scope))
+
+
+def getToken(token_url, client_id, client_secret, scope, cache=True):
+  '''
+    Retrieves token from OAuth2 token endpoint
+
+    Returns a cached token while it is valid (cache=False always fetches). The
+    HTTP session for each client/scope is kept for reuse (keep-alive).
+  '''
+  key = (token_url, client_id, scopeKey(scope))
+  tokens = TokenCache()
+  if cache:
+    token = tokens.get(*key)
+    if token:
+      return token
+
+  # Imported here (slow) so other commands do not pay for them
+  from oauthlib.oauth2 import BackendApplicationClient
+  from requests.auth import HTTPBasicAuth
+  from requests_oauthlib import OAuth2Session
+  sessions = _local.__dict__.setdefault('sessions', {})
+  oauth = sessions.get(key)
+  if oauth is None:
+    client = BackendApplicationClient(client_id=client_id)
+    oauth = sessions[key] = OAuth2Session(client=client, scope=scope)
+  auth = HTTPBasicAuth(client_id, client_secret)
+  token = oauth.fetch_token(token_url=token_url, auth=auth)
+  return tokens.put(*key, token) if cache else token
+
+
+def getCurl():
+  '''
+    Returns this thread's curl handle (reused so connections are kept alive)
+  '''
+  curl = getattr(_local, 'curl', None)
+  if curl is None:
+    import pycurl
+    curl = _local.curl = pycurl.Curl()
+  return curl
+
+
+def getTokenPyCurl(endpoint, authToken, scope, cache=True, verbose=False):
+  '''
+    Retrieves token from OAuth2 token endpoint
+
+    authToken is base64 "id:secret". Returns (status, body); a cached token
+    is returned as (200, json) while it is valid.
+  '''
+  clientId = base64.b64decode(authToken).decode('utf-8').split(':')[0]
+  key = (endpoint, clientId, scopeKey(scope))
+  tokens = TokenCache()
+  if cache:
+    token = tokens.get(*key)
+    if token:
+      return (200, json.dumps(token))
+
+  import pycurl
+  curl = getCurl()
+  curl.reset()
+  curl.setopt(curl.VERBOSE, verbose)
+  curl.setopt(curl.URL, endpoint)
+  curl.setopt(curl.HTTPHEADER, [
+    "Authorization: Basic {}".format(authToken),
+    "Content-Type: application/x-www-form-urlencoded"
+  ])
+
+  postData = {
+    "grant_type": "client_credentials",
+    "scope": scope
+  }
+  curl.setopt(curl.POSTFIELDS, urlencode(postData))
+  buf = BytesIO()
+  curl.setopt(curl.WRITEDATA, buf)
+  curl.perform()
+  code = curl.getinfo(pycurl.RESPONSE_CODE)
+  body = buf.getvalue().decode('utf-8')
+  if cache and code == 200:
+    tokens.put(*key, json.loads(body))
+  return (code, body)
@@ -1,59 +1,275 @@
 # -*- mode: python3 -*-
 
-import boto3
-import botocore
 import click
 import os
 import yaml
 import re
+import queue
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from .utils import *
+from .batch import *
+from .cache import ParamCache, invalidatePrefixes, isUnder, valueHash
+from .trace import phase
+from . import aws
 
 
-ssmClient = boto3.client('ssm')
-smClient = boto3.client('secretsmanager')
+PARAM_REGEX=re.compile("^[a-zA-Z0-9_\.\-/]+$")
 
+# Sustained put/delete calls per second (SSM throttles above its account limit)
+WRITE_RATE=10
 
-PARAM_REGEX=re.compile("^[a-zA-Z0-9_\.\-/]+$")
+def iterParamsUnderPath(path, namesOnly=False, decrypt=True):
+  '''
+    Yields parameters under path, following NextToken until exhausted
 
-def getNamesUnderPath(path):
-  # aws ssm get-parameters-by-path --path $PARAM_PATH --recursive | jq -r '.Parameters[].Name'
+    With namesOnly uses describe_parameters, which returns metadata only
+    (Name, Type, Version, LastModifiedDate) and never decrypts.
+  '''
   try:
-    res = ssmClient.get_parameters_by_path(Path=path, Recursive=True)
-    return [p['Name'] for p in res['Parameters']]
-  except botocore.exceptions.ClientError as e:
-    code = e.response['Error']['Code']
-    if code != 'ParameterNotFound':
-      print(e)
-  return []
+    if namesOnly:
+      paginator = aws.client('ssm').get_paginator('describe_parameters')
+      pages = paginator.paginate(
+          ParameterFilters=[{'Key': 'Path', 'Option': 'Recursive', 'Values': [path]}],
+          PaginationConfig={'PageSize': 50})
+    else:
+      paginator = aws.client('ssm').get_paginator('get_parameters_by_path')
+      pages = paginator.paginate(
+          Path=path,
+          Recursive=True,
+          WithDecryption=decrypt,
+          PaginationConfig={'PageSize': 10})
+    for page in pages:
+      for p in page['Parameters']:
+        yield p
+  except aws.ClientError as e:
+    # Anything else would leave callers planning against a partial listing
+    if aws.errorCode(e) != 'ParameterNotFound':
+      raise
+
+
+def disjointPaths(paths):
+  '''
+    Drops paths nested under another path in the list
+
+    disjointPaths(['/a/b', '/a', '/c']) => ['/a', '/c']
+  '''
+  kept = []
+  for path in sorted(set(p.rstrip('/') or '/' for p in paths)):
+    if any(path == k or k == '/' or path.startswith(k + '/') for k in kept):
+      continue
+    kept.append(path)
+  return kept
+
+
+def iterParamsUnderPaths(paths, workers=8, **kwargs):
+  '''
+    Yields parameters under each of paths, listing paths concurrently
+
+    Each path is paged on its own worker (at most workers at once) and results
+    are yielded as pages arrive. Overlapping paths are listed once.
+  '''
+  paths = disjointPaths(paths)
+  if len(paths) <= 1:
+    for path in paths:
+      yield from iterParamsUnderPath(path, **kwargs)
+    return
+
+  results = queue.Queue()
+  done = object()
+
+  def drain(path):
+    try:
+      for p in iterParamsUnderPath(path, **kwargs):
+        results.put(p)
+    finally:
+      results.put(done)
+
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    futures = [pool.submit(inContext(drain), path) for path in paths]
+    remaining = len(futures)
+    while remaining:
+      item = results.get()
+      if item is done:
+        remaining -= 1
+      else:
+        yield item
+    for f in futures:
+      f.result()
+
+
+def iterNamesUnderPaths(paths, workers=8):
+  for p in iterParamsUnderPaths(paths, workers, namesOnly=True):
+    yield p['Name']
+
+
+def getNamesUnderPath(path):
+  # aws ssm describe-parameters --parameter-filters Key=Path,Option=Recursive,Values=$PARAM_PATH
+  return [p['Name'] for p in iterParamsUnderPath(path, namesOnly=True)]
+
+
+def getParams(names, workers=8, decrypt=True):
+  '''
+    Returns {name: parameter} for names, 10 per get_parameters call
+
+    Names that do not exist are left out.
+  '''
+  ssm = aws.client('ssm')
+  tasks = [(batch, partial(ssm.get_parameters, Names=batch, WithDecryption=decrypt))
+           for batch in chunks(names, 10)]
+  found = {}
+  for r in runAll(tasks, workers):
+    if not r.ok:
+      raise r.error
+    for p in r.value['Parameters']:
+      found[p['Name']] = p
+  return found
+
+
+def getScope():
+  return aws.scope(aws.client('ssm').meta.region_name)
+
+
+def _stateRow(p):
+  modified = p.get('LastModifiedDate')
+  return (p['Type'], p['Version'], modified and str(modified), valueHash(p['Type'], p['Value']))
+
+
+def getRemoteState(prefix, cached=None, workers=8):
+  '''
+    Returns {name: (type, hash)} for everything under prefix via the local cache
+
+    cached=None (default) pages describe_parameters metadata and fetches values
+    only for names that are new or have a new version. cached=True skips SSM
+    entirely while the cache is within its TTL. cached=False re-reads every
+    value.
+  '''
+  cache = ParamCache(getScope(), prefix)
+  if cached and cache.isFresh():
+    rows = cache.rows()
+  elif cached is False:
+    rows = {p['Name']: _stateRow(p) for p in iterParamsUnderPath(prefix, decrypt=True)}
+    cache.update(rows, replace=True)
+  else:
+    known = cache.rows()
+    # Listing errors raise here, before anything is deleted or the prefix is
+    # marked refreshed, so a truncated listing never reaches the cache
+    meta = {p['Name']: p for p in iterParamsUnderPath(prefix, namesOnly=True)}
+    stale = [n for n, p in meta.items() if n not in known or known[n][1] != p['Version']]
+    fetched = {n: _stateRow(p) for n, p in getParams(stale, workers).items()}
+    deleted = [n for n in known if n not in meta or (n in stale and n not in fetched)]
+    cache.update(fetched, deleted)
+    rows = {n: r for n, r in known.items() if n not in deleted}
+    rows.update(fetched)
+  return {name: (row[0], row[3]) for name, row in rows.items()}
+
+
+def recordWrites(prefix, puts, results):
+  '''
+    Updates the cache for prefix with the outcome of putParams/delParams
+
+    Other cached prefixes holding a written name (parents or children of
+    prefix) are dropped.
+  '''
+  byName = {name: (value, type) for name, value, type in puts}
+  rows = {}
+  deleted = []
+  for r in results:
+    if not r.ok:
+      continue
+    if r.key in byName and isinstance(r.value, dict):
+      value, type = byName[r.key]
+      rows[r.key] = (type, r.value['Version'], None, valueHash(type, value))
+    else:
+      deleted.append(r.key)
+  scope = getScope()
+  ParamCache(scope, prefix).update(rows, deleted, refreshed=False)
+  invalidatePrefixes(scope, list(rows) + deleted, keep=prefix)
+
+
+# Puts are (name, value, type) tuples; delete and unchanged are names
+Plan = namedtuple('Plan', ['add', 'change', 'delete', 'unchanged'])
+
+@phase('diff')
+def planPush(local, remote):
+  '''
+    Compares local (name, value, type) tuples with remote {name: (type, hash)}
+
+    Only add and change need writing. Anything remote that is not local is
+    deleted.
+  '''
+  add, change, unchanged = [], [], []
+  for name, value, type in local:
+    if name not in remote:
+      add.append((name, value, type))
+    elif remote[name] != (type, valueHash(type, value)):
+      change.append((name, value, type))
+    else:
+      unchanged.append(name)
+  names = set(name for name, _, _ in local)
+  delete = sorted(n for n in remote if n not in names)
+  return Plan(add, change, delete, unchanged)
 
 
 def putString(name, value):
   print("{} => {}".format(name, value))
-  ssmClient.put_parameter(Name=name, Value=value, Type="String", Overwrite=True)
+  aws.client('ssm').put_parameter(Name=name, Value=value, Type="String", Overwrite=True)
 
 def putSecure(name, value):
   print("{}! => {}".format(name, value))
-  ssmClient.put_parameter(
+  aws.client('ssm').put_parameter(
       Name=name, Value=value, Type="SecureString", Overwrite=True)
 
 
 def delParam(name):
   print("delete: {}".format(name), end='')
   try:
-    ssmClient.delete_parameter(Name=name)
+    aws.client('ssm').delete_parameter(Name=name)
     print()
-  except botocore.exceptions.ClientError as e:
-    code = e.response['Error']['Code']
+  except aws.ClientError as e:
+    code = aws.errorCode(e)
     if code != 'ParameterNotFound':
       print(" ", e)
     else:
       print(" [Missing]")
 
 
+def putParams(params, workers=8, rate=WRITE_RATE):
+  '''
+    Puts (name, value, type) tuples concurrently
+
+    Calls are rate limited and retried when throttled. Returns a Result per name.
+  '''
+  ssm = aws.client('ssm')
+  bucket = TokenBucket(rate)
+  tasks = []
+  for name, value, type in params:
+    fn = partial(ssm.put_parameter, Name=name, Value=value, Type=type, Overwrite=True)
+    tasks.append((name, fn))
+  return runAll(tasks, workers, bucket)
+
+
+def delParams(names, workers=8, rate=WRITE_RATE):
+  '''
+    Deletes names concurrently, 10 per delete_parameters call
+
+    Returns a Result per name (value is 'missing' if it did not exist).
+  '''
+  ssm = aws.client('ssm')
+  bucket = TokenBucket(rate)
+  tasks = [(batch, partial(ssm.delete_parameters, Names=batch)) for batch in chunks(names, 10)]
+  results = []
+  for r in runAll(tasks, workers, bucket):
+    missing = set(r.value['InvalidParameters']) if r.ok else set()
+    for name in r.key:
+      results.append(Result(name, r.ok, r.error, 'missing' if name in missing else None))
+  return results
+
 
 def createSecret(name, desc, value):
   print("Creating secret {}".format(name))
-  smClient.create_secret(
+  aws.client('secretsmanager').create_secret(
     Name=name,
     Description=desc,
     SecretString=value
@@ -61,18 +277,157 @@ def createSecret(name, desc, value):
 
 def putSecret(name, desc, value):
   try:
-    smClient.put_secret_value(
+    aws.client('secretsmanager').put_secret_value(
       SecretId=name,
       SecretString=value
     )
-  except botocore.exceptions.ClientError as e:
-    code = e.response['Error']['Code']
+  except aws.ClientError as e:
+    code = aws.errorCode(e)
     if code == 'ResourceNotFoundException':
       createSecret(name, desc, value)
 
 
 def delSecret(name):
-  smClient.delete_secret(
+  aws.client('secretsmanager').delete_secret(
     SecretId=name,
     ForceDeleteWithoutRecovery=True
   )
+
+
+# Secrets per batch_get_secret_value call (API maximum)
+SECRET_BATCH = 20
+
+def iterSecrets(root=None):
+  '''
+    Yields (name, pending) for secrets at or under root ("a/b" matches a/b
+    and a/b/c, not a/bc), following NextToken
+
+    Secrets scheduled for deletion are included (pending is True): the name
+    is still taken, so create_secret would fail for them.
+  '''
+  kw = {'IncludePlannedDeletion': True}
+  if root:
+    kw['Filters'] = [{'Key': 'name', 'Values': [root]}]
+  for page in aws.client('secretsmanager').get_paginator('list_secrets').paginate(**kw):
+    for secret in page['SecretList']:
+      if not root or isUnder(secret['Name'], root):
+        yield secret['Name'], 'DeletedDate' in secret
+
+
+def secretValue(secret):
+  '''
+    Returns (kind, value): kind is SecretString or SecretBinary
+  '''
+  if 'SecretString' in secret:
+    return 'SecretString', secret['SecretString']
+  return 'SecretBinary', secret.get('SecretBinary')
+
+
+def getSecretValues(names, workers=8):
+  '''
+    Returns {name: (kind, value)} for names (current versions, see secretValue)
+
+    Uses batch_get_secret_value (20 per call) where the installed botocore
+    has it, else one get_secret_value per name. Calls run on the pool.
+  '''
+  sm = aws.client('secretsmanager')
+  if hasattr(sm, 'batch_get_secret_value'):
+    tasks = [(batch, partial(sm.batch_get_secret_value, SecretIdList=batch))
+             for batch in chunks(names, SECRET_BATCH)]
+  else:
+    tasks = [([name], partial(sm.get_secret_value, SecretId=name)) for name in names]
+  values = {}
+  for r in runAll(tasks, workers):
+    if not r.ok:
+      raise r.error
+    for secret in r.value.get('SecretValues', [r.value]):
+      values[secret['Name']] = secretValue(secret)
+    for error in r.value.get('Errors') or []:
+      raise Exception('{}: {} {}'.format(error.get('SecretId'), error.get('ErrorCode'), error.get('Message')))
+  return values
+
+
+def getSecretState(root=None, names=(), workers=8):
+  '''
+    Returns {name: (kind, hash)} for remote secrets at or under root (values
+    are not kept)
+
+    Only secrets in names (the local ones) are read; others are listed as
+    (None, None), and secrets scheduled for deletion as ('pending', None).
+  '''
+  state, fetch = {}, []
+  for name, pending in iterSecrets(root):
+    if pending:
+      state[name] = ('pending', None)
+    else:
+      state[name] = (None, None)
+      if name in names:
+        fetch.append(name)
+  for name, (kind, value) in getSecretValues(fetch, workers).items():
+    state[name] = (kind, valueHash(kind, value))
+  return state
+
+
+def binarySecrets(remote):
+  return sorted(n for n, (kind, _) in remote.items() if kind == 'SecretBinary')
+
+
+def pendingSecrets(remote):
+  return sorted(n for n, (kind, _) in remote.items() if kind == 'pending')
+
+
+@phase('diff')
+def planSecrets(local, remote):
+  '''
+    Compares local {name: value} (strings) with remote {name: (kind, hash)}
+
+    add and change are (name, value) pairs; delete and unchanged are names.
+    Remote binary secrets are left out entirely (see binarySecrets): local
+    values are strings, so they would always differ and writing one would
+    replace the binary with a string. Secrets scheduled for deletion are
+    changes (writeSecrets restores them) and never deleted again.
+  '''
+  binary = set(binarySecrets(remote))
+  pending = set(pendingSecrets(remote))
+  add, change, unchanged = [], [], []
+  for name, value in sorted(local.items()):
+    if name in binary:
+      continue
+    if name not in remote:
+      add.append((name, value))
+    elif remote[name] != ('SecretString', valueHash('SecretString', value)):
+      change.append((name, value))
+    else:
+      unchanged.append(name)
+  delete = sorted(n for n in remote if n not in local and n not in binary and n not in pending)
+  return Plan(add, change, delete, unchanged)
+
+
+def writeSecrets(plan, workers=8, rate=WRITE_RATE, desc='Managed by values.yml', restore=()):
+  '''
+    Applies a planSecrets plan concurrently: create_secret for new names (one
+    call each), put_secret_value for changes (after restore_secret for names
+    in restore, see pendingSecrets), delete_secret for removals (scheduled
+    with the default recovery window, so restore_secret can undo it)
+
+    Calls are rate limited and retried when throttled. Returns a Result per
+    name (value is 'created', 'updated', 'restored' or 'deleted').
+  '''
+  sm = aws.client('secretsmanager')
+
+  def restoreAndPut(name, value):
+    sm.restore_secret(SecretId=name)
+    return sm.put_secret_value(SecretId=name, SecretString=value)
+
+  tasks = []
+  for name, value in plan.add:
+    tasks.append(('created', name, partial(sm.create_secret, Name=name, Description=desc, SecretString=value)))
+  for name, value in plan.change:
+    if name in restore:
+      tasks.append(('restored', name, partial(restoreAndPut, name, value)))
+    else:
+      tasks.append(('updated', name, partial(sm.put_secret_value, SecretId=name, SecretString=value)))
+  for name in plan.delete:
+    tasks.append(('deleted', name, partial(sm.delete_secret, SecretId=name)))
+  results = runAll([(name, fn) for _, name, fn in tasks], workers, TokenBucket(rate))
+  return [Result(r.key, r.ok, r.error, action if r.ok else None) for (action, _, _), r in zip(tasks, results)]
@@ -0,0 +1,237 @@
+# -*- mode: python3 -*-
+#
+# Optional long-lived daemon that runs stack.py/values.py commands in a warm
+# process (boto3 already imported, clients and connection pools reused).
+#
+# The scripts call forward() before their own imports. If a daemon is
+# listening the command runs there and its output is replayed, otherwise
+# forward() returns None and the script runs the command itself.
+#
+# Only stdlib is imported at module level so forwarding stays cheap.
+#
+
+import io
+import json
+import os
+import re
+import socket
+import sys
+import time
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+# Commands that never prompt or read stdin (safe to run in the daemon)
+DAEMON_COMMANDS = {
+    'stack': {'info', 'output', 'swagger', 'sdk', 'export'},
+    'values': {'show'},
+}
+
+ANSI_REGEX = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+# Seconds forward() waits for a reply before running the command itself
+FORWARD_TIMEOUT = float(os.environ.get('MAKETOOLS_DAEMON_TIMEOUT', 60))
+
+
+def socketPath():
+  path = os.environ.get('MAKETOOLS_SOCKET')
+  if path:
+    return path
+  from .cache import cacheDir
+  return os.path.join(cacheDir(), 'daemon.sock')
+
+
+def requestEnv():
+  '''
+    Environment that changes command results (AWS profile/region etc.)
+  '''
+  return {k: v for k, v in os.environ.items() if k.startswith(('AWS_', 'MAKETOOLS_'))}
+
+
+def commandName(args):
+  return next((a for a in args if not a.startswith('-')), None)
+
+
+def call(request, timeout=None):
+  '''
+    Sends one request to the daemon and returns its reply (None if not
+    running or no reply within timeout)
+  '''
+  path = socketPath()
+  if not os.path.exists(path):
+    return None
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      sock.settimeout(timeout)
+      sock.connect(path)
+      sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+      with sock.makefile('rb') as f:
+        line = f.readline()
+  except OSError:
+    return None
+  return json.loads(line.decode('utf-8')) if line else None
+
+
+def forward(tool, args):
+  '''
+    Runs a command in the daemon if one is running and the command is safe
+
+    Returns exit code, or None if the caller should run the command itself
+    (also when the daemon does not answer within FORWARD_TIMEOUT; commands
+    it runs are read-only, so running again is safe).
+  '''
+  if os.environ.get('MAKETOOLS_NO_DAEMON'):
+    return None
+  if commandName(args) not in DAEMON_COMMANDS.get(tool, ()):
+    return None
+  reply = call({
+      'op': 'run',
+      'tool': tool,
+      'args': list(args),
+      'cwd': os.getcwd(),
+      'env': requestEnv(),
+      'tty': sys.stdout.isatty(),
+  }, timeout=FORWARD_TIMEOUT)
+  if not reply or reply.get('status') != 'ok':
+    return None
+  sys.stdout.write(reply['out'])
+  sys.stdout.flush()
+  sys.stderr.write(reply['err'])
+  return reply['rc']
+
+
+class Daemon:
+  '''
+    Unix socket server running commands for the given {tool: click group}
+  '''
+
+  def __init__(self, tools, idle=1800):
+    self.tools = tools
+    self.idle = idle
+    self.env = requestEnv()
+    self.started = time.time()
+    self.last = self.started
+    self.served = 0
+    self.running = True
+    self.children = set()
+
+  def run(self, request):
+    tool = self.tools.get(request.get('tool'))
+    args = request.get('args') or []
+    if (not tool or request.get('env') != self.env or
+        commandName(args) not in DAEMON_COMMANDS.get(request['tool'], ())):
+      return {'status': 'fallback'}
+
+    out = io.StringIO()
+    err = io.StringIO()
+    rc = 0
+    cwd = os.getcwd()
+    try:
+      os.chdir(request['cwd'])
+      with redirect_stdout(out), redirect_stderr(err):
+        try:
+          tool.main(args=args, prog_name=request['tool'] + '.py', standalone_mode=False)
+        except SystemExit as e:
+          rc = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+          show = getattr(e, 'show', None)
+          if show:
+            show()
+            rc = getattr(e, 'exit_code', 1)
+          else:
+            traceback.print_exc()
+            rc = 1
+    finally:
+      os.chdir(cwd)
+    text = out.getvalue()
+    if not request.get('tty'):
+      text = ANSI_REGEX.sub('', text)
+    return {'status': 'ok', 'rc': rc or 0, 'out': text, 'err': err.getvalue()}
+
+  def handle(self, request):
+    op = request.get('op')
+    if op == 'run':
+      return self.run(request)
+    if op == 'status':
+      return {
+          'status': 'ok',
+          'pid': os.getpid(),
+          'uptime': time.time() - self.started,
+          'served': self.served,
+          'running': len(self.children),
+      }
+    if op == 'stop':
+      self.running = False
+      return {'status': 'ok'}
+    return {'status': 'error', 'error': 'unknown op {}'.format(op)}
+
+  def reply(self, conn, reply):
+    with conn.makefile('wb') as f:
+      f.write(json.dumps(reply).encode('utf-8') + b'\n')
+      f.flush()
+
+  def fork(self, sock, conn, request):
+    '''
+      Runs request in a child process (sharing the warm imports) so requests
+      run in parallel and chdir/stdout redirection stay per request
+    '''
+    pid = os.fork()
+    if pid:
+      self.children.add(pid)
+      self.served += 1
+      return
+    code = 0
+    try:
+      sock.close()
+      self.reply(conn, self.run(request))
+    except Exception:
+      traceback.print_exc()
+      code = 1
+    finally:
+      os._exit(code)
+
+  def reap(self):
+    for pid in list(self.children):
+      try:
+        done, _ = os.waitpid(pid, os.WNOHANG)
+      except ChildProcessError:
+        done = pid
+      if done:
+        self.children.discard(pid)
+
+  def serve(self):
+    '''
+      Serves requests until stopped or idle for self.idle seconds
+
+      run requests are handled in forked children, the rest in this process.
+    '''
+    path = socketPath()
+    if os.path.exists(path):
+      os.unlink(path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      sock.bind(path)
+      os.chmod(path, 0o600)
+      sock.listen(64)
+      sock.settimeout(1)
+      try:
+        while self.running and time.time() - self.last < self.idle:
+          self.reap()
+          try:
+            conn, _ = sock.accept()
+          except socket.timeout:
+            continue
+          self.last = time.time()
+          with conn:
+            try:
+              conn.settimeout(10)
+              with conn.makefile('rb') as f:
+                request = json.loads(f.readline().decode('utf-8'))
+              conn.settimeout(None)
+              if request.get('op') == 'run':
+                self.fork(sock, conn, request)
+                continue
+              reply = self.handle(request)
+            except Exception as e:
+              reply = {'status': 'error', 'error': str(e)}
+            self.reply(conn, reply)
+      finally:
+        os.unlink(path)
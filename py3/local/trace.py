@@ -0,0 +1,218 @@
+# -*- mode: python3 -*-
+#
+# Timing of AWS calls and local phases (stack.py/values.py --profile or
+# MAKETOOLS_TRACE)
+#
+# AWS calls are recorded from botocore's event hooks on the shared session
+# (service, operation, region, latency, retries, throttles, bytes). Local
+# work is timed with phase(). Records go to a JSON lines file as they happen
+# (MAKETOOLS_TRACE=<path>) and a summary table is printed to stderr at exit.
+#
+# Only stdlib is imported here; phase() costs one check when tracing is off.
+#
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_tracer = None
+
+
+class Tracer:
+
+  def __init__(self, path=None):
+    self.records = []
+    self.started = time.perf_counter()
+    self.out = open(path, 'a', encoding='utf-8') if path else None
+    self.attached = []
+    # Wrapped once so unregister gets the same handlers register did
+    self._hooks = [(name, safeHook(fn)) for name, fn in [
+        ('before-call', self.beforeCall), ('needs-retry', self.needsRetry),
+        ('after-call', self.afterCall), ('after-call-error', self.afterCallError)]]
+
+  def hooks(self):
+    return self._hooks
+
+  def add(self, record):
+    record['ts'] = time.time()
+    with _lock:
+      self.records.append(record)
+      if self.out:
+        self.out.write(json.dumps(record, default=str) + '\n')
+
+  def attach(self, events):
+    '''
+      Registers hooks on a botocore event emitter (session.events, or
+      client.meta.events for clients created before tracing started since
+      each client copies the session's hooks)
+    '''
+    if any(e is events for e in self.attached):
+      return
+    self.attached.append(events)
+    for name, handler in self.hooks():
+      events.register(name, handler)
+
+  def detach(self):
+    for events in self.attached:
+      for name, handler in self.hooks():
+        events.unregister(name, handler)
+    self.attached = []
+
+  def beforeCall(self, model, context, request_signer=None, **kwargs):
+    context['traceStart'] = time.perf_counter()
+    context['traceRegion'] = getattr(request_signer, 'region_name', None)
+    context['traceThrottles'] = 0
+    # after-call-error gets no model, so keep what it needs in the context
+    context['traceService'] = model.service_model.service_name
+    context['traceOperation'] = model.name
+
+  def needsRetry(self, response=None, request_dict=None, **kwargs):
+    # response is (http response, parsed) when AWS answered
+    from .batch import THROTTLE_CODES
+    parsed = response[1] if response else {}
+    if parsed.get('Error', {}).get('Code') in THROTTLE_CODES and request_dict:
+      context = request_dict.get('context', {})
+      context['traceThrottles'] = context.get('traceThrottles', 0) + 1
+
+  def record(self, context, error=None, parsed=None, http_response=None):
+    start = context.get('traceStart')
+    if start is None:
+      return
+    meta = (parsed or {}).get('ResponseMetadata', {})
+    headers = getattr(http_response, 'headers', None) or {}
+    self.add({
+        'type': 'aws',
+        'service': context.get('traceService'),
+        'operation': context.get('traceOperation'),
+        'region': context.get('traceRegion'),
+        'ms': (time.perf_counter() - start) * 1000,
+        'status': meta.get('HTTPStatusCode') or getattr(http_response, 'status_code', None),
+        'retries': meta.get('RetryAttempts', 0),
+        'throttles': context.get('traceThrottles', 0),
+        'bytes': int(headers.get('content-length') or 0),
+        'error': error or (parsed or {}).get('Error', {}).get('Code'),
+    })
+
+  def afterCall(self, context, parsed=None, http_response=None, **kwargs):
+    self.record(context, parsed=parsed, http_response=http_response)
+
+  def afterCallError(self, context, exception=None, **kwargs):
+    self.record(context, error=type(exception).__name__)
+
+  def summary(self):
+    '''
+      Returns summary table rows (text) for AWS calls then phases
+    '''
+    from .utils import percentiles
+    from .console_util import bold, dim, red
+    groups = {}
+    for r in self.records:
+      key = (r['type'], r.get('service'), r.get('operation') or r.get('name'))
+      groups.setdefault(key, []).append(r)
+
+    total = time.perf_counter() - self.started
+    lines = [bold('{:<44} {:>6} {:>6} {:>6} {:>6} {:>9} {:>8} {:>8} {:>10}'.format(
+        'aws call / phase', 'calls', 'errors', 'retry', 'thrtl', 'total ms', 'p50', 'p95', 'bytes'))]
+    rows = sorted(groups.items(), key=lambda g: (g[0][0] != 'aws', -sum(r['ms'] for r in g[1])))
+    for (kind, service, name), recs in rows:
+      ms = [r['ms'] for r in recs]
+      p = percentiles(ms, (50, 95))
+      errors = sum(1 for r in recs if r.get('error'))
+      line = '{:<44} {:>6} {:>6} {:>6} {:>6} {:>9.0f} {:>8.1f} {:>8.1f} {:>10}'.format(
+          '{}.{}'.format(service, name) if kind == 'aws' else name, len(recs), errors,
+          sum(r.get('retries', 0) for r in recs), sum(r.get('throttles', 0) for r in recs),
+          sum(ms), p[50], p[95], sum(r.get('bytes', 0) for r in recs) if kind == 'aws' else '')
+      lines.append(red(line) if errors else line)
+    lines.append(dim('{} records, {:.0f} ms wall'.format(len(self.records), total * 1000)))
+    return lines
+
+  def finish(self):
+    import click
+    self.detach()
+    for line in self.summary():
+      click.echo(line, err=True)
+    if self.out:
+      self.out.close()
+
+
+def safeHook(fn):
+  '''
+    Wraps a botocore hook so a tracing bug can never break or mask the call
+  '''
+  def hook(**kwargs):
+    try:
+      fn(**kwargs)
+    except Exception:
+      pass
+  return hook
+
+
+def start(path=None):
+  '''
+    Starts tracing (JSON lines are appended to path if given)
+
+    Returns the tracer; call finish() on it at exit to print the summary.
+  '''
+  global _tracer
+  if _tracer is None:
+    _tracer = Tracer(path)
+    from . import aws
+    if aws._session is not None:
+      _tracer.attach(aws._session.events)
+    for client in list(aws._clients.values()):
+      _tracer.attach(client.meta.events)
+  return _tracer
+
+
+def startFromOptions(ctx, profile):
+  '''
+    Starts tracing for --profile or MAKETOOLS_TRACE (1 = summary only,
+    anything else is the JSON lines path) and prints the summary when ctx
+    closes
+  '''
+  env = os.environ.get('MAKETOOLS_TRACE')
+  if not profile and not env:
+    return None
+  tracer = start(env if env and env != '1' else None)
+  ctx.call_on_close(finish)
+  return tracer
+
+
+def attach(session):
+  '''
+    Called by aws.session() so sessions created after start() are traced
+  '''
+  if _tracer is not None:
+    _tracer.attach(session.events)
+
+
+def finish():
+  global _tracer
+  tracer, _tracer = _tracer, None
+  if tracer:
+    tracer.finish()
+
+
+@contextmanager
+def phase(name, **extra):
+  '''
+    Times a block of local work (no-op unless tracing)
+  '''
+  if _tracer is None:
+    yield
+    return
+  start = time.perf_counter()
+  error = None
+  try:
+    yield
+  except BaseException as e:
+    error = type(e).__name__
+    raise
+  finally:
+    record = {'type': 'phase', 'name': name, 'ms': (time.perf_counter() - start) * 1000, 'error': error}
+    record.update(extra)
+    if _tracer is not None:
+      _tracer.add(record)
@@ -1,13 +1,73 @@
 #!/usr/bin/env python3
 # -*- mode: python3 -*-
 
+import codecs
+import hashlib
+import marshal
+import math
+import os
+import tempfile
 import yaml
+from contextlib import contextmanager
+from .cache import cacheDir
+from .trace import phase
 
+# LibYAML bindings are many times faster; pure Python loader if not built
+try:
+  from yaml import CSafeLoader as SafeLoader
+except ImportError:
+  from yaml import SafeLoader
 
-def loadYaml(fileName):
+
+def parseYaml(stream):
+  return yaml.load(stream, Loader=SafeLoader)
+
+
+@phase('yaml load')
+def loadYaml(fileName, cache=True):
+  """
+    Loads YAML file, reusing a marshal of the parsed document when the file
+    (path, mtime, size) has not changed since it was last parsed
+
+    The document can hold secrets ("!" values, secrets:), so cache files are
+    0600 in a 0700 directory and are only read when owned by this user.
+    Documents marshal cannot hold (dates, ...) are not cached.
+  """
   #debug("Loading %s" % fileName, 2)
-  with open(fileName, "r") as stream:
-    return yaml.load(stream, Loader=yaml.FullLoader)
+  if not cache:
+    with open(fileName, "r") as stream:
+      return parseYaml(stream)
+
+  path = os.path.abspath(fileName)
+  st = os.stat(path)
+  stamp = (path, st.st_mtime_ns, st.st_size)
+  key = hashlib.sha256(path.encode('utf-8')).hexdigest()
+  cacheRoot = cacheDir('yaml')
+  os.chmod(cacheRoot, 0o700)
+  cached = os.path.join(cacheRoot, key + '.marshal')
+  try:
+    with open(cached, 'rb') as f:
+      if os.fstat(f.fileno()).st_uid == os.getuid():
+        cachedStamp, ob = marshal.load(f)
+        if tuple(cachedStamp) == stamp:
+          return ob
+  except (OSError, EOFError, ValueError, TypeError):
+    pass
+
+  with open(path, "r") as stream:
+    ob = parseYaml(stream)
+  try:
+    data = marshal.dumps((stamp, ob))
+  except ValueError:
+    return ob
+  with atomicWrite(cached, binary=True, mode=0o600) as f:
+    f.write(data)
+  # Drop the plaintext pickle older versions left behind
+  try:
+    os.unlink(os.path.join(cacheRoot, key + '.pickle'))
+  except FileNotFoundError:
+    pass
+  return ob
 
 
 def nest(path, val={}):
@@ -46,14 +106,125 @@ def flattenx(ob, prefix):
   return flat
 
 
+def iterFlat(ob, prefix=''):
+  """
+    Yields (path, value) for every leaf, depth first, without recursion
+
+    iterFlat({'a': {'b': 1}, 'c': 2}, '/') => ('/a/b', 1), ('/c', 2)
+
+    Path segments live in one buffer that is pushed/popped while walking, so
+    memory is bounded by depth and nothing is copied between levels.
+  """
+  path = [prefix]
+  stack = [iter(ob.items())]
+  while stack:
+    for key, val in stack[-1]:
+      if isinstance(val, dict):
+        path.append(str(key) + '/')
+        stack.append(iter(val.items()))
+        break
+      path.append(str(key))
+      yield ''.join(path), val
+      path.pop()
+    else:
+      stack.pop()
+      path.pop()
+
+
+@phase('flatten')
 def flatten(ob, prefix=''):
-  flat={}
-  for key, val in ob.items():
-    cprefix = prefix + key
-    if isinstance(val, dict):
-      sub=flatten(val, cprefix + '/')
-      for skey, sval in sub.items():
-        flat[skey] = sval
+  return dict(iterFlat(ob, prefix))
+
+
+def unflatten(pairs, dest=None):
+  """
+    Inverse of iterFlat: builds (or merges into dest) a tree in one pass
+
+    unflatten([('/a/b', 1), ('/c', 2)]) => {'a': {'b': 1}, 'c': 2}
+
+    Same result as merge(nest(path, val), dest) per pair without building
+    the intermediate trees. A path with no segments ('' or '/') is an error.
+  """
+  root = {} if dest is None else dest
+  for path, val in pairs:
+    parts = [p for p in path.split('/') if p]
+    if not parts:
+      raise ValueError('Cannot unflatten empty path {!r}'.format(path))
+    node = root
+    for key in parts[:-1]:
+      child = node.get(key)
+      if not isinstance(child, dict):
+        child = node[key] = {}
+      node = child
+    node[parts[-1]] = val
+  return root
+
+
+@contextmanager
+def atomicWrite(path, binary=False, mode=None):
+  """
+    Opens a temp file next to path and renames it over path when the block
+    completes (on error path is left untouched and the temp file removed)
+
+    File mode is mode if given, else that of the existing file (or 0644).
+  """
+  path = os.path.abspath(path)
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.{}.'.format(os.path.basename(path)))
+  try:
+    if mode is None:
+      mode = os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644
+    os.chmod(tmp, mode)
+    if binary:
+      f = os.fdopen(fd, 'wb')
     else:
-      flat[prefix + key] = val
-  return flat
+      f = os.fdopen(fd, 'w', encoding='utf-8', newline='')
+    with f:
+      yield f
+    os.replace(tmp, path)
+  except BaseException:
+    if os.path.exists(tmp):
+      os.unlink(tmp)
+    raise
+
+
+def decodeStream(chunks, encoding='utf-8'):
+  """
+    Decodes byte chunks incrementally (multibyte characters may span chunks)
+  """
+  decoder = codecs.getincrementaldecoder(encoding)()
+  for chunk in chunks:
+    text = decoder.decode(chunk)
+    if text:
+      yield text
+  text = decoder.decode(b'', final=True)
+  if text:
+    yield text
+
+
+def replaceStream(chunks, old, new):
+  """
+    Yields text chunks with old replaced by new, including occurrences that
+    span chunk boundaries (same result as str.replace on the joined text)
+  """
+  tail = ''
+  for chunk in chunks:
+    pieces = (tail + chunk).split(old)
+    last = pieces[-1]
+    # Hold back the longest suffix that could be the start of old
+    keep = next((k for k in range(min(len(last), len(old) - 1), 0, -1) if last.endswith(old[:k])), 0)
+    pieces[-1] = last[:len(last) - keep]
+    tail = last[len(last) - keep:]
+    yield new.join(pieces)
+  if tail:
+    yield tail
+
+
+def percentiles(samples, points=(50, 95, 99)):
+  """
+    Nearest-rank percentiles of samples as {point: value} (empty if no samples)
+  """
+  ordered = sorted(samples)
+  if not ordered:
+    return {}
+  n = len(ordered)
+  return {p: ordered[min(n - 1, max(0, math.ceil(p / 100 * n) - 1))] for p in points}
@@ -1,69 +1,58 @@
 #!/usr/bin/env python3
 # -*- mode: python3 -*-
 
+import sys
+if __name__ == "__main__":
+  # Run in daemon.py (if started) before paying for imports below
+  from local.server import forward
+  rc = forward('stack', sys.argv[1:])
+  if rc is not None:
+    sys.exit(rc)
+
 import click
 from local.cfn_util import *
 from local.console_util import *
-import base64
-import pycurl
-from io import BytesIO
-from urllib.parse import urlencode
-from oauthlib.oauth2 import BackendApplicationClient
-from requests.auth import HTTPBasicAuth
-from requests_oauthlib import OAuth2Session
-
-def getToken(token_url, client_id, client_secret, scope):
-  '''
-    Retrieves token from OAuth2 token endpoint
-  '''
-  auth = HTTPBasicAuth(client_id, client_secret)
-  client = BackendApplicationClient(client_id=client_id)
-  oauth = OAuth2Session(client=client, scope=scope)
-  token = oauth.fetch_token(token_url=token_url, auth=auth)
-  return token
-
-def getTokenPyCurl(endpoint, authToken, scope):
-  '''
-    Retrieves token from OAuth2 token endpoint
-  '''
-  curl = pycurl.Curl()
-  curl.setopt(curl.VERBOSE, True)
-  curl.setopt(curl.URL, endpoint)
-  curl.setopt(curl.HTTPHEADER, [
-    "Authorization: Basic {}".format(authToken),
-    "Content-Type: application/x-www-form-urlencoded"
-  ])
-
-  postData = {
-    "grant_type": "client_credentials",
-    "scope": scope
-  }
-  curl.setopt(curl.POSTFIELDS, urlencode(postData))
-  buf = BytesIO()
-  curl.setopt(curl.WRITEDATA, buf)
-  curl.perform()
-  code = curl.getinfo(pycurl.RESPONSE_CODE)
-  curl.close()
-  return (code, buf.getvalue().decode('utf-8'))
+from local.batch import runAll
+from local.fanout import FanOutGroup, splitList
+from local.oauth import getToken
+from local.utils import atomicWrite, percentiles
+from local.trace import startFromOptions
+from local.deploy import DEFAULT_CAPABILITIES, deployStack, loadSpec, resolveParams
+from local.dag import Node, runGraph
+import json
+import time
+from functools import partial
 
 def getStackInfo(stack_name):
   if not stack_name:
     print('Please specifiy a stack name')
     info = getStackNames()
-    active=['CREATE_COMPLETE', 'UPDATE_COMPLETE']
     for (name, status) in info:
-      col = blue if status in active else dim
+      col = blue if status in ACTIVE_STATUSES else dim
       print(col(name), dim(status))
     return
   return getStackOutputDict(stack_name)
 
 
-@click.group()
-def stack():
+@click.group(cls=FanOutGroup)
+@click.option('--stacks', callback=splitList, help='Run command for each stack (comma separated)')
+@click.option('--regions', callback=splitList, help='Run command in each region (comma separated)')
+@click.option('-j', '--jobs', default=8, help='max concurrent stacks/regions')
+@click.option('--profile', is_flag=True, help='Print AWS call and phase timings (JSON lines to $MAKETOOLS_TRACE)')
+@click.pass_context
+def stack(ctx, stacks, regions, jobs, profile):
   '''
     Stack helper tool
+
+    With --stacks/--regions the command runs for every (stack, region) pair
+    concurrently, e.g.:
+
+      ./stack.py --stacks orders-dev,orders-prod --regions us-east-1,us-west-2 info
+
+    With --profile (or MAKETOOLS_TRACE=1, or =<file> to also write JSON
+    lines) every AWS call and local phase is timed and summarized at exit.
   '''
-  pass
+  startFromOptions(ctx, profile)
 
 #
 # SSM
@@ -72,32 +61,76 @@ def stack():
 @click.command()
 @click.option('-p', '--prompt/--no-prompt', default=True, help='enable prompts')
 @click.option('-r', '--remove', is_flag=True, help='Remove instead of update')
+@click.option('-a', '--all', 'allClients', is_flag=True, help='All app clients (with a secret) in the pool')
+@click.option('-j', '--jobs', default=8, help='max concurrent Cognito/SSM calls')
+@click.option('--disk-cache', 'disk', is_flag=True, help='Reuse client descriptions saved on disk (private file)')
 @click.argument('stack_name', required=False)
-def ssm(stack_name, remove, prompt):
+def ssm(stack_name, remove, prompt, allClients, jobs, disk):
   """
     Adds or removes ssm entry for test client ID (FullUser)
+
+    With --all syncs every app client in the pool: clients are listed once
+    and described concurrently, then SSM entries are written in parallel.
   """
 
   si = getStackInfo(stack_name)
   if not si:
     return
 
-  ci = getApiClientInfo(si['PoolArn'], si['ClientIdFullUser'])
-  dump(ci)
+  if not allClients:
+    ci = getApiClientInfo(si['PoolArn'], si['ClientIdFullUser'])
+    dump(ci)
 
-  if remove:
-    deleteSsm(ci, prompt)
-  else:
-    putSsm(ci, prompt)
+    if remove:
+      deleteSsm(ci, prompt)
+    else:
+      putSsm(ci, prompt)
+    return
+
+  clients = getPoolClients(si['PoolArn'], jobs, disk=disk)
+  results = syncSsm(sorted(clients.values(), key=lambda c: c['name']), prompt, remove=remove, workers=jobs)
+  for r in results:
+    if r.ok:
+      print(green('{} {}'.format(r.key, r.value or 'ok')))
+    else:
+      print(red('{} failed: {}'.format(r.key, r.error)))
+  if any(not r.ok for r in results):
+    sys.exit(1)
 
 
 #
 # INFO
 #
 
+def printStack(stack, fmt):
+  '''
+    Prints one describe_stacks entry as table rows, a JSON line or a YAML document
+  '''
+  name = stack['StackName']
+  status = stack['StackStatus']
+  outputs = outputDict(stack)
+  if fmt == 'table':
+    col = blue if status in ACTIVE_STATUSES else dim
+    print(col(name), dim(status))
+    for key, val in sorted(outputs.items()):
+      print('  {}: {}'.format(key, val))
+  else:
+    ob = {'name': name, 'status': status, 'updated': stackUpdated(stack), 'outputs': outputs}
+    if fmt == 'json':
+      print(json.dumps(ob, sort_keys=True))
+    else:
+      print('---')
+      print(asYaml(ob), end='')
+  sys.stdout.flush()
+
+
 @click.command()
+@click.option('-a', '--all', 'all_', is_flag=True, help='Show outputs for every stack')
+@click.option('-m', '--match', help='Show outputs for stacks matching glob (e.g. "orders-*")')
+@click.option('-s', '--status', multiple=True, help='Only stacks with this status (repeatable)')
+@click.option('-o', '--output', 'fmt', type=click.Choice(['table', 'json', 'yaml']), default='table', help='format for --all/--match')
 @click.argument('stack_name', required=False)
-def info(stack_name):
+def info(stack_name, all_, match, status, fmt):
   """
     Shows stack outputs
 
@@ -105,8 +138,17 @@ def info(stack_name):
 
       /stack.py info orders-dev
 
+    Many stacks in one pass (streamed as DescribeStacks pages arrive):
+
+      /stack.py info --match 'orders-*' -o json
+
   """
 
+  if all_ or match:
+    for s in iterStacks(match, status):
+      printStack(s, fmt)
+    return
+
   si = getStackInfo(stack_name)
   if not si:
     return
@@ -114,6 +156,98 @@ def info(stack_name):
   print
   dump(si)
 
+#
+# EVENTS
+#
+
+def printEvent(e, root):
+  '''
+    Prints one stored event row (nested stack names shown in brackets)
+  '''
+  status = e['status'] or ''
+  if 'FAILED' in status:
+    col = bred
+  elif status.endswith('IN_PROGRESS'):
+    col = blue
+  elif 'ROLLBACK' in status:
+    col = red
+  else:
+    col = green
+  where = '' if e['stackName'] == root else dim('[{}] '.format(e['stackName']))
+  line = '{} {}{:<40} {}'.format(dim(e['timestamp'][11:19]), where, e['logicalId'] or '', col(status))
+  if e['reason']:
+    line += ' ' + dim(e['reason'])
+  print(line)
+  sys.stdout.flush()
+
+
+@click.command()
+@click.option('-f', '--follow', is_flag=True, help='Keep polling for new events (fast while IN_PROGRESS)')
+@click.option('-x', '--exit-when-done', is_flag=True, help='With --follow, exit once the stack finishes (1 on failure)')
+@click.option('-F', '--failed-only', is_flag=True, help='Only FAILED events')
+@click.option('-n', '--limit', default=50, help='max past events shown (0 = all stored)')
+@click.option('--nested/--no-nested', default=True, help='Include nested stacks')
+@click.option('-j', '--jobs', default=8, help='max concurrent stacks read')
+@click.argument('stack_name')
+def events(stack_name, follow, exit_when_done, failed_only, limit, nested, jobs):
+  '''
+    Shows stack events (and nested stacks' events)
+
+    Only events newer than the last one seen are read from CloudFormation;
+    the rest come from the local cache. Example (errors of last deploy):
+
+      ./stack.py events -F orders-dev
+
+    Follow a deploy until it finishes:
+
+      ./stack.py events -f -x orders-dev
+  '''
+  follower = EventFollower(stack_name, nested, jobs)
+  follower.poll()
+  for e in follower.history(failed_only, limit or None):
+    printEvent(e, stack_name)
+  follower.commit()
+  if not follow:
+    return
+
+  def onEvent(e):
+    if not failed_only or 'FAILED' in (e['status'] or ''):
+      printEvent(e, stack_name)
+
+  try:
+    status = followEvents(follower, onEvent, exit_when_done)
+  except KeyboardInterrupt:
+    return
+  print(bold('{} {}'.format(stack_name, status)))
+  if isFailedStatus(status):
+    sys.exit(1)
+
+
+#
+# OUTPUT
+#
+
+@click.command()
+@click.option('-t', '--ttl', default=STACK_TTL, help='max age of cached outputs in seconds (0 = always fetch)')
+@click.argument('stack_name')
+@click.argument('keys', nargs=-1, required=True)
+def output(stack_name, keys, ttl):
+  """
+    Prints stack output value(s), one per line
+
+    Outputs are cached (MAKETOOLS_STACK_TTL) so make can call this per key. Example:
+
+      ./stack.py output orders-dev ApiId
+  """
+
+  si = getStackOutputDict(stack_name, ttl, verbose=False)
+  missing = [k for k in keys if k not in si]
+  if missing:
+    click.echo('No output {} in {}'.format(', '.join(missing), stack_name), err=True)
+    sys.exit(1)
+  for k in keys:
+    print(si[k])
+
 ###
 #
 # COGNITO
@@ -122,8 +256,9 @@ def info(stack_name):
 
 #
 @click.command()
+@click.option('--no-cache', 'noCache', is_flag=True, help='Fetch a new token even if a cached one is valid')
 @click.argument('stack_name', required=False)
-def cognito(stack_name):
+def cognito(stack_name, noCache):
   """
     Shows cognito info, app client and related info (assumes stack output names)
 
@@ -133,6 +268,9 @@ def cognito(stack_name):
       PoolDomainName
       ClientIdFullUser
 
+    Tokens are cached (private files under the cache dir) until shortly
+    before they expire.
+
     /stack.py cognito global-clientcreds-dev
   """
 
@@ -152,7 +290,7 @@ def cognito(stack_name):
   endpoint='https://{}/oauth2/token'.format(adi['name'])
 
   try:
-    token = getToken(endpoint, ci['id'], ci['secret'], ['orders/rw'])
+    token = getToken(endpoint, ci['id'], ci['secret'], ['orders/rw'], cache=not noCache)
     print(token)
   except Exception as e:
     print(e)
@@ -160,43 +298,272 @@ def cognito(stack_name):
       print(red('Hint: Go to Cognito->App Client Settings and toggle "Enabled Identity Providers"'))
 
 
+def printLatency(name, results, elapsed=None):
+  '''
+    Prints count, error rate and p50/p95/p99 for timed() results
+  '''
+  times = [r.value[1] for r in results if r.ok]
+  errors = len(results) - len(times)
+  line = '{:<8} n={:<6} errors={} ({:.1%})'.format(name, len(results), errors, errors / max(1, len(results)))
+  for p, t in percentiles(times).items():
+    line += '  p{}={:.0f}ms'.format(p, t * 1000)
+  if elapsed:
+    line += '  {:.1f}/s'.format(len(results) / elapsed)
+  print((red if errors else bold)(line))
+
+
+@click.command()
+@click.option('-c', '--client', 'clients', multiple=True, help='app client id (repeatable, default ClientIdFullUser output)')
+@click.option('-s', '--scope', 'scopes', multiple=True, help='scope (repeatable, default orders/rw)')
+@click.option('-n', '--count', default=1, help='tokens per client and scope')
+@click.option('-j', '--jobs', default=8, help='max concurrent requests')
+@click.option('--cached', is_flag=True, help='Allow cached tokens (default always mints new ones)')
+@click.option('-o', '--out', type=click.Path(dir_okay=False), help='Write tokens to file (JSON lines)')
+@click.argument('stack_name', required=False)
+def tokens(stack_name, clients, scopes, count, jobs, cached, out):
+  '''
+    Mints client credentials tokens concurrently (load generation/benchmark)
+
+    Looks up each app client secret, then requests count tokens for every
+    client and scope. Prints error rate and latency percentiles for the
+    client lookups and the token endpoint. Example:
+
+      ./stack.py tokens -c id1 -c id2 -s orders/rw -s orders/r -n 100 -j 32 global-clientcreds-dev
+
+    Works with the same stack outputs as cognito.
+  '''
+  si = getStackInfo(stack_name)
+  if not si:
+    return
+
+  clients = list(clients) or [si['ClientIdFullUser']]
+  scopes = list(scopes) or ['orders/rw']
+  endpoint = 'https://{}/oauth2/token'.format(si['ClientCredentialsDevDomainName'])
+
+  lookups = runAll([(c, timed(partial(getApiClientInfo, si['PoolArn'], c))) for c in clients], jobs)
+  infos = [r.value[0] for r in lookups if r.ok]
+  for r in lookups:
+    if not r.ok:
+      print(red('{} lookup failed: {}'.format(r.key, r.error)))
+
+  tasks = []
+  for ci in infos:
+    for scope in scopes:
+      fn = partial(getToken, endpoint, ci['id'], ci['secret'], [scope], cache=cached)
+      tasks.extend(((ci['id'], scope), timed(fn)) for i in range(count))
+  # Failures are counted, not retried
+  start = time.perf_counter()
+  results = runAll(tasks, jobs, retries=0)
+  elapsed = time.perf_counter() - start
+
+  errors = {}
+  for r in results:
+    if not r.ok:
+      errors[str(r.error)] = errors.get(str(r.error), 0) + 1
+  for message, n in sorted(errors.items(), key=lambda e: -e[1])[:5]:
+    print(red('{:>6} x {}'.format(n, message)))
+  if out:
+    with atomicWrite(out, mode=0o600) as f:
+      for r in results:
+        if r.ok:
+          client, scope = r.key
+          f.write(json.dumps({'client': client, 'scope': scope, 'token': r.value[0]}) + '\n')
+  printLatency('lookup', lookups)
+  printLatency('token', results, elapsed)
+  if errors or len(infos) < len(clients):
+    sys.exit(1)
+
+
 # See swagger issues here:
 #  https://docs.aws.amazon.com/apigateway/latest/developerguide/api-gateway-known-issues.html#api-gateway-known-issues-rest-apis
 
 @click.command()
 @click.option('-d', '--directory', default='.', help='output directory')
 @click.option('-e', '--ext', type=click.Choice(ExtensionVals), default=Extension.none.name, help='extention type')
+@click.option('-f', '--force', is_flag=True, help='Download even if the stage has not been redeployed')
 @click.argument('stack_name', required=False)
-def swagger(stack_name, directory, ext):
+def swagger(stack_name, directory, ext, force):
   '''
     Fetches swagger from API GW
 
     Works with stack that exports:
       ApiId
       ApiStage
+
+    Skipped (file left untouched) if the stage deployment matches the last export.
   '''
   si = getStackInfo(stack_name)
   if not si:
     return
 
-  exportSwagger(stack_name, si['ApiId'], si['ApiStage'], directory, ext)
+  exportSwagger(stack_name, si['ApiId'], si['ApiStage'], directory, ext, force)
 
 @click.command()
 @click.option('-d', '--directory', default='.', help='output directory')
+@click.option('-f', '--force', is_flag=True, help='Download even if the stage has not been redeployed')
 @click.argument('stack_name', required=False)
-def sdk(stack_name, directory):
+def sdk(stack_name, directory, force):
   '''
     Fetches sdk from API GW (openapi generator is better)
 
     Works with stack that exports:
       ApiId
       ApiStage
+
+    Skipped (file left untouched) if the stage deployment matches the last export.
   '''
   si = getStackInfo(stack_name)
   if not si:
     return
 
-  exportSdk(stack_name, si['ApiId'], si['ApiStage'], directory)
+  exportSdk(stack_name, si['ApiId'], si['ApiStage'], directory, force)
+
+SDK_TYPES = ['javascript', 'android', 'objectivec', 'swift', 'ruby']
+
+def timed(fn):
+  '''
+    Wraps fn to return (result, seconds)
+  '''
+  def run():
+    start = time.perf_counter()
+    return fn(), time.perf_counter() - start
+  return run
+
+@click.command()
+@click.option('-d', '--directory', default='.', help='output directory')
+@click.option('-a', '--all-variants', is_flag=True, help='All swagger extension types')
+@click.option('-e', '--ext', type=click.Choice(ExtensionVals), multiple=True, help='swagger extension type (repeatable)')
+@click.option('-s', '--sdk-type', type=click.Choice(SDK_TYPES), multiple=True, help='sdk type (repeatable)')
+@click.option('-p', '--sdk-param', multiple=True, help='sdk setting KEY=VALUE (repeatable, e.g. groupId=com.foo for android)')
+@click.option('-f', '--force', is_flag=True, help='Download even if the stage has not been redeployed')
+@click.option('-j', '--jobs', default=8, help='max concurrent downloads')
+@click.argument('stack_name', required=False)
+def export(stack_name, directory, all_variants, ext, sdk_type, sdk_param, force, jobs):
+  '''
+    Fetches several swagger variants and sdks from API GW concurrently
+
+    Resolves stack outputs once. Example (all swagger flavors plus JS sdk):
+
+      ./stack.py export -a -s javascript orders-dev
+
+    Works with stack that exports:
+      ApiId
+      ApiStage
+  '''
+  si = getStackInfo(stack_name)
+  if not si:
+    return
+
+  exts = ExtensionVals if all_variants else list(ext)
+  if not exts and not sdk_type:
+    exts = [Extension.none.name]
+
+  apiId, apiStage = si['ApiId'], si['ApiStage']
+  sdkParams = dict(p.split('=', 1) for p in sdk_param)
+  # One GetStage for every artifact's up-to-date check
+  stage = getStage(apiId, apiStage)
+  tasks = []
+  for e in exts:
+    fn = partial(exportSwagger, stack_name, apiId, apiStage, directory, e, force, stage)
+    tasks.append(('swagger ({})'.format(e), timed(fn)))
+  for t in sdk_type:
+    fn = partial(exportSdk, stack_name, apiId, apiStage, directory, force, t, sdkParams, stage)
+    tasks.append(('sdk ({})'.format(t), timed(fn)))
+
+  start = time.perf_counter()
+  results = runAll(tasks, jobs)
+  print()
+  for r in results:
+    if not r.ok:
+      print(red('{:<22} failed: {}'.format(r.key, r.error)))
+      continue
+    written, elapsed = r.value
+    col = green if written else dim
+    print(col('{:<22} {:<10} {:7.2f}s'.format(r.key, 'saved' if written else 'up to date', elapsed)))
+  print(bold('{:<33} {:7.2f}s'.format('total', time.perf_counter() - start)))
+  if any(not r.ok for r in results):
+    sys.exit(1)
+
+
+#
+# DEPLOY
+#
+
+def parseParams(ctx, param, value):
+  '''
+    click callback: ('A=1', 'B=x') => {'A': '1', 'B': 'x'}
+  '''
+  try:
+    return dict(v.split('=', 1) for v in value)
+  except ValueError:
+    raise click.BadParameter('expected KEY=VALUE')
+
+
+@click.command()
+@click.option('-t', '--template', type=click.Path(exists=True, dir_okay=False), help='template file (single stack)')
+@click.option('-P', '--parameter', 'params', multiple=True, callback=parseParams, help='KEY=VALUE (repeatable; with --spec added to every stack)')
+@click.option('-s', '--spec', type=click.Path(exists=True, dir_okay=False), help='multi-stack spec (see local/deploy.py)')
+@click.option('-c', '--capability', 'capabilities', multiple=True, help='capability (repeatable, default IAM, NAMED_IAM and AUTO_EXPAND)')
+@click.option('-b', '--s3-bucket', help='bucket for templates over 51200 bytes')
+@click.option('--execute/--no-execute', default=True, help='Execute the change set (else leave it for review)')
+@click.option('-f', '--force', is_flag=True, help='Create a change set even if nothing changed since the last deploy')
+@click.option('-k', '--keep-going', is_flag=True, help='With --spec, deploy what does not depend on a failed stack')
+@click.option('-j', '--jobs', default=4, help='max stacks deployed at once (--spec)')
+@click.argument('stack_names', nargs=-1)
+def deploy(stack_names, template, params, spec, capabilities, s3_bucket, execute, force, keep_going, jobs):
+  '''
+    Deploys stack(s) through change sets
+
+    Skipped when template, parameters and capabilities match the last
+    deploy; an empty change set is discarded. Execution is followed with
+    adaptive polling and ends with a per-resource timing breakdown.
+
+      ./stack.py deploy -t .packaged.yaml -P Env=dev orders-dev
+
+    With --spec, every stack in the spec (or just the STACK_NAMES given)
+    is deployed; stacks whose parameters use another stack's outputs wait
+    for it, the rest run in parallel.
+  '''
+  capabilities = list(capabilities) or DEFAULT_CAPABILITIES
+  if not spec:
+    if not template or len(stack_names) != 1:
+      raise click.UsageError('Give --template and one stack name (or --spec)')
+    try:
+      result = deployStack(stack_names[0], template, params, capabilities, s3_bucket, execute, force)
+    except Exception as e:
+      raise click.ClickException(str(e))
+    print(bold('{}: {}'.format(stack_names[0], result)))
+    return
+
+  stacks = loadSpec(spec)
+  wanted = list(stack_names) or list(stacks)
+  unknown = [s for s in wanted if s not in stacks]
+  if unknown:
+    raise click.UsageError('Not in {}: {}'.format(spec, ', '.join(unknown)))
+
+  results = {}
+  def deployer(name, s):
+    def run(emit):
+      values = resolveParams(dict(s['parameters'], **params))
+      results[name] = deployStack(name, s['template'], values, capabilities, s3_bucket, execute, force, emit)
+    return run
+
+  # Dependencies outside the selection are assumed deployed already
+  nodes = [Node(name, deployer(name, stacks[name]), None, [d for d in stacks[name]['deps'] if d in wanted])
+           for name in wanted]
+  start = time.perf_counter()
+  outcomes = runGraph(nodes, jobs, keep_going)
+  print()
+  for o in outcomes:
+    if o.status == 'ok':
+      print(green('{:<30} {:<20} {:7.1f}s'.format(o.name, results.get(o.name, ''), o.elapsed)))
+    elif o.status == 'failed':
+      print(red('{:<30} {:<20} {:7.1f}s'.format(o.name, 'failed', o.elapsed)))
+    else:
+      print(dim('{:<30} skipped'.format(o.name)))
+  print(bold('{:<51} {:7.1f}s'.format('total', time.perf_counter() - start)))
+  if any(o.status != 'ok' for o in outcomes):
+    sys.exit(1)
 
 
 #
@@ -207,31 +574,60 @@ def sdk(stack_name, directory):
 
 @click.command()
 @click.option('-p', '--prompt/--no-prompt', default=True, help='enable prompts')
-@click.option(
-    '-r',
-    '--remove',
-    is_flag=True,
-    default=False,
-    help='Remove instead of update')
-@click.option('-s', '--stack-name', default='orders', help='stack name')
-#@click.argument('key', nargs=-1, type=click.Choice(['foo','bar']))
-def route53(stack_name, remove, prompt):
-
-  global enablePrompts
-  enablePrompts = prompt
-
-  si = StackInfo(stack_name)
-  di = si.getAuthDomainInfo()
-  # TODO can we fix script so remove doesn't depend on stack output? (query route53 only)
-  modifyUserPoolDomainRoute53AliasEntry(di, not remove)
-
-
-# stack.add_command(route53)
+@click.option('-r', '--remove', is_flag=True, help='Remove instead of update')
+@click.option('-d', '--domain', 'domains', multiple=True, help='user pool domain (repeatable, instead of stack outputs)')
+@click.option('-k', '--output-key', default='ClientCredentialsDevDomainName', help='stack output holding the domain')
+@click.option('-w', '--wait/--no-wait', default=True, help='wait until changes are INSYNC')
+@click.option('-j', '--jobs', default=8, help='max concurrent Route53/Cognito calls')
+@click.argument('stack_names', nargs=-1)
+def route53(stack_names, domains, output_key, remove, prompt, wait, jobs):
+  '''
+    Adds or removes Route53 A record aliases for user pool domains
+
+    Domains come from each stack's output (--output-key) and/or --domain.
+    Changes are batched per hosted zone and, with --wait, polled until
+    INSYNC. Example:
+
+      ./stack.py route53 --no-prompt auth-dev auth-prod
+  '''
+  domains = list(domains)
+  for r in runAll([(s, partial(getStackOutputDict, s)) for s in stack_names], jobs):
+    if not r.ok:
+      raise click.ClickException('{}: {}'.format(r.key, r.error))
+    domains.append(r.value[output_key])
+  if not domains:
+    raise click.UsageError('No stack or domain given')
+
+  infos = runAll([(d, partial(getAuthDomainInfo, d)) for d in domains], jobs)
+  failed = [r for r in infos if not r.ok]
+  for r in failed:
+    print(red('{} failed: {}'.format(r.key, r.error)))
+  submitted, synced = syncAliases([r.value for r in infos if r.ok], not remove, prompt, wait, jobs)
+
+  failed += [r for r in submitted + synced if not r.ok]
+  for r in submitted:
+    if not r.ok:
+      print(red('{} ({}) failed: {}'.format(r.key[0], ', '.join(r.key[1]), r.error)))
+  for r in synced:
+    if r.ok:
+      print(green('{} INSYNC after {:.1f}s'.format(r.key, r.value)))
+    else:
+      print(red('{} failed: {}'.format(r.key, r.error)))
+  if failed:
+    sys.exit(1)
+
+
+stack.add_command(route53)
 stack.add_command(info)
+stack.add_command(output)
+stack.add_command(events)
+stack.add_command(deploy)
 stack.add_command(cognito)
+stack.add_command(tokens)
 stack.add_command(ssm)
 stack.add_command(swagger)
 stack.add_command(sdk)
+stack.add_command(export)
 
 if __name__ == "__main__":
   stack()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,129 @@
+# -*- mode: python3 -*-
+#
+# python3 -m unittest discover -s tests (from py3)
+#
+
+import io
+import sys
+import threading
+import time
+import unittest
+
+from local.dag import Node, runGraph
+
+
+def ok(log, name, delay=0):
+  def run(emit):
+    time.sleep(delay)
+    log.append(name)
+    emit('done')
+  return run
+
+
+def fail(log, name):
+  def run(emit):
+    log.append(name)
+    raise Exception('boom')
+  return run
+
+
+def statuses(outcomes):
+  return {o.name: o.status for o in outcomes}
+
+
+class RunnerTest(unittest.TestCase):
+
+  def run_(self, nodes, **kwargs):
+    return runGraph(nodes, out=io.StringIO(), **kwargs)
+
+  def test_deps_run_first(self):
+    log = []
+    nodes = [
+        Node('f1', ok(log, 'f1'), None, ['layer']),
+        Node('f2', ok(log, 'f2'), None, ['layer']),
+        Node('layer', ok(log, 'layer', 0.05), None, []),
+    ]
+    outcomes = self.run_(nodes, jobs=4)
+    self.assertEqual(log[0], 'layer')
+    self.assertEqual(sorted(log[1:]), ['f1', 'f2'])
+    self.assertEqual([o.name for o in outcomes], ['f1', 'f2', 'layer'])
+    self.assertEqual(set(statuses(outcomes).values()), {'ok'})
+
+  def test_runs_concurrently(self):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def job(emit):
+      with lock:
+        running.append(1)
+        peak.append(len(running))
+      time.sleep(0.05)
+      with lock:
+        running.pop()
+
+    self.run_([Node(str(i), job, None, []) for i in range(4)], jobs=4)
+    self.assertGreater(max(peak), 1)
+
+  def test_fail_fast_stops_and_skips(self):
+    log = []
+    nodes = [
+        Node('bad', fail(log, 'bad'), None, []),
+        Node('after', ok(log, 'after'), None, ['bad']),
+        Node('other', ok(log, 'other', 0.2), None, ['slow']),
+        Node('slow', ok(log, 'slow', 0.1), None, []),
+    ]
+    result = statuses(self.run_(nodes, jobs=2))
+    self.assertEqual(result['bad'], 'failed')
+    self.assertEqual(result['after'], 'skipped')
+    self.assertEqual(result['other'], 'skipped')
+    self.assertNotIn('after', log)
+    self.assertNotIn('other', log)
+
+  def test_keep_going_skips_only_dependents(self):
+    log = []
+    nodes = [
+        Node('bad', fail(log, 'bad'), None, []),
+        Node('child', ok(log, 'child'), None, ['bad']),
+        Node('grandchild', ok(log, 'grandchild'), None, ['child']),
+        Node('independent', ok(log, 'independent', 0.05), None, []),
+        Node('next', ok(log, 'next'), None, ['independent']),
+    ]
+    result = statuses(self.run_(nodes, jobs=2, keepGoing=True))
+    self.assertEqual(result, {
+        'bad': 'failed',
+        'child': 'skipped',
+        'grandchild': 'skipped',
+        'independent': 'ok',
+        'next': 'ok',
+    })
+
+  def test_cycle_is_skipped(self):
+    log = []
+    nodes = [
+        Node('a', ok(log, 'a'), None, ['b']),
+        Node('b', ok(log, 'b'), None, ['a']),
+        Node('c', ok(log, 'c'), None, []),
+    ]
+    result = statuses(self.run_(nodes, jobs=2, keepGoing=True))
+    self.assertEqual(result, {'a': 'skipped', 'b': 'skipped', 'c': 'ok'})
+    self.assertEqual(log, ['c'])
+
+  def test_unknown_dep(self):
+    with self.assertRaises(ValueError):
+      self.run_([Node('a', ok([], 'a'), None, ['missing'])])
+
+  def test_shell_command_exit_code(self):
+    nodes = [
+        Node('good', [sys.executable, '-c', 'print("hi")'], None, []),
+        Node('bad', [sys.executable, '-c', 'import sys; sys.exit(3)'], None, []),
+    ]
+    out = io.StringIO()
+    outcomes = {o.name: o for o in runGraph(nodes, jobs=2, keepGoing=True, out=out)}
+    self.assertEqual(outcomes['good'].status, 'ok')
+    self.assertEqual((outcomes['bad'].status, outcomes['bad'].code), ('failed', 3))
+    self.assertIn('hi', out.getvalue())
+
+
+if __name__ == '__main__':
+  unittest.main()
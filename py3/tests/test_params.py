@@ -0,0 +1,173 @@
+# -*- mode: python3 -*-
+#
+# python3 -m unittest discover -s tests (from py3)
+#
+
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import boto3
+from botocore.stub import Stubber
+
+from local import aws, cache
+from local.batch import Result
+from local.cache import ParamCache, valueHash
+from local.params import getRemoteState, getScope, planPush, recordWrites
+
+
+def meta(name, version, type='String'):
+  return {'Name': name, 'Type': type, 'Version': version, 'LastModifiedDate': datetime(2020, 1, 1)}
+
+
+def param(name, value, version, type='String'):
+  return dict(meta(name, version, type), Value=value)
+
+
+class SsmTest(unittest.TestCase):
+  '''
+    Runs against a stubbed SSM client and a throwaway cache directory
+  '''
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.saved = (cache.CACHE_DIR, aws._session, dict(aws._clients))
+    cache.CACHE_DIR = self.dir
+    aws._session = boto3.session.Session(
+        aws_access_key_id='AKIATEST', aws_secret_access_key='x', region_name='us-east-1')
+    aws._clients.clear()
+    client = aws._session.client('ssm')
+    aws._clients[('ssm', None)] = client
+    self.stub = Stubber(client)
+    self.stub.activate()
+    cache.getAccount('AKIATEST', lambda: '123456789012')
+
+  def tearDown(self):
+    self.stub.deactivate()
+    cache.CACHE_DIR, aws._session, clients = self.saved
+    aws._clients.clear()
+    aws._clients.update(clients)
+    shutil.rmtree(self.dir)
+
+  def listing(self, *pages):
+    for i, params in enumerate(pages):
+      res = {'Parameters': params}
+      if i < len(pages) - 1:
+        res['NextToken'] = str(i + 1)
+      self.stub.add_response('describe_parameters', res)
+
+  def values(self, *params):
+    self.stub.add_response('get_parameters', {'Parameters': list(params)})
+
+
+class PlanPushTest(unittest.TestCase):
+
+  def test_add_change_delete_unchanged(self):
+    remote = {
+        '/p/same': ('String', valueHash('String', 'a')),
+        '/p/changed': ('String', valueHash('String', 'old')),
+        '/p/gone': ('String', valueHash('String', 'x')),
+    }
+    local = [('/p/same', 'a', 'String'), ('/p/changed', 'new', 'String'), ('/p/new', 'n', 'String')]
+    plan = planPush(local, remote)
+    self.assertEqual(plan.add, [('/p/new', 'n', 'String')])
+    self.assertEqual(plan.change, [('/p/changed', 'new', 'String')])
+    self.assertEqual(plan.delete, ['/p/gone'])
+    self.assertEqual(plan.unchanged, ['/p/same'])
+
+  def test_type_change(self):
+    remote = {'/p/a': ('String', valueHash('String', 'v')), '/p/b': ('SecureString', valueHash('SecureString', 'v'))}
+    plan = planPush([('/p/a', 'v', 'SecureString'), ('/p/b', 'v', 'String')], remote)
+    self.assertEqual(plan.change, [('/p/a', 'v', 'SecureString'), ('/p/b', 'v', 'String')])
+    self.assertEqual(plan.unchanged, [])
+
+
+class RemoteStateTest(SsmTest):
+
+  def test_first_read_fetches_everything(self):
+    self.listing([meta('/p/a', 1), meta('/p/b', 1, 'SecureString')])
+    self.values(param('/p/a', 'x', 1), param('/p/b', 'y', 1, 'SecureString'))
+    state = getRemoteState('/p')
+    self.assertEqual(state, {
+        '/p/a': ('String', valueHash('String', 'x')),
+        '/p/b': ('SecureString', valueHash('SecureString', 'y')),
+    })
+    self.stub.assert_no_pending_responses()
+
+  def test_refresh_fetches_new_versions_only(self):
+    self.listing([meta('/p/a', 1), meta('/p/b', 1)])
+    self.values(param('/p/a', 'x', 1), param('/p/b', 'y', 1))
+    getRemoteState('/p')
+
+    # b has a new version, c is new, a is unchanged and not re-read
+    self.listing([meta('/p/a', 1), meta('/p/b', 2), meta('/p/c', 1)])
+    self.stub.add_response('get_parameters', {'Parameters': [param('/p/b', 'y2', 2), param('/p/c', 'z', 1)]},
+                           {'Names': ['/p/b', '/p/c'], 'WithDecryption': True})
+    state = getRemoteState('/p')
+    self.assertEqual(state['/p/a'], ('String', valueHash('String', 'x')))
+    self.assertEqual(state['/p/b'], ('String', valueHash('String', 'y2')))
+    self.assertEqual(state['/p/c'], ('String', valueHash('String', 'z')))
+    self.stub.assert_no_pending_responses()
+
+  def test_refresh_drops_deleted(self):
+    self.listing([meta('/p/a', 1), meta('/p/b', 1)])
+    self.values(param('/p/a', 'x', 1), param('/p/b', 'y', 1))
+    getRemoteState('/p')
+    self.listing([meta('/p/a', 1)])
+    self.assertEqual(list(getRemoteState('/p')), ['/p/a'])
+
+  def test_cached_skips_ssm(self):
+    self.listing([meta('/p/a', 1)])
+    self.values(param('/p/a', 'x', 1))
+    first = getRemoteState('/p')
+    self.assertEqual(getRemoteState('/p', cached=True), first)
+    self.stub.assert_no_pending_responses()
+
+  def test_truncated_listing_keeps_cache(self):
+    self.listing([meta('/p/a', 1), meta('/p/b', 1)], [meta('/p/c', 1), meta('/p/d', 1)])
+    self.values(param('/p/a', 'x', 1), param('/p/b', 'y', 1), param('/p/c', 'z', 1), param('/p/d', 'w', 1))
+    full = getRemoteState('/p')
+    before = ParamCache(getScope(), '/p').age()
+
+    self.stub.add_response('describe_parameters', {'Parameters': [meta('/p/a', 1)], 'NextToken': '1'})
+    self.stub.add_client_error('describe_parameters', 'ThrottlingException')
+    with self.assertRaises(aws.ClientError):
+      getRemoteState('/p')
+    self.assertGreaterEqual(ParamCache(getScope(), '/p').age(), before)
+    self.assertEqual(getRemoteState('/p', cached=True), full)
+
+
+class RecordWritesTest(SsmTest):
+
+  def test_puts_and_deletes_update_cache(self):
+    self.listing([meta('/p/a', 1), meta('/p/b', 1)])
+    self.values(param('/p/a', 'x', 1), param('/p/b', 'y', 1))
+    getRemoteState('/p')
+
+    puts = [('/p/a', 'x2', 'SecureString'), ('/p/n', 'n', 'String')]
+    results = [Result('/p/a', True, None, {'Version': 2}), Result('/p/n', True, None, {'Version': 1}),
+               Result('/p/b', True, None, None)]
+    recordWrites('/p', puts, results)
+    self.assertEqual(getRemoteState('/p', cached=True), {
+        '/p/a': ('SecureString', valueHash('SecureString', 'x2')),
+        '/p/n': ('String', valueHash('String', 'n')),
+    })
+
+  def test_failed_writes_are_not_recorded(self):
+    self.listing([meta('/p/a', 1)])
+    self.values(param('/p/a', 'x', 1))
+    before = getRemoteState('/p')
+    recordWrites('/p', [('/p/a', 'x2', 'String')], [Result('/p/a', False, Exception('throttled'), None)])
+    self.assertEqual(getRemoteState('/p', cached=True), before)
+
+  def test_overlapping_prefixes_are_dropped(self):
+    self.listing([meta('/p/a/b', 1)])
+    self.values(param('/p/a/b', 'x', 1))
+    getRemoteState('/p')
+    recordWrites('/p/a', [], [Result('/p/a/b', True, None, None)])
+    self.assertIsNone(ParamCache(getScope(), '/p').age())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,54 @@
+# -*- mode: python3 -*-
+#
+# python3 -m unittest discover -s tests (from py3)
+#
+
+import unittest
+
+from local.utils import decodeStream, iterFlat, replaceStream, unflatten
+
+
+def splits(data, size):
+  return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class UnflattenTest(unittest.TestCase):
+
+  def test_roundtrip(self):
+    ob = {'a': {'b': 1, 'c': {'d': 2}}, 'e': 3}
+    self.assertEqual(unflatten(iterFlat(ob, '/')), ob)
+
+  def test_empty_path(self):
+    for path in ('', '/', '//'):
+      with self.assertRaises(ValueError):
+        unflatten([(path, 1)])
+
+
+class StreamTest(unittest.TestCase):
+
+  def test_replace_across_chunks(self):
+    text = '{"paths": "/{basePath}/a", "x": "/{basePath}", "y": "/{base"}'
+    for size in range(1, len(text) + 1):
+      out = ''.join(replaceStream(splits(text, size), '/{basePath}', ''))
+      self.assertEqual(out, text.replace('/{basePath}', ''), 'chunk size {}'.format(size))
+
+  def test_replace_partial_match_at_end(self):
+    self.assertEqual(''.join(replaceStream(['abc/{base'], '/{basePath}', '')), 'abc/{base')
+    self.assertEqual(''.join(replaceStream(['a/{', 'basePath', '}b'], '/{basePath}', '/v1')), 'a/v1b')
+
+  def test_decode_multibyte_across_chunks(self):
+    text = 'naïve ✓ 𝄞 end'
+    data = text.encode('utf-8')
+    for size in range(1, 5):
+      self.assertEqual(''.join(decodeStream(splits(data, size))), text)
+
+  def test_decode_then_replace(self):
+    text = 'é/{basePath}✓/{basePath}'
+    data = text.encode('utf-8')
+    for size in range(1, len(data) + 1):
+      out = ''.join(replaceStream(decodeStream(splits(data, size)), '/{basePath}', ''))
+      self.assertEqual(out, 'é✓')
+
+
+if __name__ == '__main__':
+  unittest.main()
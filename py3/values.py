@@ -1,21 +1,30 @@
 #!/usr/bin/env python3
 # -*- mode: python3 -*-
 
-import boto3
-import botocore
+import sys
+if __name__ == "__main__":
+  # Run in daemon.py (if started) before paying for imports below
+  from local.server import forward
+  rc = forward('values', sys.argv[1:])
+  if rc is not None:
+    sys.exit(rc)
+
 import click
 import os
 
 from local.params import *
 from local.utils import *
 from local.console_util import *
+from local.trace import startFromOptions
 
 @click.group()
-def values():
+@click.option('--profile', is_flag=True, help='Print AWS call and phase timings (JSON lines to $MAKETOOLS_TRACE)')
+@click.pass_context
+def values(ctx, profile):
   '''
     SSM param helper tool
   '''
-  pass
+  startFromOptions(ctx, profile)
 
 valuesFile = 'values.yml'
 
@@ -35,7 +44,11 @@ def normKey(path):
   return '/' + (trimKey(path) or '')
 
 def printVals(vals):
-  for key, val in vals.items():
+  '''
+    Prints a dict or an iterable of (key, value) pairs
+  '''
+  items = vals.items() if isinstance(vals, dict) else vals
+  for key, val in items:
     col = blue if PARAM_REGEX.match(key) else red
     print(col("{}: {}".format(key,val)))
 
@@ -44,12 +57,29 @@ def printList(vals):
     col = blue if PARAM_REGEX.match(key) else red
     print(col("{}".format(key)))
 
+def printResults(results):
+  '''
+    Prints per-key outcome of a batch write followed by totals
+  '''
+  failed = 0
+  for r in results:
+    if r.ok:
+      note = ' [{}]'.format(r.value) if isinstance(r.value, str) else ''
+      print(green('ok: {}{}'.format(r.key, note)))
+    else:
+      failed += 1
+      print(red('failed: {} ({})'.format(r.key, r.error)))
+  summary = '\n{} succeeded, {} failed'.format(len(results) - failed, failed)
+  print(bred(summary) if failed else bold(summary))
+
 def readVals(file):
   ob=loadYaml(valuesFile)
   return ob['ssm']
 
-def getFlat(vals, root):
-
+def iterFlatVals(vals, root):
+  '''
+    Yields (key, value) for leaves under root without building a flat dict
+  '''
   if root:
     root = trimKey(root)
   if root:
@@ -62,49 +92,101 @@ def getFlat(vals, root):
     prefix = '/{}/'.format('/'.join(parts))
   else:
     prefix = '/'
-  return flatten(vals, prefix)
+  return iterFlat(vals, prefix)
+
+def getFlat(vals, root):
+  return dict(iterFlatVals(vals, root))
 
 def readFlat(file, root):
   vals=readVals(file)
   return getFlat(vals, root)
 
 
+def cacheOption(f):
+  '''
+    Adds --cached/--refresh (remote state comes from the local cache, see getRemoteState)
+  '''
+  return click.option(
+      '--cached/--refresh',
+      default=None,
+      help='Trust cached remote state until it expires / re-read everything from SSM')(f)
+
+
 @click.command()
 @click.option('-r', '--root', help='Root key')
-def show(root):
+@click.option('-R', '--remote', is_flag=True, help='Compare with remote (green: in sync, red: differs)')
+@cacheOption
+def show(root, remote, cached):
   '''
     Shows flat values from local
   '''
 
   print("Values from {} ({}):\n".format(valuesFile, root or '[all]'))
+  if not remote:
+    printVals(iterFlatVals(readVals(valuesFile), root))
+    return
+
   vals = readFlat(valuesFile, root)
-  printVals(vals)
+  state = getRemoteState(normKey(root), cached)
+  local = {name: (type, value) for name, value, type in toParams(vals)}
+  for name in sorted(set(local) | set(state)):
+    if name not in local:
+      print(dim('{} [remote only]'.format(name)))
+      continue
+    type, value = local[name]
+    col = green if state.get(name) == (type, valueHash(type, value)) else red
+    print(col('{}{}: {}'.format(name, '!' if type == 'SecureString' else '', value)))
 
 
 @click.command()
-@click.argument('key', nargs=1)
-def remove(key):
+@click.option('-j', '--jobs', default=8, help='max concurrent requests')
+@click.option('--rate', default=WRITE_RATE, help='max delete calls per second')
+@click.argument('keys', nargs=-1, required=True)
+def remove(keys, jobs, rate):
   '''
-    Remove everything at or under key from remote
+    Remove everything at or under each key from remote
   '''
-  root = normKey(key)
-  keys = getNamesUnderPath(root)
-  if not keys:
-    print('No keys matching {}'.format(root))
+  roots = disjointPaths(normKey(k) for k in keys)
+  names = sorted(set(iterNamesUnderPaths(roots, jobs)))
+  if not names:
+    print('No keys matching {}'.format(', '.join(roots)))
     return
   print('\nRemove:\n')
 
-  printList(keys)
+  printList(names)
 
   if click.confirm('\nContinue?', default=False):
-    for k in keys:
-      delParam(k)
+    results = delParams(names, jobs, rate)
+    for root in roots:
+      recordWrites(root, [], [r for r in results if isUnder(r.key, root)])
+    printResults(results)
+
+def toParams(vals):
+  '''
+    Converts flat values to (name, value, type) tuples
+
+    Keys ending in "!" are SecureString.
+  '''
+  params = []
+  for k, v in vals.items():
+    if k.endswith('!'):
+      params.append((k[:-1], v, 'SecureString'))
+    else:
+      params.append((k, v, 'String'))
+  return params
+
+def printPuts(puts):
+  printVals({name + ('!' if type == 'SecureString' else ''): value for name, value, type in puts})
 
 @click.command()
+@click.option('-j', '--jobs', default=8, help='max concurrent requests')
+@click.option('--rate', default=WRITE_RATE, help='max put/delete calls per second')
+@click.option('-f', '--force', is_flag=True, help='Rewrite unchanged values too')
+@cacheOption
 @click.argument('root', required=False)
-def push(root):
+def push(root, jobs, rate, force, cached):
   '''
-    Updates remote values from local
+    Updates remote values from local (only what changed)
   '''
 
   vals=readFlat(valuesFile, root)
@@ -113,27 +195,116 @@ def push(root):
     printList(vals.keys())
     return
 
-  print('Add:\n')
-  printVals(vals)
-
-  new = vals.keys()
-  newSet = set(new)
+  prefix = normKey(root)
+  plan = planPush(toParams(vals), getRemoteState(prefix, cached, jobs))
+  puts = plan.add + plan.change
+  if force:
+    unchanged = set(plan.unchanged)
+    puts += [p for p in toParams(vals) if p[0] in unchanged]
 
+  print('Add:\n')
+  printPuts(plan.add)
+  print('\nChange:\n')
+  printPuts(plan.change)
   print('\nRemove:\n')
-  prefix = normKey(root)
-  old = getNamesUnderPath(prefix)
-  toRemove = [x for x in old if x not in newSet]
-  printList(toRemove)
+  printList(plan.delete)
+  print(dim('\n{} unchanged{}'.format(len(plan.unchanged), ' (rewriting)' if force else '')))
+
+  if not puts and not plan.delete:
+    print('\nNothing to do')
+    return
 
   if click.confirm('\nContinue?', default=False):
-    for k in toRemove:
-      delParam(k)
-    for k, v in vals.items():
-      if k.endswith('!'):
-        k=k[:-1]
-        putSecure(k, v)
-      else:
-        putString(k, v)
+    results = delParams(plan.delete, jobs, rate)
+    results += putParams(puts, jobs, rate)
+    recordWrites(prefix, puts, results)
+    printResults(results)
+
+
+def readSecrets(file, root):
+  '''
+    Returns {name: value} for leaves of the secrets: section at or under root
+    (root may name a single secret)
+
+    Secret names have no leading slash (secrets: {codebuild: {github: {token: x}}}
+    is "codebuild/github/token").
+  '''
+  vals = loadYaml(file).get('secrets') or {}
+  root = trimKey(root)
+  if root:
+    for p in root.split('/'):
+      if not isinstance(vals, dict) or p not in vals:
+        raise Exception('Error locating {}'.format(root))
+      vals = vals[p]
+    if not isinstance(vals, dict):
+      return {root: str(vals)}
+    return {'{}/{}'.format(root, k): str(v) for k, v in iterFlat(vals)}
+  return {k: str(v) for k, v in iterFlat(vals)}
+
+
+@click.group()
+def secrets():
+  '''
+    Secrets Manager values (secrets: section of values.yml)
+  '''
+
+
+@click.command('push')
+@click.option('-j', '--jobs', default=8, help='max concurrent requests')
+@click.option('--rate', default=WRITE_RATE, help='max create/put/delete calls per second')
+@click.option('-f', '--force', is_flag=True, help='Rewrite unchanged values too')
+@click.option('--delete', is_flag=True, help='Also delete remote secrets under root missing from values.yml')
+@click.argument('root', required=False)
+def secretsPush(root, jobs, rate, force, delete):
+  '''
+    Updates secrets under root from local (only what changed)
+
+    Remote secrets under root that are not in values.yml are only deleted
+    with --delete (after a second confirmation), and then with the default
+    recovery window. Secrets scheduled for deletion are restored before
+    being written. Binary secrets are skipped. Values are compared by hash
+    and never printed.
+  '''
+  vals = readSecrets(valuesFile, root)
+  if not root:
+    print('Please specify a prefix:\n')
+    printList(vals.keys())
+    return
+
+  state = getSecretState(trimKey(root), vals, jobs)
+  plan = planSecrets(vals, state)
+  if force:
+    plan = plan._replace(change=plan.change + [(n, vals[n]) for n in plan.unchanged], unchanged=[])
+  remoteOnly = plan.delete
+  restore = set(pendingSecrets(state))
+  if not delete:
+    plan = plan._replace(delete=[])
+
+  print('Add:\n')
+  printList([name for name, _ in plan.add])
+  print('\nChange:\n')
+  printList([name + (' (restore)' if name in restore else '') for name, _ in plan.change])
+  if delete:
+    print('\nRemove:\n')
+    printList(plan.delete)
+  elif remoteOnly:
+    print(dim('\n{} remote only (kept, see --delete)'.format(len(remoteOnly))))
+  binary = binarySecrets(state)
+  if binary:
+    print(dim('\nSkipped (binary):\n'))
+    printList(binary)
+  print(dim('\n{} unchanged'.format(len(plan.unchanged))))
+
+  if not plan.add and not plan.change and not plan.delete:
+    print('\nNothing to do')
+    return
+
+  if not click.confirm('\nContinue?', default=False):
+    return
+  if plan.delete and not click.confirm(
+      'Delete {} secrets (recoverable during the recovery window)?'.format(len(plan.delete)), default=False):
+    plan = plan._replace(delete=[])
+  printResults(writeSecrets(plan, jobs, rate, restore=restore))
 
 
 # TODO
@@ -151,6 +322,8 @@ def push(root):
 values.add_command(show)
 values.add_command(push)
 values.add_command(remove)
+secrets.add_command(secretsPush)
+values.add_command(secrets)
 #setup.add_command(set_codebuild_token)
 
 if __name__ == "__main__":
@@ -42,13 +42,16 @@ SWAGGER_FILE=$(GEN_DIR)/$(SWAGGER_BASE_NAME).yaml
 	validate \
 	package \
 	deploy \
+	changeset \
 	errors \
+	events \
 	generated-clean \
 	output \
 	output-table \
 	sdk \
 	swagger \
 	swagger-postman \
+	export \
 	version-dev
 
 SHELL=/usr/bin/env bash -o pipefail
@@ -57,6 +60,12 @@ SHELL=/usr/bin/env bash -o pipefail
 makefiles = $(shell export GLOBIGNORE="./funcs/ignore/.*" ; echo ./funcs/*/makefile)
 subdirs := $(foreach proj,$(makefiles),$(dir $(proj)))
 
+# Runs function targets in parallel (e.g. BUILD_FLAGS="-j 8 -k" to keep going)
+# Unchanged functions are restored from the build cache; set
+# MAKETOOLS_ARTIFACT_STORE=s3://bucket/prefix to share it (e.g. across CI runs).
+# Restored zips are byte-identical, so package does not upload them again.
+BUILD_PY = $(SELF_DIR)/py3/build.py $(BUILD_FLAGS)
+
 list:
 	@echo Stack name: $(STACK_NAME)
 	@echo Subdirs: $(subdirs)
@@ -64,15 +73,10 @@ list:
 	@(make -qp || true) | grep -v '^list$$' | awk -F':' '/^[a-zA-Z0-9][^$$#\/\t=]*:([^=]|$$)/ {split($$1,A,/ /);for(i in A)print A[i]}' | sort
 
 build-src:
-	@for dir in $(subdirs); do \
-		$(MAKE) -C $$dir build; \
-	 done
+	@$(BUILD_PY) src --no-layer
 
 build-lambda:
-	@echo "Building lambdas... [$(subdirs)]"
-	@for dir in $(subdirs); do \
-		$(MAKE) -C $$dir lambda; \
-	 done
+	@$(BUILD_PY) lambda --no-layer
 
 build-layer:
 	@echo "Building layer(s)..."
@@ -82,34 +86,22 @@ clean-layer:
 	$(MAKE) -C ./layer/nodejs clean
 
 clean-projects:
-	@for dir in $(subdirs); do \
-		$(MAKE) -C $$dir clean; \
-	 done
+	@$(BUILD_PY) clean
 
 test:
-	@set -e; for dir in $(subdirs); do \
-		cd $$dir; \
-		npm run test; \
-	 done
+	@$(BUILD_PY) test
 
 lint:
-	@set -e; for dir in $(subdirs); do \
-		cd $$dir; \
-		npm run lint; \
-	 done
+	@$(BUILD_PY) lint
 
 clean: clean-projects clean-layer
 	@rm -rf .aws-sam
 	@rm -f $$SAM_DEPLOY_TEMPLATE
 
 
-# Add build-layer as dependency if ./layer exists
-BUILD_DEPS = build-lambda
-ifneq "$(wildcard ./layer)" ""
-BUILD_DEPS += build-layer
-endif
-
-build: $(BUILD_DEPS)
+# Layer (if present) first, then all functions in parallel
+build:
+	@$(BUILD_PY) lambda
 
 local-api:
 	sam local start-api
@@ -144,18 +136,19 @@ $(SAM_DEPLOY_TEMPLATE): build
 package: $(SAM_DEPLOY_TEMPLATE)
 
 
+# Change set deploy (skipped when nothing changed since the last one)
 deploy: $(SAM_DEPLOY_TEMPLATE)
-	sam deploy \
-		--template-file $(SAM_DEPLOY_TEMPLATE) \
-		--stack-name $(STACK_NAME) \
-		--capabilities CAPABILITY_NAMED_IAM
-
-# changeset: $(SAM_DEPLOY_TEMPLATE)
-# 	@aws cloudformation deploy \
-# 		--no-execute-changeset \
-# 		--template-file $(SAM_DEPLOY_TEMPLATE) \
-# 		--stack-name $(STACK_NAME) \
-# 		--capabilities CAPABILITY_NAMED_IAM
+	@$(SELF_DIR)/py3/stack.py deploy \
+		--template $(SAM_DEPLOY_TEMPLATE) \
+		--s3-bucket $(PACKAGE_OUTPUT_BUCKET) \
+		$(STACK_NAME)
+
+# Create change set for review only
+changeset: $(SAM_DEPLOY_TEMPLATE)
+	@$(SELF_DIR)/py3/stack.py deploy --no-execute \
+		--template $(SAM_DEPLOY_TEMPLATE) \
+		--s3-bucket $(PACKAGE_OUTPUT_BUCKET) \
+		$(STACK_NAME)
 
 destroy:
 	aws cloudformation delete-stack \
@@ -165,10 +158,13 @@ endif
 
 
 
+# Failed events (only events since the last call are fetched)
 errors:
-	@aws cloudformation describe-stack-events \
-			--stack-name $(STACK_NAME) \
-			| jq '.StackEvents[]|select(.ResourceStatus|index("FAILED"))'
+	@$(SELF_DIR)/py3/stack.py events --failed-only $(STACK_NAME)
+
+# Follow events (e.g. during a deploy) until the stack settles
+events:
+	@$(SELF_DIR)/py3/stack.py events --follow --exit-when-done $(STACK_NAME)
 
 output-table:
 	aws cloudformation describe-stacks \
@@ -198,7 +194,12 @@ sdk:
 	@mkdir -p $(GEN_DIR)
 	@$(SELF_DIR)/py3/stack.py sdk -d $(GEN_DIR) $(STACK_NAME)
 
+# All swagger flavors plus JS sdk, downloaded concurrently
+export:
+	@mkdir -p $(GEN_DIR)
+	@$(SELF_DIR)/py3/stack.py export -a -s javascript -d $(GEN_DIR) $(STACK_NAME)
+
 version-dev:
-	$(eval ID=$(shell $(MAKETOOLS)/getStackOutputVal.sh $(STACK_NAME) ApiId))
+	$(eval ID=$(shell $(SELF_DIR)/py3/stack.py output $(STACK_NAME) ApiId))
 	aws apigateway get-stages --rest-api-id $(ID) --query 'item[?stageName==`dev`]'
 